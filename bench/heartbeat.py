@@ -0,0 +1,100 @@
+"""
+Heartbeat latency of the eventlet hub while slow database calls are running.
+A green thread sleeps for a fixed interval and records how late it wakes up,
+first with the calls made directly in the hub, then through DBExecutor's tpool backend.
+
+    python bench/heartbeat.py                                    # blocking 500 ms call standing in for a slow query
+    python bench/heartbeat.py --mongo mongodb://localhost:27017/mybb_twitter   # cold feed pages from a real database
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import eventlet
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_executor import DBExecutor  # noqa: E402
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def measure(executor: DBExecutor, query, duration: float, interval: float, concurrency: int) -> dict:
+    lags = []
+    queries = []
+    deadline = time.monotonic() + duration
+
+    def heartbeat():
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            eventlet.sleep(interval)
+            lags.append(time.monotonic() - started - interval)
+
+    def worker():
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            executor.run(query)
+            queries.append(time.monotonic() - started)
+
+    threads = [eventlet.spawn(heartbeat)] + [eventlet.spawn(worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.wait()
+    return {
+        "backend": executor.backend,
+        "queries": len(queries),
+        "query_ms_p50": round(percentile(queries, 0.5) * 1000, 1),
+        "heartbeat_lag_ms_p50": round(percentile(lags, 0.5) * 1000, 1),
+        "heartbeat_lag_ms_p99": round(percentile(lags, 0.99) * 1000, 1),
+        "heartbeat_lag_ms_max": round(max(lags, default=0) * 1000, 1),
+    }
+
+
+def blocking_query(seconds: float):
+    # time.sleep не пропатчен: поток блокируется так же, как на чтении из сокета pymongo
+    return lambda: time.sleep(seconds)
+
+
+def feed_query(url: str):
+    import mongoengine
+    from user_functions import UserService
+    mongoengine.connect(host=url)
+    service = UserService()
+
+    def query():
+        # Каждый раз холодная лента: без кэшей страниц и пользователей
+        service.feed_cache.clear()
+        service.user_cache.clear()
+        service.get_recent_messages(limit=50)
+    return query
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo', help="database URL; without it a blocking sleep stands in for the query")
+    parser.add_argument('--query-ms', type=float, default=500, help="length of the simulated query")
+    parser.add_argument('--duration', type=float, default=3, help="seconds per backend")
+    parser.add_argument('--interval-ms', type=float, default=10, help="heartbeat interval")
+    parser.add_argument('--concurrency', type=int, default=4, help="green threads issuing queries")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    query = feed_query(args.mongo) if args.mongo else blocking_query(args.query_ms / 1000)
+    results = [measure(DBExecutor(backend, timeout=None), query, args.duration, args.interval_ms / 1000,
+                       args.concurrency)
+               for backend in ('inline', 'tpool')]
+    for result in results:
+        print(f"{result['backend']:>7}: {result['queries']:4d} queries, query p50 {result['query_ms_p50']} ms, "
+              f"heartbeat lag p50 {result['heartbeat_lag_ms_p50']} ms, p99 {result['heartbeat_lag_ms_p99']} ms, "
+              f"max {result['heartbeat_lag_ms_max']} ms")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+"""
+Load benchmark for the Socket.IO events and HTTP routes registered in server.py.
+N simulated clients connect to the real app through Flask-SocketIO test clients (same handlers, rooms,
+caches and DB executor, without the network) and perform a weighted mix of actions concurrently,
+each in its own green thread; the DB executor's tpool lets one client's handler run while another waits on the database.
+Reports throughput and p50/p95/p99 latency per event, database operations per request and bytes
+emitted per client, and writes everything to JSON so that runs on different commits can be compared.
+
+    python bench/load.py --clients 50 --requests 5000 --json bench/results/$(git rev-parse --short HEAD).json
+    python bench/load.py --mongo mongodb://localhost:27017/mybb_twitter_bench
+    python bench/load.py --compare before.json after.json
+"""
+import argparse
+import contextvars
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import eventlet
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from query_profiler import IGNORED_COMMANDS, mongomock_commands  # noqa: E402
+
+# Действие -> вес в смеси нагрузки
+MIX = {
+    'get recent messages': 30,
+    'like message': 20,
+    'remove like message': 8,
+    'create comment': 10,
+    'get likes': 8,
+    'create subcomment': 6,
+    'create message': 5,
+    'ignore user': 2,
+    'unignore user': 2,
+    'POST /get_likes': 5,
+    'POST /create_message': 4,
+}
+# Результат последнего обработчика сокет-события в текущем зелёном потоке
+handler_result = contextvars.ContextVar('handler_result', default=None)
+
+
+class DBOpCounter(monitoring.CommandListener):
+    """
+    Counts database operations of each timed request, also while requests run concurrently:
+    the tally lives in a context variable, which DBExecutor carries into its threads.
+    Command events on a real mongod, outermost collection calls on mongomock
+    """
+
+    def __init__(self):
+        self.current = contextvars.ContextVar('db_ops', default=None)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def counting(self):
+        tally = [0]
+        token = self.current.set(tally)
+        try:
+            yield tally
+        finally:
+            self.current.reset(token)
+
+    def started(self, event) -> None:
+        tally = self.current.get()
+        if tally is not None and event.command_name not in IGNORED_COMMANDS:
+            with self.lock:
+                tally[0] += 1
+
+    def succeeded(self, event) -> None:
+        pass
+
+    def failed(self, event) -> None:
+        pass
+
+    def install_mongomock(self) -> None:
+        mongomock_commands(self).start()
+
+
+def connect_database(url, counter: DBOpCounter) -> str:
+    import mongoengine
+    mongoengine.disconnect()
+    if url:
+        mongoengine.connect(host=url, event_listeners=[counter])
+        return url
+    import mongomock
+    counter.install_mongomock()
+    mongoengine.connect('mybb_twitter_bench', mongo_client_class=mongomock.MongoClient)
+    return 'mongomock'
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def is_error(result) -> bool:
+    """
+    Whether a handler result reports a failure: a response or a (body, status) tuple with a 4xx/5xx status,
+    or a dict with an error or such a status
+    """
+    if isinstance(result, tuple):
+        status = next((item for item in result[1:] if isinstance(item, int)), None)
+        return (status is not None and status >= 400) or is_error(result[0])
+    status = getattr(result, 'status_code', None)
+    if isinstance(result, dict):
+        if 'error' in result:
+            return True
+        status = result.get('status')
+    return isinstance(status, int) and status >= 400
+
+
+def record_handler_results(socketio) -> None:
+    """
+    A test client drops what a socket handler returns unless it asks for an ack, and these handlers return
+    Flask responses that an ack cannot carry. Keeps the result in handler_result for timed() instead
+    """
+    handlers = socketio.server.handlers['/']
+    for event, handler in handlers.items():
+        if event in ('connect', 'disconnect') or getattr(handler, 'records_result', False):
+            continue
+
+        def recording(*args, handler=handler):
+            result = handler(*args)
+            handler_result.set(result)
+            return result
+        recording.records_result = True
+        handlers[event] = recording
+
+
+def emit(socket, event: str, *args):
+    """Emits like the browser does and returns what the server handler returned"""
+    handler_result.set(None)
+    socket.emit(event, *args)
+    return handler_result.get()
+
+
+class Client:
+    def __init__(self, user_id: int, socket_client, http, rng: random.Random):
+        self.user_id = user_id
+        self.socket = socket_client
+        self.http = http
+        # У каждого клиента своя последовательность действий, сколько бы клиентов ни шло одновременно
+        self.rng = rng
+        self.liked = set()
+        self.ignored = set()
+        self.bytes_received = 0
+
+
+class LoadRun:
+    def __init__(self, app, socketio, clients: int, seed_messages: int, rng: random.Random, counter: DBOpCounter):
+        self.app = app
+        self.socketio = socketio
+        self.rng = rng
+        self.counter = counter
+        self.latencies = defaultdict(list)
+        self.db_ops = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.message_ids = []
+        self.comment_ids = []
+        record_handler_results(socketio)
+        self.seed(clients, seed_messages)
+        self.clients = [self.connect(user_id) for user_id in range(1, clients + 1)]
+
+    def seed(self, clients: int, seed_messages: int) -> None:
+        from models import INDEXED_DOCUMENTS, ensure_indexes
+        from user_functions import UserService
+        for model in INDEXED_DOCUMENTS:
+            model.drop_collection()
+        ensure_indexes()
+        service = UserService()
+        for user_id in range(1, clients + 1):
+            service.create_user(user_id, f"user{user_id}", f"https://forum.example/avatars/{user_id}.png")
+        for index in range(seed_messages):
+            author = self.rng.randint(1, clients)
+            message_id = service.create_message(author, f"Seed message {index} " + "lorem ipsum " * 10)
+            self.message_ids.append(message_id)
+            for _ in range(self.rng.randint(0, 3)):
+                comment_id = service.create_comment(self.rng.randint(1, clients), message_id, "Seed comment")
+                self.comment_ids.append((message_id, comment_id))
+
+    def timed(self, name: str, action) -> None:
+        """Runs action, which returns what the handler returned, and charges it to name"""
+        started = time.perf_counter()
+        with self.counter.counting() as ops:
+            try:
+                failed = is_error(action())
+            except Exception:
+                failed = True
+        self.latencies[name].append(time.perf_counter() - started)
+        self.db_ops[name] += ops[0]
+        self.errors[name] += failed
+
+    def connect(self, user_id: int) -> Client:
+        client = Client(user_id, None, self.app.test_client(), random.Random(self.rng.random()))
+
+        def action():
+            client.socket = self.socketio.test_client(self.app)
+            results = [emit(client.socket, 'join', {'room': 'room', 'user_id': user_id}),
+                       emit(client.socket, 'get recent messages', {'user_id': user_id}),
+                       emit(client.socket, 'join threads', {'message_ids': self.message_ids[-10:]})]
+            return next((result for result in results if is_error(result)), None)
+
+        self.timed('connect', action)
+        return client
+
+    def drain(self, client: Client) -> None:
+        # Учитываем всё, что сервер отправил клиенту, и запоминаем новые id для следующих действий
+        for packet in client.socket.get_received():
+            client.bytes_received += len(json.dumps(packet['args'], default=str))
+            data = packet['args'][0] if packet['args'] else None
+            if not isinstance(data, dict):
+                continue
+            if packet['name'] == 'new tweet' and data.get('user_id') == client.user_id:
+                self.message_ids.append(data['message_id'])
+                client.socket.emit('join threads', {'message_ids': [data['message_id']]})
+            elif packet['name'] == 'new comment' and data.get('user_id') == client.user_id:
+                self.comment_ids.append((data['message_id'], data['comment_id']))
+
+    def step(self, client: Client, name: str) -> None:
+        user_id = client.user_id
+        message_id = client.rng.choice(self.message_ids[-200:])
+        profile = {'user_id': user_id, 'username': f"user{user_id}",
+                   'avatar_url': f"https://forum.example/avatars/{user_id}.png"}
+        if name == 'like message' and message_id in client.liked:
+            name = 'remove like message'
+        elif name == 'remove like message' and message_id not in client.liked:
+            name = 'like message'
+        if name == 'unignore user' and not client.ignored:
+            name = 'ignore user'
+
+        socket = client.socket
+        if name == 'get recent messages':
+            action = lambda: emit(socket, name, {'user_id': user_id})
+        elif name == 'like message':
+            client.liked.add(message_id)
+            action = lambda: emit(socket, name, user_id, message_id, 'tweet')
+        elif name == 'remove like message':
+            client.liked.discard(message_id)
+            action = lambda: emit(socket, name, user_id, message_id, 'tweet')
+        elif name == 'get likes':
+            items = [['tweet', item] for item in self.message_ids[-20:]]
+            action = lambda: emit(socket, name, {'user_id': user_id, 'items': items})
+        elif name == 'create message':
+            action = lambda: emit(socket, name, dict(profile, content="Benchmark tweet " + "lorem " * 20))
+        elif name == 'create comment':
+            action = lambda: emit(socket, name, {'user_id': user_id, 'message_id': message_id,
+                                                'content': "Benchmark comment"})
+        elif name == 'create subcomment':
+            _, comment_id = client.rng.choice(self.comment_ids[-200:])
+            action = lambda: emit(socket, name, {'user_id': user_id, 'message_id': comment_id,
+                                                'content': "Benchmark reply"})
+        elif name == 'ignore user':
+            ignored_user_id = client.rng.choice([other.user_id for other in self.clients if other is not client])
+            client.ignored.add(ignored_user_id)
+            action = lambda: emit(socket, name, {'user_id': user_id, 'ignored_user_id': ignored_user_id})
+        elif name == 'unignore user':
+            ignored_user_id = client.ignored.pop()
+            action = lambda: emit(socket, name, {'user_id': user_id, 'ignored_user_id': ignored_user_id})
+        elif name == 'POST /get_likes':
+            items = [['tweet', item] for item in self.message_ids[-20:]]
+            action = lambda: client.http.post('/get_likes', json={'user_id': user_id, 'items': items})
+        elif name == 'POST /create_message':
+            action = lambda: client.http.post('/create_message', json=dict(profile, content="Benchmark HTTP tweet"))
+        else:
+            raise ValueError(f"Unknown action: {name}")
+        self.timed(name, action)
+
+    def run(self, requests: int) -> float:
+        """requests actions split evenly between the clients, which all run at once"""
+        count = len(self.clients)
+        started = time.perf_counter()
+        threads = [eventlet.spawn(self.client_loop, client, requests // count + (index < requests % count))
+                   for index, client in enumerate(self.clients)]
+        for thread in threads:
+            thread.wait()
+        for client in self.clients:
+            self.drain(client)
+        return time.perf_counter() - started
+
+    def client_loop(self, client: Client, requests: int) -> None:
+        names = list(MIX)
+        weights = [MIX[name] for name in names]
+        for _ in range(requests):
+            self.step(client, client.rng.choices(names, weights)[0])
+            self.drain(client)
+            # Без ожидания базы зелёный поток не уступил бы хаб другим клиентам
+            eventlet.sleep(0)
+
+    def report(self, seconds: float) -> dict:
+        events = {}
+        for name, latencies in sorted(self.latencies.items()):
+            events[name] = {
+                "count": len(latencies),
+                "errors": self.errors[name],
+                "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+                "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+                "max_ms": round(max(latencies) * 1000, 3),
+                "db_ops_per_request": round(self.db_ops[name] / len(latencies), 2),
+            }
+        received = [client.bytes_received for client in self.clients]
+        requests = sum(len(latencies) for name, latencies in self.latencies.items() if name != 'connect')
+        return {
+            "total": {"requests": requests, "seconds": round(seconds, 3),
+                      "throughput_rps": round(requests / seconds, 1) if seconds else None},
+            "events": events,
+            "bytes_emitted_per_client": {"mean": round(sum(received) / len(received)),
+                                         "p50": percentile(received, 0.5), "max": max(received)},
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before_path: str, after_path: str) -> None:
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    print(f"{before['meta'].get('commit')} -> {after['meta'].get('commit')}: throughput "
+          f"{before['total']['throughput_rps']} -> {after['total']['throughput_rps']} req/s")
+    for name in sorted(set(before['events']) | set(after['events'])):
+        old, new = before['events'].get(name), after['events'].get(name)
+        if old is None or new is None:
+            print(f"{name:>22}: only in {'after' if old is None else 'before'}")
+            continue
+        print(f"{name:>22}: p50 {old['p50_ms']} -> {new['p50_ms']} ms, p99 {old['p99_ms']} -> {new['p99_ms']} ms, "
+              f"db ops {old['db_ops_per_request']} -> {new['db_ops_per_request']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo', help="database URL of a local mongod; mongomock when omitted")
+    parser.add_argument('--clients', type=int, default=20, help="simulated socket clients")
+    parser.add_argument('--requests', type=int, default=2000, help="actions across all clients")
+    parser.add_argument('--seed-messages', type=int, default=100, help="tweets created before the run")
+    parser.add_argument('--seed', type=int, default=1, help="random seed of the action mix")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two result files")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    counter = DBOpCounter()
+    import server
+    database = connect_database(args.mongo, counter)
+    run = LoadRun(server.app, server.socketio, args.clients, args.seed_messages, random.Random(args.seed), counter)
+    seconds = run.run(args.requests)
+    results = dict(meta={
+        "commit": git_commit(),
+        "date": datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        "database": database,
+        "clients": args.clients,
+        "seed_messages": args.seed_messages,
+        "seed": args.seed,
+        "python": platform.python_version(),
+    }, **run.report(seconds))
+
+    total = results['total']
+    print(f"{total['requests']} requests in {total['seconds']} s: {total['throughput_rps']} req/s")
+    for name, stats in results['events'].items():
+        print(f"{name:>22}: {stats['count']:5d} x, p50 {stats['p50_ms']} ms, p95 {stats['p95_ms']} ms, "
+              f"p99 {stats['p99_ms']} ms, {stats['db_ops_per_request']} db ops, {stats['errors']} errors")
+    print(f"bytes emitted per client: {results['bytes_emitted_per_client']}")
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+CPU cost of turning query results into feed items, per feed page.
+'documents' is the old read path: every result becomes a mongoengine Document (_from_son, what a queryset
+does for each document it yields) and is serialized with message_to_dict/comment_to_dict/subcomment_to_dict.
+'rows' is the current one: the raw dicts from as_pymongo() go straight into the *_row_to_dict builders.
+No database is needed: a page of synthetic documents with the stored field layout is serialized repeatedly.
+
+    python bench/serialize.py
+    python bench/serialize.py --tweets 50 --comments 3 --subcomments 3 --pages 2000 --json bench/results/serialize.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import Message, Comment, SubComment  # noqa: E402
+from message_manager import MessageManager  # noqa: E402
+from user_cache import CachedUser  # noqa: E402
+
+
+# Словарь для текстов: одинаковые строки сжимались бы лучше настоящих
+WORDS = ("тред", "лента", "сервер", "форум", "ответ", "сегодня", "новый", "пост", "мысль", "вопрос", "спасибо",
+         "update", "release", "socket", "feed", "like", "why", "great", "idea", "later", "again", "maybe")
+
+
+def text(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def make_page(tweets: int, comments: int, subcomments: int, users: int = 10) -> dict:
+    """Документы одной страницы ленты в том виде, в каком их возвращает as_pymongo() с проекцией ленты"""
+    rng = random.Random(0)
+    authors = [CachedUser(id=ObjectId(), forum_id=index, username=f"user{index}",
+                          avatar_url=f"https://forum.example/uploads/avatars/{index}.png", banned=False,
+                          ignored_ids=frozenset()) for index in range(users)]
+    started = datetime(2023, 7, 1)
+    page = {'authors': {author.id: author for author in authors}, 'tweet': [], 'comment': [], 'subcomment': []}
+    for tweet in range(tweets):
+        tweet_id = ObjectId()
+        page['tweet'].append({'_id': tweet_id, 'user': authors[tweet % users].id, 'content': text(rng, 20),
+                              'created_at': started - timedelta(minutes=tweet), 'likes_count': 5,
+                              'comments_count': comments, 'subcomments_count': comments * subcomments})
+        for comment in range(comments):
+            comment_id = ObjectId()
+            page['comment'].append({'_id': comment_id, 'user': authors[comment % users].id, 'message': tweet_id,
+                                    'content': text(rng, 10), 'created_at': started, 'likes_count': 1,
+                                    'subcomments_count': subcomments})
+            for subcomment in range(subcomments):
+                page['subcomment'].append({'_id': ObjectId(), 'user': authors[subcomment % users].id,
+                                           'parent_comment': comment_id, 'content': text(rng, 10),
+                                           'created_at': started, 'likes_count': 0})
+    return page
+
+
+DOCUMENTS = (
+    ('tweet', Message, MessageManager.message_to_dict),
+    ('comment', Comment, MessageManager.comment_to_dict),
+    ('subcomment', SubComment, MessageManager.subcomment_to_dict),
+)
+ROWS = (
+    ('tweet', MessageManager.message_row_to_dict),
+    ('comment', MessageManager.comment_row_to_dict),
+    ('subcomment', MessageManager.subcomment_row_to_dict),
+)
+
+
+def serialize_documents(page: dict) -> list:
+    authors = page['authors']
+    items = []
+    for kind, model, serializer in DOCUMENTS:
+        for row in page[kind]:
+            # _from_son меняет словарь: queryset каждый раз получает новый от драйвера
+            document = model._from_son(dict(row))
+            # Как при no_dereference(): id автора без обращения к базе
+            author_id = document._data.get('user')
+            items.append(serializer(document, author=authors.get(getattr(author_id, 'id', author_id))))
+    return items
+
+
+def serialize_rows(page: dict) -> list:
+    authors = page['authors']
+    items = []
+    for kind, serializer in ROWS:
+        for row in page[kind]:
+            items.append(serializer(dict(row), authors.get(row['user'])))
+    return items
+
+
+def measure(serialize, page: dict, pages: int) -> dict:
+    serialize(page)
+    started = time.process_time()
+    for _ in range(pages):
+        serialize(page)
+    seconds = time.process_time() - started
+    items = len(page['tweet']) + len(page['comment']) + len(page['subcomment'])
+    return {"cpu_us_per_page": round(seconds / pages * 1e6, 1),
+            "cpu_us_per_item": round(seconds / pages / items * 1e6, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tweets', type=int, default=10, help="tweets per page")
+    parser.add_argument('--comments', type=int, default=3, help="comments per tweet shown with the feed")
+    parser.add_argument('--subcomments', type=int, default=3, help="replies per comment shown with the feed")
+    parser.add_argument('--pages', type=int, default=1000, help="pages serialized per path")
+    parser.add_argument('--json', help="write the results to this file")
+    args = parser.parse_args()
+
+    page = make_page(args.tweets, args.comments, args.subcomments)
+    # Оба пути обязаны давать одинаковый ответ
+    assert serialize_documents(page) == serialize_rows(page)
+    results = {
+        "items_per_page": len(page['tweet']) + len(page['comment']) + len(page['subcomment']),
+        "documents": measure(serialize_documents, page, args.pages),
+        "rows": measure(serialize_rows, page, args.pages),
+    }
+    results["speedup"] = round(results["documents"]["cpu_us_per_page"] / results["rows"]["cpu_us_per_page"], 2)
+
+    print(f"{results['items_per_page']} items per page")
+    for path in ('documents', 'rows'):
+        print(f"{path:>9}: {results[path]['cpu_us_per_page']} us CPU per page, "
+              f"{results[path]['cpu_us_per_item']} us per item")
+    print(f"speedup: {results['speedup']}x")
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
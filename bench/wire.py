@@ -0,0 +1,95 @@
+"""
+Size of a 'recent messages' feed page on the wire and the server CPU spent encoding it, per wire format.
+'json' is the default payload; 'compact' moves authors into a users table that items refer to by index;
+'msgpack' packs the compact payload into bytes (only when the msgpack package is installed).
+Text formats are measured as the JSON Socket.IO writes, and every format also with raw deflate,
+which is what permessage-deflate sends for a packet above COMPRESSION_THRESHOLD.
+No database is needed: the page is built from the synthetic documents of bench/serialize.py.
+
+    python bench/wire.py
+    python bench/wire.py --tweets 50 --users 50 --pages 2000 --json bench/results/wire.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import zlib
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from feed_assembler import FeedAssembler  # noqa: E402
+from serialize import make_page  # noqa: E402
+from wire_format import WIRE_FORMATS, encode, expand, msgpack  # noqa: E402
+
+
+def feed_payload(page: dict) -> dict:
+    """Ответ 'recent messages' из документов страницы, как его собирает FeedAssembler"""
+    authors = page['authors']
+    subcomments = defaultdict(list)
+    for row in page['subcomment']:
+        subcomments[row['parent_comment']].append(
+            FeedAssembler.subcomment_node(row, authors.get(row['user'])))
+    comments = defaultdict(list)
+    for row in page['comment']:
+        comments[row['message']].append(
+            FeedAssembler.comment_node(row, authors.get(row['user']), subcomments[row['_id']]))
+    nodes = [FeedAssembler.message_node(row, authors.get(row['user']), comments[row['_id']])
+             for row in page['tweet']]
+    return {"messages": [FeedAssembler.render(node) for node in nodes], "has_more_messages": True,
+            "next_cursor": None, "liked_ids": []}
+
+
+def to_wire(payload: dict, wire: str) -> bytes:
+    encoded = encode(payload, wire)
+    if isinstance(encoded, bytes):
+        return encoded
+    return json.dumps(encoded, separators=(',', ':')).encode()
+
+
+def deflate(data: bytes) -> int:
+    # permessage-deflate: «сырой» deflate с завершающим блоком без четырёх хвостовых байт
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+
+def measure(payload: dict, wire: str, pages: int) -> dict:
+    data = to_wire(payload, wire)
+    started = time.process_time()
+    for _ in range(pages):
+        to_wire(payload, wire)
+    seconds = time.process_time() - started
+    return {"bytes": len(data), "deflated_bytes": deflate(data),
+            "cpu_us_per_page": round(seconds / pages * 1e6, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tweets', type=int, default=10, help="tweets per page")
+    parser.add_argument('--comments', type=int, default=3, help="comments per tweet shown with the feed")
+    parser.add_argument('--subcomments', type=int, default=3, help="replies per comment shown with the feed")
+    parser.add_argument('--users', type=int, default=10, help="distinct authors on the page")
+    parser.add_argument('--pages', type=int, default=1000, help="pages encoded per format")
+    parser.add_argument('--json', help="write the results to this file")
+    args = parser.parse_args()
+
+    payload = feed_payload(make_page(args.tweets, args.comments, args.subcomments, args.users))
+    # Компактный формат обязан разворачиваться в исходный ответ
+    assert expand(encode(payload, 'compact')) == payload
+    formats = [wire for wire in WIRE_FORMATS if wire != 'msgpack' or msgpack is not None]
+    results = {"formats": {wire: measure(payload, wire, args.pages) for wire in formats}}
+
+    for wire, result in results["formats"].items():
+        print(f"{wire:>8}: {result['bytes']} bytes per page, {result['deflated_bytes']} deflated, "
+              f"{result['cpu_us_per_page']} us CPU per page")
+    if msgpack is None:
+        print("msgpack: not installed, skipped")
+    if args.json:
+        os.makedirs(os.path.dirname(os.path.abspath(args.json)), exist_ok=True)
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
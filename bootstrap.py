@@ -0,0 +1,10 @@
+"""
+Process setup every entry point imports before anything else: server.py, wsgi.py, flask run and the CLI
+"""
+import os
+
+if os.environ.get('SOCKETIO_MESSAGE_QUEUE') or os.environ.get('INVALIDATION_BUS_URL'):
+    # Слушатели очередей блокируются на сокетах: без monkey patching они остановят event loop.
+    # Патчить нужно до импорта threading, socket и pymongo, иначе останутся непропатченные ссылки
+    import eventlet
+    eventlet.monkey_patch()
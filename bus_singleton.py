@@ -0,0 +1,6 @@
+import os
+
+from invalidation_bus import create_bus
+
+# Без INVALIDATION_BUS_URL шина работает внутри одного процесса
+bus = create_bus(os.environ.get('INVALIDATION_BUS_URL'))
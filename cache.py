@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Small bounded LRU mapping with an optional per-entry time to live.
+    Safe to share between the DB worker threads
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expires_at, value = self.data[key]
+            except KeyError:
+                return default
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.data[key] = (expires_at, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def items(self) -> list:
+        """Live entries without touching their LRU position"""
+        now = time.monotonic()
+        with self.lock:
+            entries = list(self.data.items())
+        return [(key, value) for key, (expires_at, value) in entries
+                if expires_at is None or expires_at > now]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.data.clear()
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, self) is not self
+
+    def __len__(self) -> int:
+        return len(self.data)
@@ -2,12 +2,43 @@
 // CONSTANTS AND GLOBAL VARIABLES
 // ================================
 const socket = io.connect('http://localhost:5000');
+// Страницы ленты и тредов приходят с таблицей авторов; с подключённой библиотекой MessagePack — в бинарном виде
+const WIRE_FORMAT = typeof MessagePack !== 'undefined' ? 'msgpack' : 'compact';
+const AUTHOR_FIELDS = ['user_id', 'username', 'avatar_url'];
+const ITEM_LISTS = ['messages', 'comments', 'subcomments'];
 // ================================
 // SOCKET CONNECTION HANDLERS
 // ================================
+// Позиция в потоке событий сервера: после переподключения он досылает только пропущенное
+let streamEpoch = null;
+let lastSeq = null;
 socket.on('connect', () => {
     console.log('Connected to the server');
-    socket.emit('join', {room: 'room'});
+    // Вход в комнаты и открытые треды вместе с запросом пропущенных событий
+    socket.emit('resume', {
+        user_id: getCurrentUserId(),
+        message_ids: getDisplayedTweetIds(),
+        epoch: streamEpoch,
+        seq: lastSeq
+    });
+});
+socket.onAny((event, data) => {
+    if (data && typeof data.seq === 'number' && (lastSeq === null || data.seq > lastSeq)) {
+        lastSeq = data.seq;
+    }
+});
+socket.on('resumed', data => {
+    const reconnected = streamEpoch !== null;
+    if (data.epoch !== streamEpoch) {
+        lastSeq = null;
+    }
+    streamEpoch = data.epoch;
+    lastSeq = lastSeq === null ? data.seq : Math.max(lastSeq, data.seq);
+    // Пропущенное не поместилось в буфер сервера или это другой воркер: перечитываем ленту целиком,
+    // страница приносит и счётчики, и liked_ids, так что лайки отдельно не запрашиваются
+    if (reconnected && !data.complete) {
+        refreshFeed();
+    }
 });
 socket.on('new tweet', data => {
     if (!getIgnoredUsers().includes(data.user_id)) {
@@ -53,6 +84,7 @@ socket.on('delete message', data => {
     if (tweetElement) {
         tweetElement.remove();
     }
+    leaveThreads([data.message_id]);
 });
 socket.on('delete comment', data => {
     const commentElement = document.querySelector(`.comment[data-comment-id="${data.comment_id}"]`);
@@ -60,7 +92,7 @@ socket.on('delete comment', data => {
         const tweetContainer = commentElement.closest('.tweet-container');
         commentElement.parentNode.remove();
         if (tweetContainer) {
-            updateCommentCount(tweetContainer);
+            updateCommentCount(tweetContainer, -1);
         }
     }
 });
@@ -70,7 +102,7 @@ socket.on('delete subcomment', data => {
         const parentComment = subcommentElement.closest('.comment');
         subcommentElement.parentNode.remove();
         if (parentComment) {
-            updateSubcommentCount(parentComment.querySelector('.reply-button'));
+            updateSubcommentCount(parentComment.querySelector('.reply-button'), -1);
         }
     }
 });
@@ -87,13 +119,32 @@ socket.on('message likes', (data) => {
         if (likeCounter) {
             likeCounter.textContent = data.likes.total;
         }
-        if (data.likes.user_liked) {
+        // Рассылка по треду содержит только счётчик, состояние кнопки приходит лишь в личном ответе
+        if (data.likes.user_liked === true) {
             likeButton.classList.add('liked');
-        } else {
+        } else if (data.likes.user_liked === false) {
             likeButton.classList.remove('liked');
         }
     }
 });
+socket.on('likes', data => {
+    // Ответ на 'get likes' или сводка по треду за окно: счётчики пачкой
+    data.likes.forEach(like => {
+        const targetElement = getLikeTarget(like.message_id);
+        if (!targetElement) {
+            return;
+        }
+        targetElement.querySelector(".like-count").textContent = like.total;
+        // В сводке по треду личного состояния нет
+        if (typeof like.user_liked === 'boolean') {
+            targetElement.querySelector(".like-button").classList.toggle('liked', like.user_liked);
+        }
+    });
+});
+socket.on('server busy', data => {
+    // База перегружена или не ответила вовремя: запрос не выполнен, его можно повторить
+    console.warn(`Server busy on '${data.event}': ${data.message}`);
+});
 socket.on('update ignored users', data => {
     ignoredUsersList = data.map(user => user.id);
     updateIgnoredUsers(data);
@@ -106,17 +157,48 @@ window.onload = function () {
 // TWEET LOADING FUNCTIONS
 // ================================
 let offset = 0;
+let nextCursor = null;  // Курсор следующей страницы ленты, приходит с сервера
 const limit = 10;
 let loadingOlderTweets = false;
 const MAX_TWEETS_ON_PAGE = 15;
+const RELATIVE_TIME_REFRESH_MS = 30000;  // Как часто пересчитывать "N мин. назад"
 let userSentTweet = false;
 let ignoredUsersList = [];
 const refreshFeed = () => {
     offset = 0;  // Сброс смещения
+    nextCursor = null;
+    leaveThreads(getDisplayedTweetIds());
     const tweetsWrapper = document.getElementById('tweets-wrapper');
     tweetsWrapper.innerHTML = '';  // Очистка текущих твитов
     loadRecentMessages();  // Загрузка твитов с начала
 };
+const formatRelativeTime = (isoTime) => {
+    // Сервер присылает абсолютное время в ISO, подпись считается на клиенте
+    const date = new Date(isoTime);
+    if (!isoTime || isNaN(date.getTime())) {
+        return isoTime || '';  // Старый формат: уже готовая строка
+    }
+    const seconds = Math.max(0, Math.floor((Date.now() - date.getTime()) / 1000));
+    const days = Math.floor(seconds / 86400);
+    const hours = Math.floor(seconds / 3600);
+    const minutes = Math.floor(seconds / 60);
+
+    if (days > 1) {
+        return `${days} дн. назад`;
+    } else if (days === 1) {
+        return "1 день назад";
+    } else if (hours >= 1) {
+        return hours > 1 ? `${hours} ч. назад` : "1 час назад";
+    } else if (minutes >= 1) {
+        return `${minutes} мин. назад`;
+    }
+    return "только что";
+};
+const refreshRelativeTimes = () => {
+    document.querySelectorAll('[data-created-at]').forEach(element => {
+        element.textContent = formatRelativeTime(element.getAttribute('data-created-at'));
+    });
+};
 const isWrapperAtBottom = (wrapper) => {
     return wrapper.scrollTop + wrapper.clientHeight === wrapper.scrollHeight;
 };
@@ -130,14 +212,14 @@ const generateTweetHTML = (message) => {
                 </div>
                 <div class="tweet-content">${message.content}</div>
                 <div class="tweet-time-date">
-                    <span class="tweet-time">${message.created_at}</span>
+                    <span class="tweet-time" data-created-at="${message.created_at}">${formatRelativeTime(message.created_at)}</span>
                 </div>
                 <div class="tweet-actions">
                     <button class="like-button" onclick="toggleLike(this)"><i class="far fa-heart"></i></button>
-                    <span class="like-count">0</span>
+                    <span class="like-count">${message.likes || 0}</span>
                     <button class="reply-button" onclick="displayReplyForm(this)"><i class="fas fa-pencil-alt"></i></button>
                     <button class="comment-button" onclick="toggleComments(this)"><i class="far fa-comment"></i></button>
-                    <span class="comment-count">0</span>
+                    <span class="comment-count">${message.comments_count || 0}</span>
                     <button class="edit-button" onclick="editTweet(this)"><i class="far fa-edit"></i></button>
                     <button class="delete-button" onclick="confirmDelete(this)"><i class="far fa-trash-alt"></i></button>
                     <button class="blacklist-button" data-user-id="${message.user_id}" onclick="confirmBlacklist(this)"><i class="fas fa-ban"></i></button>
@@ -151,7 +233,7 @@ const generateCommentHTML = (commentData, isSubcomment = false) => {
     const subcommentButtonHTML = isSubcomment ? '' : `
         <button class="subcomment-button" onclick="toggleSubcomments(this)">
             <i class="fas fa-reply"></i>
-            <span class="subcomment-count">0</span>
+            <span class="subcomment-count">${commentData.subcomments_count || 0}</span>
         </button>
     `;
 
@@ -175,11 +257,11 @@ const generateCommentHTML = (commentData, isSubcomment = false) => {
                 ${commentData.content}
             </div>
             <div class="${commentTimeDateClassName}">
-                <span class="comment-time">${commentData.created_at}</span>
+                <span class="comment-time" data-created-at="${commentData.created_at}">${formatRelativeTime(commentData.created_at)}</span>
             </div>
             <div class="${commentActionsClassName}">
                 <button class="like-button" onclick="toggleLike(this)"><i class="far fa-heart"></i></button>
-                <span class="like-count">0</span>
+                <span class="like-count">${commentData.likes || 0}</span>
                 <button class="reply-button" onclick="displayReplyForm(this)"><i class="fas fa-pencil-alt"></i></button>
                 ${subcommentButtonHTML}
                 <button class="edit-button" onclick="editTweet(this)"><i class="far fa-edit"></i></button>
@@ -189,17 +271,34 @@ const generateCommentHTML = (commentData, isSubcomment = false) => {
         </div>
     `;
 };
+const getDisplayedTweetIds = () => {
+    return [...document.querySelectorAll('.tweet-container')].map(tweet => tweet.getAttribute('data-tweet-id'));
+};
+const joinThreads = (messageIds) => {
+    if (messageIds.length > 0) {
+        socket.emit('join threads', {message_ids: messageIds});
+    }
+};
+const leaveThreads = (messageIds) => {
+    if (messageIds.length > 0) {
+        socket.emit('leave threads', {message_ids: messageIds});
+    }
+};
 const removeExcessTweets = () => {
     const tweetsWrapper = document.getElementById('tweets-wrapper');
     const tweets = tweetsWrapper.getElementsByClassName('tweet-container');
+    const removedIds = [];
     while (tweets.length > MAX_TWEETS_ON_PAGE) {
+        removedIds.push(tweets[tweets.length - 1].getAttribute('data-tweet-id'));
         tweets[tweets.length - 1].remove(); // удаляем последний элемент
     }
+    leaveThreads(removedIds);
 };
 const loadRecentMessages = () => {
     loadingOlderTweets = true;
     const userId = getCurrentUserId();  // Получите текущий user_id
-    socket.emit('get recent messages', { offset: offset, user_id: userId });
+    // Курсор не смещается, если пока листали ленту, появились новые твиты
+    socket.emit('get recent messages', { offset: offset, cursor: nextCursor, user_id: userId, wire: WIRE_FORMAT });
     offset += limit;
 };
 const displayRecentMessages = (data) => {
@@ -207,6 +306,7 @@ const displayRecentMessages = (data) => {
     const tweetsWrapper = document.getElementById('tweets-wrapper');
 
     const wasAtBottom = isWrapperAtBottom(tweetsWrapper);
+    const newTweetIds = [];
 
     data.messages.forEach(message => {
 
@@ -224,11 +324,14 @@ const displayRecentMessages = (data) => {
                 tweetsWrapper.insertBefore(newTweetElement, tweetsWrapper.firstChild); // Новые сообщения вставляем в самом верху
             }
             addCommentsToTweet(message, newTweetElement);
+            newTweetIds.push(message.message_id);
         } else {
             addCommentsToTweet(message, existingTweet);
         }
-        requestLikesForMessage(message, "tweet");
     });
+    joinThreads(newTweetIds);
+    // Счётчики лайков приходят в самих твитах, а личное состояние — списком liked_ids
+    markLikedItems(data.liked_ids || []);
 
     if (!loadingOlderTweets) {
         removeExcessTweets();
@@ -240,8 +343,14 @@ const displayRecentMessages = (data) => {
         tweetsWrapper.scrollTop = tweetsWrapper.scrollHeight;
     }
 
+    if (loadingOlderTweets) {
+        nextCursor = data.next_cursor || null;
+    }
+
     const loadMoreBtn = document.getElementById('load-more-btn');
-    if (!data.hasMoreMessages) {
+    // Сервер присылает has_more_messages, для событий 'new tweet' флаг выставляется на клиенте
+    const hasMoreMessages = data.has_more_messages !== undefined ? data.has_more_messages : data.hasMoreMessages;
+    if (!hasMoreMessages) {
         loadMoreBtn.style.display = 'none';
     } else {
         loadMoreBtn.style.display = '';
@@ -250,6 +359,10 @@ const displayRecentMessages = (data) => {
     loadingOlderTweets = false;
 };
 const addCommentsToTweet = (message, tweetContainerElement) => {
+    if (message.comments_count !== undefined) {
+        // Счётчик — общее число комментариев с сервера, а не число загруженных
+        tweetContainerElement.querySelector('.comment-count').textContent = message.comments_count;
+    }
     if (!message.comments || !Array.isArray(message.comments)) {
         return;  // Если нет комментариев или comments не является массивом, прекращаем выполнение функции
     }
@@ -273,14 +386,18 @@ const addCommentsToTweet = (message, tweetContainerElement) => {
 
             // Добавляем сабкомментарии для каждого комментария
             addSubcommentsToComment(commentData, newCommentElement);
-            updateCommentCount(tweetContainerElement);
         }
-        requestLikesForMessage(commentData, "comment");
     });
+    // В ленте приходят только первые комментарии: остальные дочитываются по курсору
+    setMoreButton(tweetContainerElement.querySelector('.comments'), 'more-comments', message.comments_cursor,
+        'loadMoreComments(this)');
 }
 const addSubcommentsToComment = (commentData, parentComment) => {
+    if (!Array.isArray(commentData.subcomments)) {
+        return;
+    }
     commentData.subcomments.forEach(subcommentData => {
-        const existingSubcomment = parentComment.querySelector(`.comment[data-subcomment-id="${subcommentData.subcomment_id}"]`);
+        const existingSubcomment = parentComment.querySelector(`.subcomment[data-subcomment-id="${subcommentData.subcomment_id}"]`);
         if (!existingSubcomment) {
             const newSubcommentHTML = generateCommentHTML(subcommentData, true);
             const newSubcommentElement = document.createElement('div');
@@ -293,15 +410,89 @@ const addSubcommentsToComment = (commentData, parentComment) => {
                 parentComment.appendChild(subcommentsContainer);
             }
             subcommentsContainer.prepend(newSubcommentElement);
-
-            const replyButton = parentComment.querySelector('.reply-button');
-            if (replyButton) {
-                updateSubcommentCount(replyButton);
-            }
         }
-        requestLikesForMessage(subcommentData, "subcomment");
     });
+    setMoreButton(parentComment.querySelector('.subcomments'), 'more-subcomments', commentData.subcomments_cursor,
+        'loadMoreSubcomments(this)');
 }
+const setMoreButton = (container, className, cursor, onclick) => {
+    // Кнопка «ещё» стоит перед контейнером и хранит курсор следующей порции; без курсора порций больше нет
+    if (!container) return;
+    let button = container.previousElementSibling;
+    if (!button || !button.classList.contains(className)) {
+        button = null;
+    }
+    if (!cursor) {
+        if (button) button.remove();
+        return;
+    }
+    if (!button) {
+        button = document.createElement('button');
+        button.className = className;
+        button.setAttribute('onclick', onclick);
+        button.textContent = className === 'more-comments' ? 'Показать ещё комментарии' : 'Показать ещё ответы';
+        container.insertAdjacentElement('beforebegin', button);
+    }
+    button.setAttribute('data-cursor', cursor);
+};
+const loadMoreComments = (button) => {
+    const tweetContainer = button.closest('.tweet-container');
+    socket.emit('get message comments', {
+        message_id: tweetContainer.getAttribute('data-tweet-id'),
+        cursor: button.getAttribute('data-cursor'),
+        user_id: getCurrentUserId(),
+        wire: WIRE_FORMAT
+    });
+};
+const loadMoreSubcomments = (button) => {
+    const commentElement = button.parentNode.querySelector(':scope > .comment');
+    socket.emit('get subcomments', {
+        comment_id: commentElement.getAttribute('data-comment-id'),
+        cursor: button.getAttribute('data-cursor'),
+        user_id: getCurrentUserId(),
+        wire: WIRE_FORMAT
+    });
+};
+const expandItem = (item, users) => {
+    const expanded = {};
+    Object.entries(item).forEach(([key, value]) => {
+        if (key === 'user' && Number.isInteger(value)) {
+            AUTHOR_FIELDS.forEach((field, index) => { expanded[field] = users[value][index]; });
+        } else if (ITEM_LISTS.includes(key) && Array.isArray(value)) {
+            expanded[key] = value.map(child => expandItem(child, users));
+        } else {
+            expanded[key] = value;
+        }
+    });
+    return expanded;
+};
+const decodePage = (data) => {
+    // MessagePack приходит бинарным вложением, компактный JSON — объектом с таблицей users
+    if (data instanceof ArrayBuffer) {
+        data = MessagePack.decode(new Uint8Array(data));
+    }
+    if (!Array.isArray(data.users)) {
+        return data;
+    }
+    const expanded = expandItem(data, data.users);
+    delete expanded.users;
+    return expanded;
+};
+const displayMoreComments = (data) => {
+    data = decodePage(data);
+    const tweetContainer = document.querySelector(`.tweet-container[data-tweet-id="${data.message_id}"]`);
+    if (!tweetContainer) return;
+    addCommentsToTweet({comments: data.comments, comments_cursor: data.next_cursor}, tweetContainer);
+    markLikedItems(data.liked_ids || []);
+};
+const displayMoreSubcomments = (data) => {
+    data = decodePage(data);
+    const commentElement = document.querySelector(`.comment[data-comment-id="${data.comment_id}"]`);
+    if (!commentElement) return;
+    addSubcommentsToComment({subcomments: data.subcomments, subcomments_cursor: data.next_cursor},
+        commentElement.parentNode);
+    markLikedItems(data.liked_ids || []);
+};
 const displayNewComment = (data) => {
     const newCommentHTML = generateCommentHTML(data);
     const newCommentElement = document.createElement('div');
@@ -319,7 +510,7 @@ const displayNewComment = (data) => {
         newCommentsContainer.appendChild(newCommentElement);
         tweetElement.appendChild(newCommentsContainer);
     }
-    updateCommentCount(tweetElement);
+    updateCommentCount(tweetElement, 1);
 };
 const displayNewSubcomment = (data) => {
     const newSubcommentHTML = generateCommentHTML(data, true);
@@ -337,16 +528,26 @@ const displayNewSubcomment = (data) => {
     subcommentsContainer.prepend(newSubcommentElement);
 
     const replyButton = parentComment.querySelector('.reply-button');
-    updateSubcommentCount(replyButton);
+    updateSubcommentCount(replyButton, 1);
+};
+const getLikeTarget = (messageId) => {
+    return document.querySelector(`.tweet-container[data-tweet-id="${messageId}"]`)
+        || document.querySelector(`.comment[data-comment-id="${messageId}"]`)
+        || document.querySelector(`.subcomment[data-subcomment-id="${messageId}"]`);
 };
-const requestLikesForMessage = (data, messageType) => {
-    data.user_id = getCurrentUserId();
-    data.message_type = messageType;
-    data.message_id = data.message_id || data.comment_id || data.subcomment_id;
-    socket.emit('get message likes', data.user_id, data.message_id, messageType);
+const markLikedItems = (likedIds) => {
+    likedIds.forEach(messageId => {
+        const targetElement = getLikeTarget(messageId);
+        const likeButton = targetElement && targetElement.querySelector(".like-button");
+        if (likeButton) {
+            likeButton.classList.add('liked');
+        }
+    });
 };
 const initTweetLoadingEvents = () => {
-    socket.on('recent messages', displayRecentMessages);
+    socket.on('recent messages', data => displayRecentMessages(decodePage(data)));
+    socket.on('get message comments', displayMoreComments);
+    socket.on('subcomments', displayMoreSubcomments);
     document.getElementById('load-more-btn').addEventListener('click', loadRecentMessages);
 };
 // ================================
@@ -474,7 +675,7 @@ const deleteElement = (button) => {
         elementToDelete.parentNode.remove();
 
         if (tweetContainer) {
-            updateCommentCount(tweetContainer);
+            updateCommentCount(tweetContainer, -1);
         }
     } else if (elementToDelete.classList.contains('subcomment')) {
         const subcommentsContainer = elementToDelete.closest('.subcomments');
@@ -489,7 +690,7 @@ const deleteElement = (button) => {
         elementToDelete.parentNode.remove();
 
         if (parentComment) {
-            updateSubcommentCount(parentComment.querySelector('.reply-button'));
+            updateSubcommentCount(parentComment.querySelector('.reply-button'), -1);
         }
     }
 
@@ -515,7 +716,7 @@ const sendTweet = () => {
         username: username,
         avatar_url: avatarUrl,
         content: tweetContent,
-        created_at: "только что"  // Текущее время
+        created_at: new Date().toISOString()  // Текущее время
     });
 
     tweetInput.value = '';
@@ -656,7 +857,7 @@ const addComment = (button) => {
         username: username,
         avatar_url: avatarUrl,
         content: commentContent,
-        created_at: "только что"
+        created_at: new Date().toISOString()
     };
 
     switch (type) {
@@ -679,16 +880,13 @@ const addComment = (button) => {
     textarea.value = '';
     replyForm.remove();
 };
-const updateCommentCount = (tweetContainer) => {
+const updateCommentCount = (tweetContainer, delta) => {
+    // Загружена только часть треда, поэтому счётчик сдвигается на delta, а не пересчитывается по странице
     const commentCountElem = tweetContainer.querySelector('.comment-count');
     if (!commentCountElem) return;
-
-    const commentsContainer = tweetContainer.querySelector('.comments');
-    const commentCount = commentsContainer ? commentsContainer.children.length : 0;
-
-    commentCountElem.textContent = commentCount;
+    commentCountElem.textContent = Math.max(0, (parseInt(commentCountElem.textContent, 10) || 0) + delta);
 };
-const updateSubcommentCount = (replyButton) => {
+const updateSubcommentCount = (replyButton, delta) => {
     // Находим ближайший родительский комментарий
     const parentComment = replyButton.closest('.comment');
     if (!parentComment) return;
@@ -696,21 +894,7 @@ const updateSubcommentCount = (replyButton) => {
     // Находим элемент счётчика сабкомментов
     const subcommentCountElem = parentComment.querySelector('.subcomment-count');
     if (!subcommentCountElem) return;
-
-    // Находим контейнер с сабкомментариями
-    let subcommentsContainer = parentComment.nextElementSibling;
-    if (subcommentsContainer && subcommentsContainer.classList.contains('reply-form-container')) {
-        subcommentsContainer = subcommentsContainer.nextElementSibling;
-    }
-
-    // Если контейнер с сабкомментариями существует, то обновляем счётчик
-    if (subcommentsContainer && subcommentsContainer.classList.contains('subcomments')) {
-        const subcommentCount = subcommentsContainer.children.length;
-        subcommentCountElem.textContent = subcommentCount;
-    } else {
-        // Если нет сабкомментариев, устанавливаем счётчик в 0
-        subcommentCountElem.textContent = 0;
-    }
+    subcommentCountElem.textContent = Math.max(0, (parseInt(subcommentCountElem.textContent, 10) || 0) + delta);
 };
 const addToBlacklist = (button) => {
     const userId = button.dataset.userId;
@@ -810,4 +994,5 @@ const getIgnoredUsers = () => ignoredUsersList;
 document.addEventListener("DOMContentLoaded", function () {
     initTweetLoadingEvents();
     loadRecentMessages();
+    setInterval(refreshRelativeTimes, RELATIVE_TIME_REFRESH_MS);
 });
\ No newline at end of file
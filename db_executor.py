@@ -0,0 +1,115 @@
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, Optional
+
+BACKENDS = ('tpool', 'green', 'threads', 'inline')
+
+
+class DBUnavailable(Exception):
+    """The operation was not started or did not finish in time"""
+
+
+class DBTimeout(DBUnavailable):
+    pass
+
+
+class DBOverloaded(DBUnavailable):
+    pass
+
+
+class DBExecutor:
+    """
+    Runs blocking pymongo/mongoengine calls so that they do not stall the eventlet hub.
+    Backends:
+    'tpool' — eventlet's pool of OS threads, for a hub without monkey patching;
+    'green' — in the calling green thread, when eventlet.monkey_patch() already makes pymongo sockets yield;
+    'threads' — a ThreadPoolExecutor, for async_mode='threading';
+    'inline' — in the caller, with the in-flight cap only.
+    At most max_in_flight operations run at once: extra calls fail with DBOverloaded instead of queueing.
+    With the thread backends a call that times out keeps its slot until the worker finishes it
+    """
+
+    def __init__(self, backend: str = 'threads', max_workers: int = 20, max_in_flight: int = 100,
+                 timeout: Optional[float] = 5.0):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown DB executor backend: {backend}")
+        self.backend = backend
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix='db') if backend == 'threads' else None
+        if backend == 'tpool':
+            from eventlet import tpool
+            # Действует только до первого вызова tpool.execute
+            tpool.set_num_threads(max_workers)
+
+    def run(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs):
+        timeout = self.timeout if timeout is None else timeout
+        with self.lock:
+            if self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                raise DBOverloaded("Too many database operations in progress")
+            self.in_flight += 1
+        # Контекст (в том числе профиль запроса) переезжает в поток вместе с вызовом
+        call = functools.partial(contextvars.copy_context().run, self.call, fn, args, kwargs)
+        try:
+            if self.backend == 'inline':
+                return call()
+            if self.backend == 'threads':
+                try:
+                    return self.pool.submit(call).result(timeout)
+                except FutureTimeoutError:
+                    raise DBTimeout(f"Database operation timed out after {timeout} s") from None
+            from eventlet import Timeout, tpool
+            with Timeout(timeout, DBTimeout(f"Database operation timed out after {timeout} s")):
+                return tpool.execute(call) if self.backend == 'tpool' else call()
+        except DBTimeout:
+            with self.lock:
+                self.timeouts += 1
+            raise
+
+    def call(self, fn: Callable, args: tuple, kwargs: dict):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.completed += 1
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, "in_flight": self.in_flight, "completed": self.completed,
+                "timeouts": self.timeouts, "rejected": self.rejected}
+
+
+class OffloadedService:
+    """
+    Same interface as the wrapped service, but every method call goes through the executor.
+    timeouts overrides the executor timeout per method, inline lists methods that never touch the database
+    """
+
+    def __init__(self, service, executor: DBExecutor, timeouts: Optional[dict] = None, inline=()):
+        self.service = service
+        self.executor = executor
+        self.timeouts = timeouts or {}
+        self.inline = frozenset(inline)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.service, name)
+        if not callable(attribute) or name in self.inline:
+            return attribute
+        return functools.partial(self.executor.run, attribute, timeout=self.timeouts.get(name))
+
+
+def default_backend() -> str:
+    """Flask-SocketIO picks eventlet whenever it is installed; DB_EXECUTOR overrides the guess"""
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return 'threads'
+    return 'green' if patcher.is_monkey_patched('socket') else 'tpool'
@@ -0,0 +1,62 @@
+import threading
+from collections import defaultdict
+
+from event_log import replayable
+
+
+class EmitAggregator:
+    """
+    Collects like counters addressed to rooms and sends them once per window:
+    each room gets a single 'likes' event with the latest total of every target that changed.
+    window=0 sends every update immediately
+    """
+    EVENT = 'likes'
+
+    def __init__(self, socketio, window: float = 0.2, max_batch: int = 500):
+        self.socketio = socketio
+        self.window = window
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        # (комната, id цели) -> последнее значение; старые значения за окно просто перезаписываются
+        self.pending = {}
+        self.flush_scheduled = False
+        self.queued = 0
+        self.coalesced = 0
+        self.sent = 0
+
+    def add(self, room: str, target: dict) -> None:
+        key = (room, target['message_id'])
+        with self.lock:
+            self.queued += 1
+            if key in self.pending:
+                self.coalesced += 1
+            self.pending[key] = target
+            flush_now = self.window <= 0 or len(self.pending) >= self.max_batch
+            schedule = not flush_now and not self.flush_scheduled
+            if schedule:
+                self.flush_scheduled = True
+        if flush_now:
+            self.flush()
+        elif schedule:
+            self.socketio.start_background_task(self.flush_after_window)
+
+    def flush_after_window(self) -> None:
+        self.socketio.sleep(self.window)
+        self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flush_scheduled = False
+
+        by_room = defaultdict(list)
+        for (room, _), target in pending.items():
+            by_room[room].append(target)
+        for room, targets in by_room.items():
+            self.socketio.emit(self.EVENT, replayable({"likes": targets}), room=room)
+        with self.lock:
+            self.sent += len(by_room)
+
+    def stats(self) -> dict:
+        return {"queued": self.queued, "coalesced": self.coalesced, "sent": self.sent,
+                "pending": len(self.pending)}
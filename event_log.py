@@ -0,0 +1,98 @@
+import itertools
+import threading
+import uuid
+from collections import deque
+from typing import Optional
+
+import socketio
+
+# Поле номера в полезной нагрузке события; None просит журнал присвоить номер при доставке
+SEQ = 'seq'
+
+
+def replayable(data: dict) -> dict:
+    """Copy of a broadcast payload that the event log of the delivering worker numbers and keeps for 'resume'"""
+    return dict(data, **{SEQ: None})
+
+
+class EventLog:
+    """
+    The last size broadcasts this worker delivered, numbered 1, 2, 3... in delivery order.
+    A client that reconnects sends the epoch and the last number it saw, and gets only what it missed.
+    Numbers are per worker: epoch changes with every process, so a client that lands on another worker
+    or returns after a restart, as well as one that missed more than the log holds, reloads the feed instead
+    """
+
+    def __init__(self, size: int = 1000):
+        self.size = size
+        self.epoch = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.seq = 0
+        # (номер, комнаты, событие, полезная нагрузка с номером), номера идут подряд
+        self.events = deque(maxlen=size)
+        self.resumes = 0
+        self.replayed = 0
+        self.reloads = 0
+
+    def stamp(self, room, event: str, data):
+        if not isinstance(data, dict) or data.get(SEQ, 0) is not None:
+            return data
+        rooms = tuple(room) if isinstance(room, (list, tuple)) else (room,)
+        with self.lock:
+            self.seq += 1
+            stamped = dict(data, **{SEQ: self.seq})
+            self.events.append((self.seq, rooms, event, stamped))
+        return stamped
+
+    def since(self, epoch: Optional[str], seq, rooms) -> Optional[list]:
+        """
+        (event, data) delivered to any of rooms after seq, oldest first.
+        None when they cannot be replayed: another epoch, or the oldest of them has already left the log.
+        A first connect has no epoch yet: it gets None too, but is counted neither as a resume nor as a reload
+        """
+        if epoch is None:
+            return None
+        rooms = set(rooms)
+        with self.lock:
+            self.resumes += 1
+            oldest = self.events[0][0] if self.events else self.seq + 1
+            if epoch != self.epoch or not isinstance(seq, int) or not oldest - 1 <= seq <= self.seq:
+                self.reloads += 1
+                return None
+            # Номера идут подряд, так что пропущенное начинается с известной позиции
+            missed = [(event, data) for _, targets, event, data
+                      in itertools.islice(self.events, seq + 1 - oldest, None) if not rooms.isdisjoint(targets)]
+            self.replayed += len(missed)
+        return missed
+
+    def position(self) -> dict:
+        return {"epoch": self.epoch, SEQ: self.seq}
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"seq": self.seq, "size": len(self.events), "resumes": self.resumes,
+                    "replayed": self.replayed, "reloads": self.reloads}
+
+
+def record_broadcasts(server, log: EventLog) -> None:
+    """
+    Numbers replayable broadcasts as this worker delivers them.
+    With a message queue every worker delivers the events it receives from the queue to its own clients,
+    so each one numbers them in its own order; without a queue delivery happens in manager.emit
+    """
+    manager = server.manager
+    if isinstance(manager, socketio.PubSubManager):
+        handle_emit = manager._handle_emit
+
+        def handle_emit_logged(message):
+            return handle_emit(dict(message, data=log.stamp(message.get('room'), message.get('event'),
+                                                            message.get('data'))))
+
+        manager._handle_emit = handle_emit_logged
+    else:
+        emit = manager.emit
+
+        def emit_logged(event, data, namespace, room=None, **kwargs):
+            return emit(event, log.stamp(room, event, data), namespace, room=room, **kwargs)
+
+        manager.emit = emit_logged
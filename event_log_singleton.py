@@ -0,0 +1,6 @@
+import os
+
+from event_log import EventLog
+
+# Сколько последних широковещательных событий воркер помнит для 'resume'
+event_log = EventLog(size=int(os.environ.get('EVENT_LOG_SIZE', 1000)))
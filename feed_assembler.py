@@ -0,0 +1,181 @@
+from collections import defaultdict
+from typing import Optional
+
+from models import Comment, SubComment
+from message_manager import MessageManager
+from pagination import encode_cursor
+
+# Служебные ключи узла дерева с исходной датой создания и ObjectId автора, наружу не отдаются
+CREATED_AT = '_created_at'
+AUTHOR_ID = '_author_id'
+# Сколько комментариев под твитом и ответов под комментарием приходит вместе с лентой
+TOP_COMMENTS = 3
+TOP_SUBCOMMENTS = 3
+# Поля, которые лента читает из базы: документы приходят словарями as_pymongo() только с ними
+MESSAGE_FIELDS = ('user', 'content', 'created_at', 'likes_count', 'comments_count', 'subcomments_count')
+COMMENT_FIELDS = ('user', 'message', 'content', 'created_at', 'likes_count', 'subcomments_count')
+SUBCOMMENT_FIELDS = ('user', 'parent_comment', 'content', 'created_at', 'likes_count')
+
+
+class FeedAssembler:
+    """
+    Собирает страницу ленты за фиксированное число запросов:
+    комментарии, сабкомментарии и авторы подгружаются пачками через $in,
+    а дерево собирается в памяти.
+    Под каждым твитом только первые top_comments комментариев, под комментарием — первые
+    top_subcomments ответов; остальное клиент дочитывает по курсору, так что страница
+    не растёт вместе с самым длинным обсуждением.
+    Твиты, комментарии и ответы — «сырые» документы as_pymongo() (словари с _id), а не Document:
+    на странице их сотни, и построение Document стоило бы больше, чем сами запросы
+    """
+
+    def __init__(self, user_cache, top_comments: int = TOP_COMMENTS, top_subcomments: int = TOP_SUBCOMMENTS):
+        self.user_cache = user_cache
+        self.top_comments = top_comments
+        self.top_subcomments = top_subcomments
+
+    def assemble(self, messages: list) -> list:
+        return [self.render(node) for node in self.build(messages)]
+
+    def build(self, messages: list) -> list:
+        """Дерево ленты с исходными датами: его можно хранить в кэше и отрисовывать позже"""
+        comments_by_message = self.first_children(Comment, 'message', COMMENT_FIELDS, messages, self.top_comments)
+        comments = [comment for loaded in comments_by_message.values() for comment in loaded[:self.top_comments]]
+        subcomments_by_comment = self.first_children(SubComment, 'parent_comment', SUBCOMMENT_FIELDS, comments,
+                                                     self.top_subcomments)
+        subcomments = [subcomment for loaded in subcomments_by_comment.values()
+                       for subcomment in loaded[:self.top_subcomments]]
+
+        authors = self.load_authors(messages + comments + subcomments)
+
+        nodes = []
+        for message in messages:
+            loaded = comments_by_message[message['_id']]
+            comment_nodes = [self.comment_tree(comment, subcomments_by_comment[comment['_id']], authors)
+                             for comment in loaded[:self.top_comments]]
+            nodes.append(self.message_node(message, self.author_of(message, authors), comment_nodes,
+                                           self.cursor_after(loaded, self.top_comments)))
+        return nodes
+
+    def build_comments(self, comments: list) -> list:
+        """Узлы страницы комментариев треда, каждый с первыми ответами"""
+        subcomments_by_comment = self.first_children(SubComment, 'parent_comment', SUBCOMMENT_FIELDS, comments,
+                                                     self.top_subcomments)
+        subcomments = [subcomment for loaded in subcomments_by_comment.values()
+                       for subcomment in loaded[:self.top_subcomments]]
+        authors = self.load_authors(comments + subcomments)
+        return [self.comment_tree(comment, subcomments_by_comment[comment['_id']], authors) for comment in comments]
+
+    def build_subcomments(self, subcomments: list) -> list:
+        authors = self.load_authors(subcomments)
+        return [self.subcomment_node(subcomment, self.author_of(subcomment, authors)) for subcomment in subcomments]
+
+    def comment_tree(self, comment, loaded: list, authors: dict) -> dict:
+        subcomment_nodes = [self.subcomment_node(subcomment, self.author_of(subcomment, authors))
+                            for subcomment in loaded[:self.top_subcomments]]
+        return self.comment_node(comment, self.author_of(comment, authors), subcomment_nodes,
+                                 self.cursor_after(loaded, self.top_subcomments))
+
+    @staticmethod
+    def first_children(model, parent_field: str, fields: tuple, parents: list, limit: int) -> dict:
+        """
+        Id родителя -> его первые дочерние документы в порядке (created_at, _id), не больше limit + 1:
+        лишний показывает, что есть продолжение.
+        Один aggregate на уровень при любом числе длинных тредов: $in по родителям, сортировка по индексу
+        (parent, created_at, _id), $group с $push и $slice до limit + 1
+        """
+        children = defaultdict(list)
+        parent_ids = [parent['_id'] for parent in parents]
+        if not parent_ids:
+            return children
+        pipeline = [
+            {'$match': {parent_field: {'$in': parent_ids}}},
+            {'$sort': {'created_at': 1, '_id': 1}},
+            {'$project': {field: 1 for field in fields}},
+            {'$group': {'_id': '$' + parent_field, 'children': {'$push': '$$ROOT'}}},
+            {'$project': {'children': {'$slice': ['$children', limit + 1]}}},
+        ]
+        for group in model._get_collection().aggregate(pipeline):
+            children[group['_id']] = group['children']
+        return children
+
+    @staticmethod
+    def cursor_after(loaded: list, limit: int) -> Optional[str]:
+        """Курсор продолжения треда, если в нём больше limit элементов"""
+        if len(loaded) <= limit or not limit:
+            return None
+        last = loaded[limit - 1]
+        return encode_cursor(last['created_at'], last['_id'])
+
+    @staticmethod
+    def message_node(message: dict, author, comments=(), comments_cursor: Optional[str] = None) -> dict:
+        node = MessageManager.message_row_to_dict(message, author)
+        node['comments'] = list(comments)
+        node['comments_count'] = message.get('comments_count') or 0
+        # Курсор следующей порции комментариев; None — показаны все
+        node['comments_cursor'] = comments_cursor
+        node[CREATED_AT] = message.get('created_at')
+        node[AUTHOR_ID] = author.id if author is not None else None
+        return node
+
+    @staticmethod
+    def comment_node(comment: dict, author, subcomments=(), subcomments_cursor: Optional[str] = None) -> dict:
+        node = MessageManager.comment_row_to_dict(comment, author)
+        node['subcomments'] = list(subcomments)
+        node['subcomments_count'] = comment.get('subcomments_count') or 0
+        node['subcomments_cursor'] = subcomments_cursor
+        node[CREATED_AT] = comment.get('created_at')
+        node[AUTHOR_ID] = author.id if author is not None else None
+        return node
+
+    @staticmethod
+    def subcomment_node(subcomment: dict, author) -> dict:
+        node = MessageManager.subcomment_row_to_dict(subcomment, author)
+        node[CREATED_AT] = subcomment.get('created_at')
+        node[AUTHOR_ID] = author.id if author is not None else None
+        return node
+
+    @staticmethod
+    def render(node: dict, relative_times: bool = False, ignored_ids: frozenset = frozenset()) -> dict:
+        """
+        Копия узла для клиента без служебных ключей.
+        relative_times добавляет устаревшее поле created_ago для клиентов, не умеющих считать время сами.
+        Комментарии и ответы авторов из ignored_ids (ObjectId) пропускаются: проверка по множеству
+        стоит одинаково при любой длине списка игнорируемых
+        """
+        rendered = {}
+        hidden = {}
+        for key, value in node.items():
+            if key in (CREATED_AT, AUTHOR_ID):
+                continue
+            if isinstance(value, list):
+                children = FeedAssembler.visible(value, ignored_ids)
+                hidden[key] = len(value) - len(children)
+                value = [FeedAssembler.render(child, relative_times, ignored_ids) for child in children]
+            rendered[key] = value
+            if key == 'created_at' and relative_times:
+                created_at = node.get(CREATED_AT)
+                rendered['created_ago'] = MessageManager.human_readable_time_difference(
+                    created_at) if created_at else None
+        for key, count in hidden.items():
+            if count and key + '_count' in rendered:
+                rendered[key + '_count'] -= count
+        return rendered
+
+    @staticmethod
+    def visible(nodes: list, ignored_ids: frozenset) -> list:
+        if not ignored_ids:
+            return nodes
+        return [node for node in nodes if node.get(AUTHOR_ID) not in ignored_ids]
+
+    def load_authors(self, rows: list) -> dict:
+        user_ids = {row['user'] for row in rows if row.get('user') is not None}
+        if not user_ids:
+            return {}
+        return self.user_cache.get_many_by_ids(user_ids)
+
+    @staticmethod
+    def author_of(row: dict, authors: dict):
+        if row.get('user') is None:
+            return None
+        return authors.get(row['user'])
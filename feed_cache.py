@@ -0,0 +1,232 @@
+import copy
+import threading
+from typing import Optional
+
+from cache import LRUCache
+from feed_assembler import FeedAssembler, CREATED_AT, TOP_COMMENTS, TOP_SUBCOMMENTS
+from pagination import encode_cursor
+
+
+class FeedCache:
+    """
+    First pages of the feed keyed by limit. One page serves every reader: authors a reader ignores
+    are left out when the page is rendered for them.
+    Feed events patch the cached pages in place. A handler returns True when it cannot
+    patch a page, and that page alone is rebuilt on the next read. The TTL only limits
+    how long a lost event can go unnoticed
+    """
+
+    def __init__(self, maxsize: int = 1000, ttl: float = 60, top_comments: int = TOP_COMMENTS,
+                 top_subcomments: int = TOP_SUBCOMMENTS):
+        self.pages = LRUCache(maxsize=maxsize, ttl=ttl)
+        # Должны совпадать с FeedAssembler, который собирает страницы
+        self.top_comments = top_comments
+        self.top_subcomments = top_subcomments
+        self.lock = threading.RLock()
+        # Растёт с каждым событием: страница, собранная до события, в кэш не попадёт
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, limit: int, relative_times: bool = False, ignored_ids: frozenset = frozenset()) -> Optional[dict]:
+        """
+        The returned page is shared between callers until the next event touches it
+        and must not be modified
+        """
+        with self.lock:
+            page = self.pages.get(limit)
+            if page is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if relative_times or ignored_ids:
+                return self.render(page, relative_times, ignored_ids)
+            # Без относительного времени страница не зависит от момента запроса
+            if page.get('rendered') is None:
+                page['rendered'] = self.render(page)
+            return page['rendered']
+
+    def store(self, limit: int, nodes: list, has_more: bool, version: int) -> None:
+        with self.lock:
+            if version != self.version:
+                return
+            self.pages.set(limit, {
+                'limit': limit,
+                'messages': nodes,
+                'has_more_messages': has_more,
+            })
+
+    @staticmethod
+    def render(page: dict, relative_times: bool = False, ignored_ids: frozenset = frozenset()) -> dict:
+        """The cursor points after the last tweet of the page even if the reader does not see it"""
+        messages = page['messages']
+        has_more = page['has_more_messages'] and bool(messages)
+        return {
+            "messages": [FeedAssembler.render(node, relative_times, ignored_ids)
+                         for node in FeedAssembler.visible(messages, ignored_ids)],
+            "has_more_messages": has_more,
+            "next_cursor": encode_cursor(messages[-1][CREATED_AT], messages[-1]['message_id'])
+            if has_more else None
+        }
+
+    def apply(self, event: dict) -> None:
+        handler = getattr(self, 'on_' + event['op'])
+        with self.lock:
+            self.version += 1
+            for key, page in self.pages.items():
+                page['rendered'] = None
+                if handler(page, event):
+                    self.pages.pop(key)
+
+    def forget_author(self, forum_id: int) -> None:
+        """Drops the pages showing anything written by the user, e.g. after a rename"""
+        user_id = str(forum_id)
+        with self.lock:
+            self.version += 1
+            for key, page in self.pages.items():
+                if any(node['user_id'] == user_id for node in self.walk(page['messages'])):
+                    self.pages.pop(key)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.version += 1
+            self.pages.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self.pages), "hits": self.hits, "misses": self.misses}
+
+    @staticmethod
+    def walk(messages: list):
+        for message in messages:
+            yield message
+            for comment in message['comments']:
+                yield comment
+                yield from comment['subcomments']
+
+    @staticmethod
+    def find(nodes: list, key: str, node_id: str) -> Optional[dict]:
+        for node in nodes:
+            if node[key] == node_id:
+                return node
+        return None
+
+    def find_comment(self, page: dict, event: dict) -> Optional[dict]:
+        message = self.find(page['messages'], 'message_id', event['message_id'])
+        return self.find(message['comments'], 'comment_id', event['comment_id']) if message else None
+
+    @staticmethod
+    def sort_key(node: dict) -> tuple:
+        # Тот же порядок, что и в запросе ленты: (-created_at, -_id); hex ObjectId сравнивается как строка
+        return node[CREATED_AT], node['message_id']
+
+    def on_message_created(self, page: dict, event: dict):
+        messages = page['messages']
+        node = event['node']
+        if self.find(messages, 'message_id', node['message_id']):
+            # Страницу собрали уже после сохранения твита, а событие пришло позже
+            return
+        position = 0
+        while position < len(messages) and self.sort_key(messages[position]) > self.sort_key(node):
+            position += 1
+        if position == len(messages) and page['has_more_messages']:
+            # Старше последнего твита страницы — попадёт только на следующие страницы
+            return
+        messages.insert(position, copy.deepcopy(node))
+        if len(messages) > page['limit']:
+            messages.pop()
+            page['has_more_messages'] = True
+
+    def on_message_updated(self, page: dict, event: dict):
+        message = self.find(page['messages'], 'message_id', event['message_id'])
+        if message:
+            message['content'] = event['content']
+
+    def on_message_deleted(self, page: dict, event: dict):
+        message = self.find(page['messages'], 'message_id', event['message_id'])
+        if message is None:
+            return
+        if page['has_more_messages']:
+            # Освободившееся место занял бы твит со следующей страницы, которого в кэше нет
+            return True
+        page['messages'].remove(message)
+
+    def add_child(self, parent: dict, key: str, node: dict, limit: int, count: Optional[int]) -> None:
+        """
+        Новый комментарий или ответ попадает в конец треда: он виден на странице,
+        только если тред показан целиком и в нём ещё есть место, иначе растут счётчик и курсор.
+        count — счётчик из базы после вставки: повторное или запоздалое событие не увеличит его ещё раз
+        """
+        child_key = key[:-1] + '_id'
+        parent[key + '_count'] = count if count is not None else parent[key + '_count'] + 1
+        shown = parent[key]
+        if self.find(shown, child_key, node[child_key]):
+            return
+        if parent[key + '_cursor'] is None and len(shown) < limit:
+            shown.append(copy.deepcopy(node))
+        elif parent[key + '_cursor'] is None and shown:
+            last = shown[-1]
+            parent[key + '_cursor'] = encode_cursor(last[CREATED_AT], last[child_key])
+
+    @staticmethod
+    def remove_child(parent: dict, key: str, child: Optional[dict]):
+        parent[key + '_count'] -= 1
+        if child is None:
+            if parent[key + '_count'] <= len(parent[key]):
+                # Скрытых элементов не осталось — кнопка «ещё» больше не нужна
+                parent[key + '_cursor'] = None
+            return
+        if parent[key + '_cursor'] is not None:
+            # На место удалённого встал бы первый скрытый элемент, которого на странице нет
+            return True
+        parent[key].remove(child)
+
+    def on_comment_created(self, page: dict, event: dict):
+        message = self.find(page['messages'], 'message_id', event['message_id'])
+        if message:
+            self.add_child(message, 'comments', event['node'], self.top_comments, event.get('comments_count'))
+
+    def on_comment_updated(self, page: dict, event: dict):
+        comment = self.find_comment(page, event)
+        if comment:
+            comment['content'] = event['content']
+
+    def on_comment_deleted(self, page: dict, event: dict):
+        message = self.find(page['messages'], 'message_id', event['message_id'])
+        if message:
+            message['subcomments'] -= event['subcomments']
+            return self.remove_child(message, 'comments',
+                                     self.find(message['comments'], 'comment_id', event['comment_id']))
+
+    def on_subcomment_created(self, page: dict, event: dict):
+        message = self.find(page['messages'], 'message_id', event['message_id'])
+        if message is None:
+            return
+        total = event.get('thread_subcomments')
+        message['subcomments'] = total if total is not None else message['subcomments'] + 1
+        comment = self.find(message['comments'], 'comment_id', event['comment_id'])
+        if comment:
+            self.add_child(comment, 'subcomments', event['node'], self.top_subcomments,
+                           event.get('subcomments_count'))
+
+    def on_subcomment_updated(self, page: dict, event: dict):
+        comment = self.find_comment(page, event)
+        subcomment = self.find(comment['subcomments'], 'subcomment_id', event['subcomment_id']) if comment else None
+        if subcomment:
+            subcomment['content'] = event['content']
+
+    def on_subcomment_deleted(self, page: dict, event: dict):
+        message = self.find(page['messages'], 'message_id', event['message_id'])
+        if message is None:
+            return
+        message['subcomments'] -= 1
+        comment = self.find(message['comments'], 'comment_id', event['comment_id'])
+        if comment:
+            return self.remove_child(comment, 'subcomments',
+                                     self.find(comment['subcomments'], 'subcomment_id', event['subcomment_id']))
+
+    def on_liked(self, page: dict, event: dict):
+        key = {'tweet': 'message_id', 'comment': 'comment_id', 'subcomment': 'subcomment_id'}[event['message_type']]
+        for node in self.walk(page['messages']):
+            if node.get(key) == event['message_id']:
+                node['likes'] = event['likes']
+                return
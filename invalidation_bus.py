@@ -0,0 +1,184 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from typing import Callable, Optional
+
+import socketio
+from pymongo import MongoClient, CursorType, ReturnDocument
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# Каналы шины: полезная нагрузка — ключ, который нужно сбросить из кэша
+USERS_CHANNEL = 'users'
+# События ленты: каждый воркер правит свои закэшированные страницы
+FEED_CHANNEL = 'feed'
+# Размер capped-коллекций очередей в байтах. Слушатель, отставший больше чем на этот объём, теряет сообщения
+CAPPED_QUEUE_BYTES = int(os.environ.get('CAPPED_QUEUE_BYTES', 256 * 1024 * 1024))
+
+
+class InMemoryBus:
+    """
+    Bus for a single process. Buses sharing one hub behave like separate workers
+    connected to the same queue, which is what the tests rely on
+    """
+
+    def __init__(self, hub: Optional[list] = None):
+        self.hub = hub if hub is not None else []
+        self.hub.append(self)
+        self.handlers = defaultdict(list)
+
+    def subscribe(self, channel: str, handler: Callable) -> None:
+        self.handlers[channel].append(handler)
+
+    def publish(self, channel: str, payload) -> None:
+        for bus in self.hub:
+            bus.deliver(channel, payload)
+
+    def deliver(self, channel: str, payload) -> None:
+        for handler in self.handlers[channel]:
+            try:
+                handler(payload)
+            except Exception:
+                logger.exception("Invalidation handler failed on channel %s", channel)
+
+
+class CappedCollection:
+    """
+    Pub/sub over a MongoDB capped collection: writers insert, readers follow a tailable cursor.
+    Every document gets seq from a shared counter, so a reader that starts or loses its cursor asks the server
+    for what follows its position instead of reading the whole collection from the beginning.
+    The size applies when the collection is created; an existing one keeps its size
+    """
+    RETRY_INTERVAL = 0.5
+    # Номер выдаётся до вставки, так что документы разных воркеров могут лечь не по порядку номеров:
+    # курсор возобновляется чуть раньше своей позиции, а уже прочитанные номера пропускаются
+    RESUME_OVERLAP = 100
+
+    def __init__(self, url: str, name: str, size: Optional[int] = None):
+        self.client = MongoClient(url)
+        self.db = self.client.get_default_database('mybb_twitter')
+        self.name = name
+        self.size = size or CAPPED_QUEUE_BYTES
+        # Сколько раз слушатель отстал настолько, что непрочитанное вытеснили новые записи
+        self.overruns = 0
+
+    def collection(self):
+        try:
+            self.db.create_collection(self.name, capped=True, size=self.size)
+        except CollectionInvalid:
+            # Коллекция уже создана другим воркером
+            pass
+        return self.db[self.name]
+
+    def next_seq(self) -> int:
+        counter = self.db['queue_sequences'].find_one_and_update(
+            {'_id': self.name}, {'$inc': {'seq': 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+        return counter['seq']
+
+    def publish(self, document: dict) -> None:
+        self.db[self.name].insert_one(dict(document, seq=self.next_seq()))
+
+    def listen(self):
+        collection = self.collection()
+        # История до старта воркера не нужна: начинаем после последнего документа
+        newest = collection.find_one(sort=[('$natural', -1)])
+        start = last_seq = newest.get('seq') if newest else None
+        seen = deque(maxlen=2 * self.RESUME_OVERLAP)
+        while True:
+            try:
+                oldest = collection.find_one(sort=[('$natural', 1)])
+                # Документ, следующий за прочитанным, уже вытеснен: пропущенное не вернуть
+                if last_seq is not None and oldest is not None and (oldest.get('seq') or 0) > last_seq + 1:
+                    self.overruns += 1
+                    logger.warning("Listener on %s fell behind a full capped collection of %s bytes, "
+                                   "messages were lost", self.name, self.size)
+                # Фильтр по seq отбрасывает старые документы на сервере; порядок чтения — $natural
+                query = {} if last_seq is None else {'seq': {'$gt': last_seq - self.RESUME_OVERLAP}}
+                cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    for document in cursor:
+                        seq = document.get('seq')
+                        # Без номера — документ прошлой версии, записанный до старта воркера
+                        if seq is None or seq in seen or (start is not None and seq <= start):
+                            continue
+                        seen.append(seq)
+                        last_seq = seq if last_seq is None else max(last_seq, seq)
+                        yield document
+            except PyMongoError:
+                logger.exception("Lost tailable cursor on %s", self.name)
+            # Курсор по пустой коллекции сразу закрывается — ждём первых записей
+            time.sleep(self.RETRY_INTERVAL)
+
+
+class MongoBus:
+    """
+    Bus shared by every worker connected to the same database.
+    Local handlers run synchronously on publish, other workers receive the message from the capped collection
+    """
+
+    def __init__(self, url: str, collection: str = 'invalidations'):
+        self.transport = CappedCollection(url, collection)
+        self.origin = uuid.uuid4().hex
+        self.local = InMemoryBus()
+        self.thread = None
+
+    def subscribe(self, channel: str, handler: Callable) -> None:
+        self.local.subscribe(channel, handler)
+        self.start()
+
+    def publish(self, channel: str, payload) -> None:
+        # Свой воркер сбрасывает кэш сразу, не дожидаясь круга через базу
+        self.local.publish(channel, payload)
+        self.transport.publish({'origin': self.origin, 'channel': channel, 'payload': payload})
+
+    def start(self) -> None:
+        if self.thread is None:
+            # Под eventlet.monkey_patch() это зелёный поток
+            self.thread = threading.Thread(target=self.listen, daemon=True)
+            self.thread.start()
+
+    def listen(self) -> None:
+        for document in self.transport.listen():
+            if document.get('origin') != self.origin:
+                self.local.deliver(document['channel'], document['payload'])
+
+
+class MongoManager(socketio.PubSubManager):
+    """
+    Socket.IO client manager that relays emits between workers through a capped collection
+    """
+    name = 'mongo'
+
+    def __init__(self, url: str, channel: str = 'flask-socketio', write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.transport = CappedCollection(url, 'socketio_queue')
+
+    def _publish(self, data):
+        self.transport.publish({'channel': self.channel, 'message': data})
+
+    def _listen(self):
+        for document in self.transport.listen():
+            if document.get('channel') == self.channel:
+                yield document['message']
+
+
+def create_bus(url: Optional[str] = None):
+    if not url:
+        return InMemoryBus()
+    if url.startswith(('mongodb://', 'mongodb+srv://')):
+        return MongoBus(url)
+    raise ValueError(f"Unsupported invalidation bus URL: {url}")
+
+
+def socketio_queue_options(url: Optional[str] = None) -> dict:
+    """Keyword arguments for SocketIO.init_app that share emits between workers"""
+    if not url:
+        return {}
+    if url.startswith(('mongodb://', 'mongodb+srv://')):
+        return {'client_manager': MongoManager(url)}
+    # redis://, kafka://, amqp:// — штатные очереди Flask-SocketIO
+    return {'message_queue': url}
@@ -0,0 +1,74 @@
+from collections import defaultdict
+
+from pymongo import UpdateOne
+
+from cache import LRUCache
+from models import User
+
+# Порядок рейтинга; под него в User объявлен составной индекс
+ORDER = ('-messages_count', '-comments_count', '-likes_received')
+FIELDS = ('forum_id', 'username', 'avatar_url', 'messages_count', 'comments_count', 'likes_received')
+
+
+class Leaderboard:
+    """
+    Top users by messages written, comments and replies written, and likes received.
+    The counters live on User and the write paths change them with $inc,
+    so the top is one index-backed query with a limit, cached for ttl seconds.
+    repair_counters() rebuilds them from the source collections
+    """
+
+    def __init__(self, size: int = 10, ttl: float = 30):
+        self.size = size
+        self.cache = LRUCache(maxsize=1, ttl=ttl)
+
+    def top(self) -> list:
+        top = self.cache.get('top')
+        if top is None:
+            top = [self.entry(row) for row in
+                   User.objects.order_by(*ORDER).only(*FIELDS).limit(self.size).as_pymongo()]
+            self.cache.set('top', top)
+        return top
+
+    @staticmethod
+    def entry(row: dict) -> dict:
+        return {
+            "id": row.get('forum_id'),
+            "username": row.get('username'),
+            "avatar_url": row.get('avatar_url'),
+            "messages": row.get('messages_count', 0),
+            "comments": row.get('comments_count', 0),
+            "likes": row.get('likes_received', 0),
+        }
+
+    def add(self, user_id, messages: int = 0, comments: int = 0, likes: int = 0) -> None:
+        self.add_many({user_id: (messages, comments, likes)})
+
+    @staticmethod
+    def add_many(changes: dict) -> None:
+        """changes: ObjectId пользователя -> (сообщения, комментарии, лайки); одна пачка на всех"""
+        operations = []
+        for user_id, (messages, comments, likes) in changes.items():
+            increments = {field: value for field, value in (('messages_count', messages),
+                                                            ('comments_count', comments),
+                                                            ('likes_received', likes)) if value}
+            if user_id is not None and increments:
+                operations.append(UpdateOne({'_id': user_id}, {'$inc': increments}))
+        if operations:
+            User._get_collection().bulk_write(operations, ordered=False)
+
+    def removed(self, messages=(), comments=()) -> None:
+        """
+        Authors of deleted tweets and comments (rows with 'user' and 'likes_count')
+        lose them together with the likes they had received
+        """
+        changes = defaultdict(lambda: [0, 0, 0])
+        for rows, column in ((messages, 0), (comments, 1)):
+            for row in rows:
+                change = changes[row.get('user')]
+                change[column] -= 1
+                change[2] -= row.get('likes_count', 0)
+        self.add_many(changes)
+
+    def clear(self) -> None:
+        self.cache.clear()
@@ -0,0 +1,151 @@
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, Optional
+
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+class LikeWriter:
+    """
+    Write-behind queue of like/unlike intents.
+    Intents are keyed by (type, target id, user id), so the last click wins, and are written
+    once per interval: one bulk_write of upserts/deletes into the like collection,
+    then one bulk_write of likes_count increments per target collection.
+    Until then intent() and delta() let readers see their own writes
+    """
+
+    def __init__(self, models: dict, like_model, interval: float = 0.1, max_batch: int = 1000,
+                 on_flush: Optional[Callable] = None):
+        self.models = models
+        self.like_model = like_model
+        self.interval = interval
+        self.max_batch = max_batch
+        self.on_flush = on_flush
+        self.lock = threading.Lock()
+        # ключ -> [намерение, состояние в базе на момент первого клика]
+        self.pending = {}
+        # Пачка, которая сейчас пишется: видна читателям, пока bulk_write не завершится
+        self.inflight = {}
+        self.timer = None
+        self.queued = 0
+        self.coalesced = 0
+        self.written = 0
+        self.skipped = 0
+
+    def intent(self, message_type: str, message_id, user_id) -> Optional[bool]:
+        key = (message_type, message_id, user_id)
+        with self.lock:
+            entry = self.pending.get(key) or self.inflight.get(key)
+            return entry[0] if entry else None
+
+    def delta(self, message_type: str, message_id) -> int:
+        """Сколько лайков цель получит (или потеряет) после записи очереди"""
+        with self.lock:
+            return sum(liked - stored
+                       for entries in (self.inflight, self.pending)
+                       for (entry_type, entry_id, _), (liked, stored) in entries.items()
+                       if entry_type == message_type and entry_id == message_id)
+
+    def submit(self, message_type: str, message_id, user_id, liked: bool, stored: bool) -> None:
+        key = (message_type, message_id, user_id)
+        with self.lock:
+            self.queued += 1
+            if key in self.pending:
+                self.coalesced += 1
+                self.pending[key][0] = liked
+            else:
+                # Если предыдущий клик ещё пишется, отсчитываем от его результата
+                inflight = self.inflight.get(key)
+                self.pending[key] = [liked, inflight[0] if inflight else stored]
+            flush_now = self.interval <= 0 or len(self.pending) >= self.max_batch
+            if not flush_now and self.timer is None:
+                # Отдельный поток, а не задача event loop: bulk_write не должен останавливать хаб eventlet,
+                # и submit можно вызывать из потоков DBExecutor
+                self.timer = threading.Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if flush_now:
+            self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.inflight.update(batch)
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        operations = []
+        # (тип, id) -> на сколько изменится счётчик лайков цели
+        targets = defaultdict(int)
+        skipped = 0
+        now = datetime.utcnow()
+        for (message_type, message_id, user_id), (liked, stored) in batch.items():
+            if liked == stored:
+                # Лайк и отмена в одном окне: писать нечего
+                skipped += 1
+                continue
+            key = {'target_type': message_type, 'target_id': message_id, 'user': user_id}
+            if liked:
+                operations.append(UpdateOne(key, {'$setOnInsert': {'value': 1, 'created_at': now}}, upsert=True))
+            else:
+                operations.append(DeleteOne(key))
+            targets[(message_type, message_id)] += 1 if liked else -1
+
+        try:
+            if operations:
+                targets = self.write(operations, targets)
+        except Exception:
+            logger.exception("Failed to write %d like operations", len(operations))
+            targets = {}
+        finally:
+            with self.lock:
+                for key in batch:
+                    if self.inflight.get(key) is batch[key]:
+                        del self.inflight[key]
+                self.written += len(operations)
+                self.skipped += skipped
+
+        if targets and self.on_flush is not None:
+            self.on_flush(dict(targets))
+
+    def write(self, operations: list, targets: dict) -> dict:
+        """Пишет лайки и переносит итог в likes_count целей; возвращает фактические изменения счётчиков"""
+        inserts = sum(isinstance(operation, UpdateOne) for operation in operations)
+        try:
+            result = self.like_model._get_collection().bulk_write(operations, ordered=False)
+            written = (result.upserted_count, result.deleted_count)
+        except BulkWriteError as error:
+            # Например, тот же лайк одновременно вставил другой воркер
+            written = (error.details.get('nUpserted'), error.details.get('nRemoved'))
+        if written == (inserts, len(operations) - inserts):
+            # Каждая операция изменила ровно один лайк: счётчики сдвигаются на ожидаемые значения
+            by_type = defaultdict(list)
+            for (message_type, message_id), change in targets.items():
+                if change:
+                    by_type[message_type].append(UpdateOne({'_id': message_id}, {'$inc': {'likes_count': change}}))
+            for message_type, updates in by_type.items():
+                self.models[message_type]._get_collection().bulk_write(updates, ordered=False)
+            return targets
+        return self.recount(targets)
+
+    def recount(self, targets: dict) -> dict:
+        """Кто-то успел раньше: счётчики затронутых целей пересчитываются по коллекции лайков"""
+        likes = self.like_model._get_collection()
+        changes = {}
+        for message_type, message_id in targets:
+            total = likes.count_documents({'target_type': message_type, 'target_id': message_id})
+            before = self.models[message_type]._get_collection().find_one_and_update(
+                {'_id': message_id}, {'$set': {'likes_count': total}}, projection={'likes_count': 1})
+            if before is not None and before.get('likes_count', 0) != total:
+                changes[(message_type, message_id)] = total - before.get('likes_count', 0)
+        return changes
+
+    def stats(self) -> dict:
+        return {"queued": self.queued, "coalesced": self.coalesced, "written": self.written,
+                "skipped": self.skipped, "pending": len(self.pending)}
@@ -0,0 +1,128 @@
+from collections import Counter
+
+from pymongo import UpdateOne
+
+from models import User, Message, Comment, SubComment, Like
+
+BATCH_SIZE = 1000
+
+
+def write_in_batches(collection, operations, counted: str = 'modified_count') -> int:
+    written = 0
+    batch = []
+    for operation in operations:
+        batch.append(operation)
+        if len(batch) >= BATCH_SIZE:
+            written += getattr(collection.bulk_write(batch, ordered=False), counted)
+            batch = []
+    if batch:
+        written += getattr(collection.bulk_write(batch, ordered=False), counted)
+    return written
+
+
+def count_likes(message_type: str) -> Counter:
+    """Id цели -> число лайков в коллекции лайков"""
+    pipeline = [{"$match": {"target_type": message_type}},
+                {"$group": {"_id": "$target_id", "count": {"$sum": 1}}}]
+    return Counter({row['_id']: row['count'] for row in Like._get_collection().aggregate(pipeline)})
+
+
+def count_by_author(model, likes: Counter) -> dict:
+    """Id автора -> (число документов, полученные ими лайки)"""
+    authors = {}
+    for row in model._get_collection().find({}, {"user": 1}):
+        count, received = authors.get(row.get('user'), (0, 0))
+        authors[row.get('user')] = (count + 1, received + likes.get(row['_id'], 0))
+    return authors
+
+
+def migrate_likes() -> dict:
+    """
+    Переносит лайки из массивов likes внутри Message/Comment/SubComment в коллекцию лайков,
+    затем удаляет массивы и пересчитывает счётчики. Повторный запуск ничего не дублирует
+    """
+    likes = Like._get_collection()
+    migrated = {}
+    for message_type, model in (('tweet', Message), ('comment', Comment), ('subcomment', SubComment)):
+        collection = model._get_collection()
+        documents = collection.find({"likes": {"$exists": True}}, {"likes": 1})
+        upserts = (
+            UpdateOne({"target_type": message_type, "target_id": row['_id'], "user": like['user']},
+                      {"$setOnInsert": {"value": like.get('value', 1), "created_at": row['_id'].generation_time}},
+                      upsert=True)
+            for row in documents
+            for like in row.get('likes') or ()
+            if like.get('user') is not None
+        )
+        migrated[message_type] = write_in_batches(likes, upserts, counted='upserted_count')
+        collection.update_many({"likes": {"$exists": True}}, {"$unset": {"likes": ""}})
+    migrated['counters'] = repair_counters()
+    return migrated
+
+
+def repair_counters() -> dict:
+    """
+    Пересчитывает денормализованные счётчики Message/Comment/SubComment и счётчики рейтинга User
+    по исходным коллекциям
+    """
+    comment_to_message = {
+        row['_id']: row.get('message')
+        for row in Comment._get_collection().find({}, {"message": 1})
+    }
+
+    subcomments_per_comment = Counter(
+        row.get('parent_comment')
+        for row in SubComment._get_collection().find({}, {"parent_comment": 1})
+    )
+
+    comments_per_message = Counter(comment_to_message.values())
+    subcomments_per_message = Counter()
+    for comment_id, count in subcomments_per_comment.items():
+        message_id = comment_to_message.get(comment_id)
+        if message_id is not None:
+            subcomments_per_message[message_id] += count
+
+    message_likes = count_likes('tweet')
+    comment_likes = count_likes('comment')
+    subcomment_likes = count_likes('subcomment')
+
+    messages_by_author = count_by_author(Message, message_likes)
+    comments_by_author = Counter()
+    likes_by_author = Counter()
+    for model, target_likes in ((Comment, comment_likes), (SubComment, subcomment_likes)):
+        for author_id, (count, likes) in count_by_author(model, target_likes).items():
+            comments_by_author[author_id] += count
+            likes_by_author[author_id] += likes
+    for author_id, (_, likes) in messages_by_author.items():
+        likes_by_author[author_id] += likes
+
+    updated = {
+        'messages': write_in_batches(Message._get_collection(), (
+            UpdateOne({"_id": message_id}, {"$set": {
+                "likes_count": message_likes.get(message_id, 0),
+                "comments_count": comments_per_message.get(message_id, 0),
+                "subcomments_count": subcomments_per_message.get(message_id, 0),
+            }})
+            for message_id in (row['_id'] for row in Message._get_collection().find({}, {"_id": 1}))
+        )),
+        'comments': write_in_batches(Comment._get_collection(), (
+            UpdateOne({"_id": comment_id}, {"$set": {
+                "likes_count": comment_likes.get(comment_id, 0),
+                "subcomments_count": subcomments_per_comment.get(comment_id, 0),
+            }})
+            for comment_id in comment_to_message
+        )),
+        'subcomments': write_in_batches(SubComment._get_collection(), (
+            UpdateOne({"_id": row['_id']}, {"$set": {"likes_count": subcomment_likes.get(row['_id'], 0)}})
+            for row in SubComment._get_collection().find({}, {"_id": 1})
+        )),
+        'users': write_in_batches(User._get_collection(), (
+            UpdateOne({"_id": row['_id']}, {"$set": {
+                "messages_count": messages_by_author.get(row['_id'], (0, 0))[0],
+                "comments_count": comments_by_author.get(row['_id'], 0),
+                "likes_received": likes_by_author.get(row['_id'], 0),
+            }})
+            for row in User._get_collection().find({}, {"_id": 1})
+        )),
+    }
+    return updated
@@ -1,5 +1,7 @@
 from datetime import datetime, timezone
-from models import Comment, SubComment
+
+# Маркер: автор не передан, берём его из ReferenceField документа
+_FROM_DOCUMENT = object()
 
 
 class MessageManager:
@@ -28,6 +30,15 @@ class MessageManager:
         else:
             return "только что"
 
+    @staticmethod
+    def iso_time(dt):
+        """Абсолютное время в UTC: относительное клиент считает сам"""
+        if dt is None:
+            return None
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.astimezone(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
     @staticmethod
     def user_to_dict(user):
         return {
@@ -37,57 +48,100 @@ class MessageManager:
         }
 
     @staticmethod
-    def message_to_dict(message):
-        comments_pipeline = [
-            {"$match": {"message": message.id}},
-            {"$group": {"_id": "$message", "count": {"$sum": 1}}}
-        ]
-        comments_data = list(Comment.objects.aggregate(*comments_pipeline))
-        comments_count = comments_data[0]['count'] if comments_data else 0
-
-        subcomments_pipeline = [
-            {"$match": {
-                "parent_comment": {"$in": [comment.id for comment in Comment.objects(message=message.id)]}}},
-            {"$group": {"_id": None, "count": {"$sum": 1}}}
-        ]
-        subcomments_data = list(SubComment.objects.aggregate(*subcomments_pipeline))
-        subcomments_count = subcomments_data[0]['count'] if subcomments_data else 0
+    def author_to_dict(author):
+        return {
+            'user_id': str(author.forum_id) if author else None,
+            'username': author.username if author else None,
+            'avatar_url': author.avatar_url if author else None,
+        }
+
+    @staticmethod
+    def message_to_dict(message, author=_FROM_DOCUMENT):
+        if author is _FROM_DOCUMENT:
+            author = message.user
 
+        author_data = MessageManager.author_to_dict(author)
         return {
-            'user_id': str(message.user.forum_id) if message.user else None,
+            'user_id': author_data['user_id'],
             'message_id': str(message.id),
             'content': message.content,
-            'created_at': MessageManager.human_readable_time_difference(
-                message.created_at) if message.created_at else None,
-            'username': message.user.username if message.user else None,
-            'avatar_url': message.user.avatar_url if message.user else None,  # Add avatar_url here
-            'likes': len(message.likes),
-            'comments': comments_count,
-            'subcomments': subcomments_count
+            'created_at': MessageManager.iso_time(message.created_at),
+            'username': author_data['username'],
+            'avatar_url': author_data['avatar_url'],
+            'likes': message.likes_count,
+            'comments': message.comments_count,
+            'subcomments': message.subcomments_count
         }
 
     @staticmethod
-    def comment_to_dict(comment):
+    def comment_to_dict(comment, author=_FROM_DOCUMENT):
+        if author is _FROM_DOCUMENT:
+            author = comment.user
+        author_data = MessageManager.author_to_dict(author)
         return {
-            'user_id': str(comment.user.forum_id) if comment.user else None,
+            'user_id': author_data['user_id'],
             'comment_id': str(comment.id),
             'content': comment.content,
-            'created_at': MessageManager.human_readable_time_difference(
-                comment.created_at) if comment.created_at else None,
-            'username': comment.user.username if comment.user else None,
-            'avatar_url': comment.user.avatar_url if comment.user else None,
-            'likes': len(comment.likes),
+            'created_at': MessageManager.iso_time(comment.created_at),
+            'username': author_data['username'],
+            'avatar_url': author_data['avatar_url'],
+            'likes': comment.likes_count,
         }
 
     @staticmethod
-    def subcomment_to_dict(subcomment):
+    def subcomment_to_dict(subcomment, author=_FROM_DOCUMENT):
+        if author is _FROM_DOCUMENT:
+            author = subcomment.user
+        author_data = MessageManager.author_to_dict(author)
         return {
-            'user_id': str(subcomment.user.forum_id) if subcomment.user else None,
+            'user_id': author_data['user_id'],
             'subcomment_id': str(subcomment.id),
             'content': subcomment.content,
-            'created_at': MessageManager.human_readable_time_difference(
-                subcomment.created_at) if subcomment.created_at else None,
-            'username': subcomment.user.username if subcomment.user else None,
-            'avatar_url': subcomment.user.avatar_url if subcomment.user else None,
-            'likes': len(subcomment.likes),
+            'created_at': MessageManager.iso_time(subcomment.created_at),
+            'username': author_data['username'],
+            'avatar_url': author_data['avatar_url'],
+            'likes': subcomment.likes_count,
+        }
+
+    # Те же словари из «сырых» документов as_pymongo(): без построения Document на каждый элемент ленты.
+    # Пропущенные в документе поля заменяются значениями по умолчанию из моделей
+    @staticmethod
+    def message_row_to_dict(row: dict, author) -> dict:
+        author_data = MessageManager.author_to_dict(author)
+        return {
+            'user_id': author_data['user_id'],
+            'message_id': str(row['_id']),
+            'content': row.get('content'),
+            'created_at': MessageManager.iso_time(row.get('created_at')),
+            'username': author_data['username'],
+            'avatar_url': author_data['avatar_url'],
+            'likes': row.get('likes_count', 0),
+            'comments': row.get('comments_count', 0),
+            'subcomments': row.get('subcomments_count', 0)
+        }
+
+    @staticmethod
+    def comment_row_to_dict(row: dict, author) -> dict:
+        author_data = MessageManager.author_to_dict(author)
+        return {
+            'user_id': author_data['user_id'],
+            'comment_id': str(row['_id']),
+            'content': row.get('content'),
+            'created_at': MessageManager.iso_time(row.get('created_at')),
+            'username': author_data['username'],
+            'avatar_url': author_data['avatar_url'],
+            'likes': row.get('likes_count', 0),
+        }
+
+    @staticmethod
+    def subcomment_row_to_dict(row: dict, author) -> dict:
+        author_data = MessageManager.author_to_dict(author)
+        return {
+            'user_id': author_data['user_id'],
+            'subcomment_id': str(row['_id']),
+            'content': row.get('content'),
+            'created_at': MessageManager.iso_time(row.get('created_at')),
+            'username': author_data['username'],
+            'avatar_url': author_data['avatar_url'],
+            'likes': row.get('likes_count', 0),
         }
@@ -0,0 +1,233 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+from typing import Callable
+
+from pymongo import monitoring
+from socketio import packet
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    """
+    Base of the lock-free metrics: every OS thread writes to its own shard, render() adds the shards up.
+    Green threads of one OS thread share a shard, which is safe because eventlet
+    never switches them in the middle of an update
+    """
+    TYPE = None
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # id потока ОС -> {значения меток: значение}; get_native_id не подменяется monkey_patch
+        self.shards = {}
+
+    def shard(self) -> dict:
+        thread_id = threading.get_native_id()
+        shard = self.shards.get(thread_id)
+        if shard is None:
+            shard = self.shards.setdefault(thread_id, self.new_shard())
+        return shard
+
+    def new_shard(self) -> dict:
+        return defaultdict(float)
+
+    def merged(self) -> dict:
+        merged = defaultdict(float)
+        for shard in list(self.shards.values()):
+            for labels, value in list(shard.items()):
+                merged[labels] += value
+        return merged
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        for labels, value in sorted(self.merged().items()):
+            lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.shard()[labels] += amount
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_shard(self) -> dict:
+        # Для каждой комбинации меток: счётчики по корзинам, затем +Inf, сумма и количество
+        return defaultdict(lambda: [0] * (len(self.buckets) + 1) + [0.0, 0])
+
+    def observe(self, *labels, value: float) -> None:
+        counts = self.shard()[labels]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def merged(self) -> dict:
+        merged = {}
+        for shard in list(self.shards.values()):
+            for labels, counts in list(shard.items()):
+                total = merged.setdefault(labels, [0] * len(counts))
+                for index, count in enumerate(counts):
+                    total[index] += count
+        return merged
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        for labels, counts in sorted(self.merged().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == '+Inf' else f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(counts[-2])}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {counts[-1]}')
+        return lines
+
+    def timed(self, handler: Callable, *labels):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                self.observe(*labels, value=time.perf_counter() - started)
+        wrapper.__name__ = getattr(handler, '__name__', 'handler')
+        wrapper.__wrapped__ = handler
+        return wrapper
+
+
+class Gauge:
+    """
+    Value read at scrape time: callback returns {label values: value}.
+    metric_type='counter' exports totals that other components already count, e.g. cache hits
+    """
+
+    def __init__(self, name: str, help: str, callback: Callable, labelnames: tuple = (), metric_type: str = 'gauge'):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+        self.metric_type = metric_type
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.metric_type}']
+        for labels, value in sorted(self.callback().items()):
+            lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        return self.add(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name: str, help: str, callback: Callable, labelnames: tuple = (),
+              metric_type: str = 'gauge') -> Gauge:
+        return self.add(Gauge(name, help, callback, labelnames, metric_type))
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Counts every MongoDB command and the time it took, by command name"""
+
+    def __init__(self, commands: Counter, seconds: Counter):
+        self.commands = commands
+        self.seconds = seconds
+
+    def started(self, event) -> None:
+        pass
+
+    def succeeded(self, event) -> None:
+        self.commands.inc(event.command_name, 'ok')
+        self.seconds.inc(event.command_name, amount=event.duration_micros / 1e6)
+
+    def failed(self, event) -> None:
+        self.commands.inc(event.command_name, 'failed')
+        self.seconds.inc(event.command_name, amount=event.duration_micros / 1e6)
+
+
+def instrument_emits(server, emits: Counter, emitted_bytes: Counter) -> None:
+    """
+    Counts packets and bytes sent to clients per event name.
+    python-socketio encodes the event packet once per recipient, so room fan-out is counted in full;
+    the size is taken from that encoding instead of serializing the payload again
+    """
+    base = server.packet_class
+
+    class MeasuredPacket(base):
+        def encode(self):
+            encoded = super().encode()
+            # Входящие пакеты только декодируются, подтверждения (ACK) событиями не считаются
+            if self.packet_type in (packet.EVENT, packet.BINARY_EVENT) and self.data:
+                event = self.data[0]
+                emits.inc(event)
+                emitted_bytes.inc(event, amount=packet_size(encoded))
+            return encoded
+
+    server.packet_class = MeasuredPacket
+
+
+def packet_size(encoded) -> int:
+    # Пакет с бинарными данными (MessagePack) кодируется в текстовый заголовок и вложения
+    if isinstance(encoded, list):
+        return sum(len(part) for part in encoded)
+    return len(encoded)
+
+
+def room_stats(server, namespace: str = '/') -> dict:
+    """
+    Connected clients and room membership by kind of room ('room', 'user', 'thread').
+    Per-room series would grow with every thread, so rooms are aggregated
+    """
+    rooms = dict(server.manager.rooms.get(namespace, {})) if server is not None else {}
+    connected = rooms.pop(None, {})
+    kinds = defaultdict(lambda: {"rooms": 0, "members": 0, "max_members": 0})
+    for room, members in rooms.items():
+        if room in connected:
+            # Личная комната каждого сокета — это просто его sid
+            continue
+        stats = kinds[room.split(':', 1)[0]]
+        stats["rooms"] += 1
+        stats["members"] += len(members)
+        stats["max_members"] = max(stats["max_members"], len(members))
+    return {"connected": len(connected), "kinds": dict(kinds)}
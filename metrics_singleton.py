@@ -0,0 +1,18 @@
+from pymongo import monitoring
+
+from metrics import Registry, CommandMetrics
+
+registry = Registry()
+socket_event_seconds = registry.histogram('socketio_event_duration_seconds', 'Socket.IO event handler latency',
+                                          ('event',))
+http_request_seconds = registry.histogram('http_request_duration_seconds', 'HTTP route latency',
+                                          ('method', 'route', 'status'))
+socket_emits = registry.counter('socketio_emits_total', 'Packets sent to clients by event name', ('event',))
+socket_emit_bytes = registry.counter('socketio_emit_bytes_total', 'Payload bytes sent to clients by event name',
+                                     ('event',))
+db_commands = registry.counter('mongodb_commands_total', 'MongoDB commands by name and outcome',
+                               ('command', 'outcome'))
+db_command_seconds = registry.counter('mongodb_command_seconds_total', 'Time spent in MongoDB commands',
+                                      ('command',))
+# Слушатель должен быть зарегистрирован до создания MongoClient
+monitoring.register(CommandMetrics(db_commands, db_command_seconds))
@@ -1,8 +1,9 @@
+import threading
 from datetime import datetime
 
 from flask_mongoengine import MongoEngine
 from mongoengine import StringField, IntField, DateTimeField, ListField, ReferenceField, CASCADE, BooleanField, \
-    EmbeddedDocument, EmbeddedDocumentField
+    ObjectIdField
 
 db = MongoEngine()
 
@@ -18,14 +19,17 @@ class User(db.Document):
     comment = StringField()
     ignored_users = ListField(ReferenceField('self'))
     banned = BooleanField(default=False)
+    # Счётчики рейтинга, см. Leaderboard
+    messages_count = IntField(default=0)
+    comments_count = IntField(default=0)
+    likes_received = IntField(default=0)
 
-
-class Like(EmbeddedDocument):
-    """
-    Like db class
-    """
-    user = ReferenceField(User)
-    value = IntField()  # 1 for like
+    meta = {
+        'auto_create_index': False,
+        'indexes': [
+            ('-messages_count', '-comments_count', '-likes_received'),
+        ]
+    }
 
 
 class Message(db.Document):
@@ -35,7 +39,20 @@ class Message(db.Document):
     user = ReferenceField(User, reverse_delete_rule=CASCADE)
     content = StringField()
     created_at = DateTimeField(default=datetime.utcnow)
-    likes = ListField(EmbeddedDocumentField(Like))
+    # Денормализованные счётчики, обновляются через $inc в UserService
+    likes_count = IntField(default=0)
+    comments_count = IntField(default=0)
+    subcomments_count = IntField(default=0)
+
+    meta = {
+        'auto_create_index': False,
+        # Встроенные массивы likes из старых версий игнорируются, пока их не перенесёт migrate-likes
+        'strict': False,
+        'indexes': [
+            ('-created_at', '-id'),  # лента, в том числе keyset-пагинация
+            ('user', '-created_at'),  # сообщения пользователя, каскад при удалении пользователя
+        ]
+    }
 
 
 class Comment(db.Document):
@@ -43,10 +60,21 @@ class Comment(db.Document):
     Comment db class
     """
     user = ReferenceField(User, reverse_delete_rule=CASCADE)
-    message = ReferenceField(Message, reverse_delete_rule=CASCADE)
+    # Без reverse_delete_rule: комментарии удалённого твита вычищает PurgeWorker
+    message = ReferenceField(Message)
     content = StringField()
     created_at = DateTimeField(default=datetime.utcnow)
-    likes = ListField(EmbeddedDocumentField(Like))
+    likes_count = IntField(default=0)
+    subcomments_count = IntField(default=0)
+
+    meta = {
+        'auto_create_index': False,
+        'strict': False,
+        'indexes': [
+            ('message', 'created_at', 'id'),  # комментарии твита по порядку, каскад при удалении твита
+            'user',
+        ]
+    }
 
 
 class SubComment(db.Document):
@@ -54,10 +82,38 @@ class SubComment(db.Document):
     SubComment db class
     """
     user = ReferenceField(User, reverse_delete_rule=CASCADE)
-    parent_comment = ReferenceField(Comment, reverse_delete_rule=CASCADE)
+    parent_comment = ReferenceField(Comment)
     content = StringField()
     created_at = DateTimeField(default=datetime.utcnow)
-    likes = ListField(EmbeddedDocumentField(Like))
+    likes_count = IntField(default=0)
+
+    meta = {
+        'auto_create_index': False,
+        'strict': False,
+        'indexes': [
+            ('parent_comment', 'created_at', 'id'),
+            'user',
+        ]
+    }
+
+
+class Like(db.Document):
+    """
+    Like db class: one document per (target, user), the target keeps only likes_count
+    """
+    target_type = StringField(required=True)  # 'tweet', 'comment' или 'subcomment'
+    target_id = ObjectIdField(required=True)
+    user = ReferenceField(User, required=True)
+    value = IntField(default=1)  # 1 for like
+    created_at = DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'auto_create_index': False,
+        'indexes': [
+            # Лайкнул ли пользователь, лайки страницы, каскад при удалении цели; уникальность — защита от двойного клика
+            {'fields': ('target_type', 'target_id', 'user'), 'unique': True},
+        ]
+    }
 
 
 class Report(db.Document):
@@ -65,11 +121,35 @@ class Report(db.Document):
     Report db class
     """
     user = ReferenceField(User, reverse_delete_rule=CASCADE)
-    message = ReferenceField(Message, reverse_delete_rule=CASCADE)
-    comment = ReferenceField(Comment, reverse_delete_rule=CASCADE)
+    message = ReferenceField(Message)
+    comment = ReferenceField(Comment)
     reason = StringField()
     created_at = DateTimeField(default=datetime.utcnow)
 
+    meta = {
+        'auto_create_index': False,
+        'indexes': ['message', 'comment', 'user']
+    }
+
+
+class Purge(db.Document):
+    """
+    Purge db class: tombstone of a deleted tweet or comment whose dependents are not removed yet, see PurgeWorker
+    """
+    target_type = StringField(required=True)  # 'tweet' или 'comment'
+    target_id = ObjectIdField(required=True)
+    created_at = DateTimeField(default=datetime.utcnow)
+    leased_until = DateTimeField()  # до этого времени надгробие обрабатывает один из воркеров
+    removed = IntField(default=0)  # сколько зависимых документов уже удалено
+
+    meta = {
+        'auto_create_index': False,
+        'indexes': [
+            {'fields': ('target_type', 'target_id'), 'unique': True},
+            'created_at',
+        ]
+    }
+
 
 class Notification(db.Document):
     """
@@ -79,3 +159,38 @@ class Notification(db.Document):
     text = StringField()
     read = BooleanField(default=False)
     created_at = DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'auto_create_index': False,
+        'indexes': [('user', 'read', '-created_at')]
+    }
+
+
+INDEXED_DOCUMENTS = [User, Message, Comment, SubComment, Like, Report, Purge, Notification]
+
+
+# Индексы этого процесса уже построены: ensure_indexes_once больше не обращается к базе
+indexes_lock = threading.Lock()
+indexes_ready = False
+
+
+def ensure_indexes() -> None:
+    """
+    Creates every index declared in meta; indexes are not built lazily on first access
+    """
+    global indexes_ready
+    for document in INDEXED_DOCUMENTS:
+        document.ensure_indexes()
+    indexes_ready = True
+
+
+def ensure_indexes_once() -> None:
+    """
+    Creates the indexes before the first request a process serves, however it was started
+    (python server.py, wsgi.py or a WSGI server importing the app); later calls only check a flag
+    """
+    if indexes_ready:
+        return
+    with indexes_lock:
+        if not indexes_ready:
+            ensure_indexes()
@@ -0,0 +1,39 @@
+import base64
+import binascii
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from mongoengine.queryset.visitor import Q
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_cursor(created_at: datetime, document_id) -> str:
+    """
+    Opaque keyset cursor pointing at (created_at, _id) of the last item of a page
+    """
+    milliseconds = (created_at.replace(tzinfo=None) - EPOCH) // timedelta(milliseconds=1)
+    raw = f"{milliseconds}:{document_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, ObjectId]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        milliseconds, document_id = raw.split(':')
+        return EPOCH + timedelta(milliseconds=int(milliseconds)), ObjectId(document_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError, InvalidId):
+        raise ValueError("Invalid cursor")
+
+
+def older_than(cursor: str) -> Q:
+    """Filter for items strictly after the cursor in (-created_at, -_id) order"""
+    created_at, document_id = decode_cursor(cursor)
+    return Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=document_id)
+
+
+def newer_than(cursor: str) -> Q:
+    """Filter for items strictly after the cursor in (created_at, _id) order, e.g. comments of a thread"""
+    created_at, document_id = decode_cursor(cursor)
+    return Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=document_id)
@@ -0,0 +1,12 @@
+import os
+
+from pymongo import monitoring
+
+from query_profiler import QueryProfiler
+
+# Бюджеты на один обработчик: всё, что выше, попадает в лог; 0 отключает проверку
+profiler = QueryProfiler(max_queries=int(os.environ.get('PROFILER_MAX_QUERIES', 20)) or None,
+                         max_ms=int(os.environ.get('PROFILER_MAX_MS', 500)) or None)
+# Слушатель должен быть зарегистрирован до создания MongoClient
+monitoring.register(profiler)
+profiler.instrument_dereferences()
@@ -0,0 +1,169 @@
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from mongoengine.queryset.visitor import Q
+
+from models import Message, Comment, SubComment, Like, Report, Purge
+
+logger = logging.getLogger(__name__)
+
+
+class PurgeWorker:
+    """
+    Removes what a deleted tweet or comment leaves behind: comments, subcomments, reports and likes.
+    Deleting writes a tombstone and removes the document itself; the dependents are removed here
+    with delete_many in batches of batch_size, in a background thread, so no request waits for a big thread.
+    Tombstones live in the database: one left by a stopped worker is picked up by the next drain(),
+    and a lease keeps two workers off the same tombstone.
+    on_removed(comments=rows) gets the removed comments and subcomments with their authors and likes_count
+    """
+
+    def __init__(self, batch_size: int = 500, pause: float = 0.0, lease: float = 60.0, background: bool = True,
+                 on_removed: Optional[Callable] = None):
+        self.batch_size = batch_size
+        self.pause = pause
+        self.lease = lease
+        self.background = background
+        self.on_removed = on_removed
+        self.lock = threading.Lock()
+        self.thread = None
+        # Повтор после неудачного прохода, когда истечёт аренда упавшего надгробия
+        self.retry = None
+        # Появились надгробия, которые текущий проход потока мог не увидеть
+        self.dirty = False
+        self.removed = Counter()
+        self.batches = 0
+        self.completed = 0
+        self.failures = 0
+
+    def queue(self, target_type: str, target_id) -> None:
+        Purge.objects(target_type=target_type, target_id=target_id).update_one(
+            upsert=True, set_on_insert__created_at=datetime.utcnow())
+        if self.background:
+            self.wake()
+        else:
+            self.drain()
+
+    def wake(self) -> None:
+        with self.lock:
+            self.dirty = True
+            if self.thread is None:
+                # Поток, а не задача event loop, по той же причине, что и у LikeWriter
+                self.thread = threading.Thread(target=self.run, name='purge', daemon=True)
+                self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            with self.lock:
+                if not self.dirty:
+                    self.thread = None
+                    return
+                self.dirty = False
+            self.drain()
+
+    def drain(self) -> int:
+        """Purges every tombstone that no other worker holds; returns how many were finished"""
+        finished = 0
+        while True:
+            tombstone = self.claim()
+            if tombstone is None:
+                return finished
+            try:
+                self.purge(tombstone)
+            except Exception:
+                with self.lock:
+                    self.failures += 1
+                logger.exception("Failed to purge %s %s", tombstone.target_type, tombstone.target_id)
+                self.schedule_retry()
+                return finished
+            finished += 1
+
+    def schedule_retry(self) -> None:
+        """Новый проход, когда истечёт аренда: без него надгробие ждало бы следующего удаления"""
+        with self.lock:
+            if self.retry is not None and self.retry.is_alive():
+                return
+            self.retry = threading.Timer(self.lease, self.wake if self.background else self.drain)
+            self.retry.daemon = True
+            self.retry.start()
+
+    def claim(self) -> Optional[Purge]:
+        now = datetime.utcnow()
+        return Purge.objects(Q(leased_until=None) | Q(leased_until__lt=now)).order_by('created_at') \
+            .modify(new=True, set__leased_until=now + timedelta(seconds=self.lease))
+
+    def purge(self, tombstone: Purge) -> None:
+        target_id = tombstone.target_id
+        if tombstone.target_type == 'tweet':
+            while True:
+                comments = self.batch(Comment, message=target_id)
+                if not comments:
+                    break
+                # Сначала ответы: комментарий, удалённый раньше них, в следующий проход уже не найдётся
+                self.purge_replies(tombstone, [comment['_id'] for comment in comments])
+                self.remove(tombstone, Comment, 'comment', comments)
+            Report._get_collection().delete_many({'message': target_id})
+            # Документ уже удалён, если воркер не остановился между надгробием и удалением
+            Message._get_collection().delete_one({'_id': target_id})
+        else:
+            self.purge_replies(tombstone, [target_id])
+            Report._get_collection().delete_many({'comment': target_id})
+            Comment._get_collection().delete_one({'_id': target_id})
+        Like._get_collection().delete_many({'target_type': tombstone.target_type, 'target_id': target_id})
+        tombstone.delete()
+        with self.lock:
+            self.completed += 1
+
+    def purge_replies(self, tombstone: Purge, comment_ids: list) -> None:
+        while True:
+            replies = self.batch(SubComment, parent_comment__in=comment_ids)
+            if not replies:
+                return
+            self.remove(tombstone, SubComment, 'subcomment', replies)
+
+    def batch(self, model, **query) -> list:
+        return list(model.objects(**query).only('user', 'likes_count').limit(self.batch_size).as_pymongo())
+
+    def remove(self, tombstone: Purge, model, message_type: str, rows: list) -> None:
+        ids = [row['_id'] for row in rows]
+        Like._get_collection().delete_many({'target_type': message_type, 'target_id': {'$in': ids}})
+        if message_type == 'comment':
+            Report._get_collection().delete_many({'comment': {'$in': ids}})
+        model._get_collection().delete_many({'_id': {'$in': ids}})
+        # Прогресс заодно продлевает аренду
+        Purge.objects(id=tombstone.id).update_one(
+            inc__removed=len(ids), set__leased_until=datetime.utcnow() + timedelta(seconds=self.lease))
+        with self.lock:
+            self.removed[model._get_collection_name()] += len(ids)
+            self.batches += 1
+        if self.on_removed is not None:
+            self.on_removed(comments=rows)
+        if self.pause:
+            # Уступаем базу запросам пользователей между пачками
+            time.sleep(self.pause)
+
+    @staticmethod
+    def pending(targets: list) -> bool:
+        """Лежит ли надгробие хотя бы на одной из целей (тип, id)"""
+        if not targets:
+            return False
+        query = Q()
+        for target_type, target_id in targets:
+            query |= Q(target_type=target_type, target_id=target_id)
+        return Purge.objects(query).limit(1).count(with_limit_and_skip=True) > 0
+
+    @staticmethod
+    def progress() -> list:
+        return [{"target_type": row['target_type'], "target_id": str(row['target_id']),
+                 "removed": row.get('removed', 0), "created_at": row['created_at'].isoformat(),
+                 "leased_until": row['leased_until'].isoformat() if row.get('leased_until') else None}
+                for row in Purge.objects.order_by('created_at').as_pymongo()]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"removed": dict(self.removed), "batches": self.batches, "completed": self.completed,
+                    "failures": self.failures, "running": self.thread is not None}
@@ -0,0 +1,194 @@
+import contextvars
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Optional
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# Служебные команды драйвера, которые запросами не считаются
+IGNORED_COMMANDS = frozenset(('hello', 'ismaster', 'isMaster', 'ping', 'buildInfo', 'saslStart', 'saslContinue',
+                              'authenticate', 'getnonce', 'endSessions'))
+
+# Профиль текущего обработчика; DBExecutor переносит его в свои потоки вместе с контекстом
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+
+class RequestProfile:
+    """What one socket event or HTTP request cost the database"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.queries = 0
+        self.db_time = 0.0
+        self.documents = 0
+        self.dereferences = 0
+        self.started = time.perf_counter()
+        self.elapsed = None
+
+    def as_dict(self) -> dict:
+        return {"name": self.name, "queries": self.queries, "db_ms": round(self.db_time * 1000, 3),
+                "documents": self.documents, "dereferences": self.dereferences,
+                "elapsed_ms": round(self.elapsed * 1000, 3) if self.elapsed is not None else None}
+
+
+class QueryProfiler(monitoring.CommandListener):
+    """
+    pymongo command listener that charges every command to the handler that caused it.
+    Handlers over max_queries or max_ms are logged; stats() aggregates the profiles per handler
+    """
+
+    def __init__(self, max_queries: Optional[int] = 20, max_ms: Optional[float] = 500):
+        self.max_queries = max_queries
+        self.max_ms = max_ms
+        self.lock = threading.Lock()
+        self.handlers = {}
+
+    # Интерфейс CommandListener: вызывается в потоке, который выполняет команду
+    def started(self, event) -> None:
+        profile = current_profile.get()
+        if profile is not None and event.command_name not in IGNORED_COMMANDS:
+            profile.queries += 1
+
+    def succeeded(self, event) -> None:
+        profile = current_profile.get()
+        if profile is None or event.command_name in IGNORED_COMMANDS:
+            return
+        profile.db_time += event.duration_micros / 1e6
+        profile.documents += self.returned_documents(event.reply)
+
+    def failed(self, event) -> None:
+        profile = current_profile.get()
+        if profile is not None and event.command_name not in IGNORED_COMMANDS:
+            profile.db_time += event.duration_micros / 1e6
+
+    @staticmethod
+    def returned_documents(reply) -> int:
+        cursor = reply.get('cursor')
+        if cursor:
+            return len(cursor.get('firstBatch') or cursor.get('nextBatch') or ())
+        # findAndModify
+        return 1 if reply.get('value') else 0
+
+    def dereferenced(self, count: int = 1) -> None:
+        profile = current_profile.get()
+        if profile is not None:
+            profile.dereferences += count
+
+    def instrument_dereferences(self) -> None:
+        """Counts the lazy loads of mongoengine reference fields, one query each"""
+        from mongoengine.fields import ReferenceField, GenericReferenceField, CachedReferenceField
+
+        for field_class in (ReferenceField, GenericReferenceField, CachedReferenceField):
+            original = field_class.__dict__['_lazy_load_ref'].__func__
+            if getattr(original, 'profiled', False):
+                continue
+
+            @functools.wraps(original)
+            def lazy_load_ref(*args, original=original, **kwargs):
+                self.dereferenced()
+                return original(*args, **kwargs)
+            lazy_load_ref.profiled = True
+            field_class._lazy_load_ref = staticmethod(lazy_load_ref)
+
+    @contextmanager
+    def profile(self, name: str):
+        profile = RequestProfile(name)
+        token = current_profile.set(profile)
+        try:
+            yield profile
+        finally:
+            current_profile.reset(token)
+            self.finish(profile)
+
+    def start(self, name: str) -> contextvars.Token:
+        """For hooks that cannot wrap the handler, e.g. Flask before_request/teardown_request"""
+        return current_profile.set(RequestProfile(name))
+
+    def stop(self, token: contextvars.Token) -> None:
+        profile = current_profile.get()
+        current_profile.reset(token)
+        if profile is not None:
+            self.finish(profile)
+
+    def profiled(self, name: str, handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            with self.profile(name):
+                return handler(*args, **kwargs)
+        return wrapper
+
+    def finish(self, profile: RequestProfile) -> None:
+        profile.elapsed = time.perf_counter() - profile.started
+        over_queries = self.max_queries is not None and profile.queries > self.max_queries
+        over_time = self.max_ms is not None and profile.elapsed * 1000 > self.max_ms
+        if over_queries or over_time:
+            logger.warning("Handler %s over budget: %d queries, %.1f ms, %.1f ms in the database, "
+                           "%d documents, %d dereferences", profile.name, profile.queries, profile.elapsed * 1000,
+                           profile.db_time * 1000, profile.documents, profile.dereferences)
+        with self.lock:
+            stats = self.handlers.setdefault(profile.name, {
+                "count": 0, "queries": 0, "queries_max": 0, "db_ms": 0.0, "documents": 0, "dereferences": 0,
+                "elapsed_ms": 0.0, "elapsed_ms_max": 0.0, "over_budget": 0,
+            })
+            stats["count"] += 1
+            stats["queries"] += profile.queries
+            stats["queries_max"] = max(stats["queries_max"], profile.queries)
+            stats["db_ms"] += profile.db_time * 1000
+            stats["documents"] += profile.documents
+            stats["dereferences"] += profile.dereferences
+            stats["elapsed_ms"] += profile.elapsed * 1000
+            stats["elapsed_ms_max"] = max(stats["elapsed_ms_max"], profile.elapsed * 1000)
+            stats["over_budget"] += over_queries or over_time
+
+    def stats(self) -> dict:
+        with self.lock:
+            handlers = {name: dict(stats) for name, stats in self.handlers.items()}
+        for stats in handlers.values():
+            stats["queries_avg"] = round(stats["queries"] / stats["count"], 2)
+            stats["db_ms"] = round(stats["db_ms"], 3)
+            stats["elapsed_ms"] = round(stats["elapsed_ms"], 3)
+            stats["elapsed_ms_max"] = round(stats["elapsed_ms_max"], 3)
+        return {"max_queries": self.max_queries, "max_ms": self.max_ms,
+                # Сначала обработчики, которые суммарно больше всего ждут базу
+                "handlers": dict(sorted(handlers.items(), key=lambda item: item[1]["db_ms"], reverse=True))}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.handlers.clear()
+
+
+# Методы коллекции mongomock, которые на сервере были бы командами; find_one внутри вызывает find
+MONGOMOCK_COMMANDS = ('find', 'insert_one', 'insert_many', 'update_one', 'update_many', 'replace_one', 'delete_one',
+                      'delete_many', 'bulk_write', 'aggregate', 'count_documents', 'distinct', 'find_one_and_update')
+
+
+def mongomock_commands(listener):
+    """
+    mongomock has no command monitoring: reports its outermost collection calls to listener.started instead.
+    Returns a patcher, used as a context manager or started for the rest of the process
+    """
+    import mongomock
+    from unittest.mock import patch
+    local = threading.local()
+
+    def counted(name, original):
+        def method(*args, **kwargs):
+            depth = getattr(local, 'depth', 0)
+            if depth == 0:
+                listener.started(SimpleNamespace(command_name=name))
+            local.depth = depth + 1
+            try:
+                return original(*args, **kwargs)
+            finally:
+                local.depth = depth
+        return method
+
+    return patch.multiple(mongomock.collection.Collection,
+                          **{name: counted(name, getattr(mongomock.collection.Collection, name))
+                             for name in MONGOMOCK_COMMANDS})
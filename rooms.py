@@ -0,0 +1,19 @@
+from flask import request, has_request_context
+
+# Общая комната, куда попадает каждое подключение: только для настоящих широковещательных событий
+BROADCAST_ROOM = 'room'
+
+
+def user_room(user_id) -> str:
+    return f'user:{user_id}'
+
+
+def thread_room(message_id) -> str:
+    return f'thread:{message_id}'
+
+
+def current_sid():
+    """Socket.IO session id of the current event, None for HTTP requests"""
+    if not has_request_context():
+        return None
+    return getattr(request, 'sid', None)
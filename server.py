@@ -1,14 +1,35 @@
-from flask import Flask
+import bootstrap  # noqa: F401
+
+import logging
+import os
+import time
+
+import click
+from flask import Flask, jsonify, request, g
 from flask_mongoengine import MongoEngine
 from flask_cors import CORS
-from flask_socketio import join_room
+from flask_socketio import join_room, leave_room, emit
 
 from views import UserView, CreateMessageView, DeleteMessageView, UpdateMessageView, CreateCommentView, \
     DeleteCommentView, CreateSubCommentView, DeleteSubCommentView, UpdateSubCommentView, UpdateCommentView,\
-    LikeMessageView, RemoveLikeMessageView, GetMessageLikesView, BanUserView, UnbanUserView, \
+    LikeMessageView, RemoveLikeMessageView, GetMessageLikesView, GetLikesView, BanUserView, UnbanUserView, \
     IgnoreUserView, UnignoreUserView, GetIgnoredUsersView, ReportMessageView, ReportCommentView, GetTopUsersView, \
-    GetRecentMessagesView, SendNotificationView, GetMessageCommentsView, GetUserPostsView
+    GetRecentMessagesView, SendNotificationView, GetMessageCommentsView, GetUserPostsView, QueryStatsView, \
+    MetricsView, GetSubcommentsView, PurgeStatusView, purge_worker
 from socketio_singleton import socketio
+from profiler_singleton import profiler
+from metrics import instrument_emits
+from metrics_singleton import socket_event_seconds, http_request_seconds, socket_emits, socket_emit_bytes
+from maintenance import repair_counters, migrate_likes
+from models import ensure_indexes, ensure_indexes_once
+from rooms import BROADCAST_ROOM, user_room, thread_room
+from invalidation_bus import socketio_queue_options
+from db_executor import DBUnavailable
+from wire_format import deflate_websocket_above
+from event_log import record_broadcasts
+from event_log_singleton import event_log
+
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config['MONGODB_SETTINGS'] = {
@@ -19,23 +40,148 @@ app.config['MONGODB_SETTINGS'] = {
 cors = CORS(app, resources={r"/*": {"origins": "*", "allow_headers": ["Content-Type"],
                                     "methods": ["GET", "POST"]}})
 db = MongoEngine(app)
-socketio.init_app(app)
+# Пакеты от COMPRESSION_THRESHOLD байт сжимаются: gzip/deflate для long-polling, permessage-deflate для websocket
+compression_threshold = int(os.environ.get('COMPRESSION_THRESHOLD', 1024))
+# Несколько воркеров за балансировщиком: события пересылаются через общую очередь
+socketio.init_app(app, compression_threshold=compression_threshold,
+                  **socketio_queue_options(os.environ.get('SOCKETIO_MESSAGE_QUEUE')))
+deflate_websocket_above(compression_threshold)
+instrument_emits(socketio.server, socket_emits, socket_emit_bytes)
+record_broadcasts(socketio.server, event_log)
+
+
+@app.before_request
+def build_indexes():
+    # Коллекции созданы с auto_create_index=False: без индексов запросы пойдут полным сканированием
+    ensure_indexes_once()
+
+
+@socketio.on('connect')
+def on_connect(auth=None):
+    ensure_indexes_once()
+
+
+@app.before_request
+def start_profile():
+    g.request_started = time.perf_counter()
+    if request.url_rule is not None:
+        g.profile_token = profiler.start(f"{request.method} {request.url_rule.rule}")
+
+
+@app.after_request
+def observe_request(response):
+    # Неизвестные пути в одну серию, чтобы сканеры не плодили метки
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    http_request_seconds.observe(request.method, route, response.status_code,
+                                 value=time.perf_counter() - g.request_started)
+    return response
+
+
+@app.teardown_request
+def stop_profile(exc):
+    token = g.pop('profile_token', None)
+    if token is not None:
+        profiler.stop(token)
+
+
+@app.errorhandler(DBUnavailable)
+def db_unavailable(e):
+    return jsonify({"message": str(e)}), 503
+
+
+@socketio.on_error_default
+def socket_error(e):
+    if not isinstance(e, DBUnavailable):
+        raise e
+    # Клиент узнаёт, что запрос не выполнен, и может повторить его позже
+    emit('server busy', {"event": request.event['message'], "message": str(e)})
+
+
+@app.cli.command('repair-counters')
+def repair_counters_command():
+    """Recompute denormalized like/comment/subcomment counters and the leaderboard."""
+    updated = repair_counters()
+    for collection, count in updated.items():
+        click.echo(f'{collection}: {count} documents updated')
+
+
+@app.cli.command('migrate-likes')
+def migrate_likes_command():
+    """Move likes embedded in tweets and comments into the like collection."""
+    migrated = migrate_likes()
+    counters = migrated.pop('counters')
+    for message_type, count in migrated.items():
+        click.echo(f'{message_type}: {count} likes moved')
+    for collection, count in counters.items():
+        click.echo(f'{collection}: {count} documents updated')
+
+
+@app.cli.command('purge-deleted')
+def purge_deleted_command():
+    """Remove what deleted tweets and comments left behind, without waiting for the background purge."""
+    finished = purge_worker.drain()
+    for collection, count in purge_worker.stats()['removed'].items():
+        click.echo(f'{collection}: {count} documents removed')
+    click.echo(f'{finished} deleted tweets and comments purged')
+
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    """Create the MongoDB indexes declared on the models."""
+    ensure_indexes()
+    click.echo('Indexes are up to date')
 
 
 @socketio.on('join')
 def on_join(data):
-    room = data['room']
-    join_room(room)
-    print('Client joined room:', room)
+    # Общая комната для широковещательных событий и личная комната пользователя
+    join_room(BROADCAST_ROOM)
+    user_id = data.get('user_id')
+    if user_id is not None:
+        join_room(user_room(user_id))
+    logger.debug('Client joined rooms: %s %s', BROADCAST_ROOM, user_id)
+
+
+@socketio.on('join threads')
+def on_join_threads(data):
+    # Клиент подписывается на события твитов, которые сейчас отображает
+    for message_id in data.get('message_ids', []):
+        join_room(thread_room(message_id))
+
+
+@socketio.on('leave threads')
+def on_leave_threads(data):
+    for message_id in data.get('message_ids', []):
+        leave_room(thread_room(message_id))
+
+
+@socketio.on('resume')
+def on_resume(data):
+    """
+    Join and catch-up in one event: rooms of 'join' and 'join threads', then every numbered broadcast
+    to them after the client's epoch and seq, then 'resumed' with the position to continue from.
+    complete=False means the events could not be replayed and the client reloads the feed
+    """
+    user_id = data.get('user_id')
+    rooms = [BROADCAST_ROOM] + ([user_room(user_id)] if user_id is not None else []) + \
+        [thread_room(message_id) for message_id in data.get('message_ids', [])]
+    # Между входом в комнаты и снимком журнала нет переключений: событие придёт либо вживую, либо повтором
+    for room in rooms:
+        join_room(room)
+    missed = event_log.since(data.get('epoch'), data.get('seq'), rooms)
+    position = event_log.position()
+    for event, payload in missed or ():
+        emit(event, payload)
+    emit('resumed', dict(position, replayed=len(missed or ()), complete=missed is not None))
 
 
 view_classes = [
     UserView, CreateMessageView, DeleteMessageView, UpdateMessageView, CreateCommentView,
     DeleteCommentView, UpdateCommentView, CreateSubCommentView, DeleteSubCommentView, UpdateSubCommentView,
-    LikeMessageView, RemoveLikeMessageView, GetMessageLikesView, BanUserView,
+    LikeMessageView, RemoveLikeMessageView, GetMessageLikesView, GetLikesView, BanUserView,
     UnbanUserView, IgnoreUserView, UnignoreUserView, GetIgnoredUsersView, ReportMessageView,
     ReportCommentView, GetTopUsersView, GetRecentMessagesView, SendNotificationView,
-    GetMessageCommentsView, GetUserPostsView
+    GetMessageCommentsView, GetUserPostsView, QueryStatsView, MetricsView, GetSubcommentsView, PurgeStatusView
 ]
 
 event_handlers = {
@@ -51,6 +197,7 @@ event_handlers = {
     'like message': 'handle_like_message_socket',
     'remove like message': 'handle_remove_like_socket',
     'get message likes': 'handle_get_likes_socket',
+    'get likes': 'handle_get_likes_bulk_socket',
     'ban user': 'handle_ban_user_socket',
     'unban user': 'handle_unban_user_socket',
     'ignore user': 'handle_ignore_user_socket',
@@ -62,11 +209,14 @@ event_handlers = {
     'get recent messages': 'handle_get_recent_messages_socket',
     'send notification': 'handle_send_notification_socket',
     'get message comments': 'handle_get_message_comments_socket',
+    'get subcomments': 'handle_get_subcomments_socket',
     'get user posts': 'handle_get_user_posts_socket',
     'create subcomment': 'handle_create_subcomment_socket',
     'new subcomment': 'handle_new_subcomment_socket',
     'delete subcomment': 'handle_delete_subcomment_socket',
     'update subcomment': 'handle_update_subcomment_socket',
+    'get query stats': 'handle_get_query_stats_socket',
+    'get purge status': 'handle_get_purge_status_socket',
 }
 
 view_instances = {view_class: view_class(socketio) for view_class in view_classes}
@@ -74,7 +224,9 @@ view_instances = {view_class: view_class(socketio) for view_class in view_classe
 for event_name, handler_name in event_handlers.items():
     for view_instance in view_instances.values():
         if hasattr(view_instance, handler_name):
-            socketio.on(event_name)(getattr(view_instance, handler_name))
+            # Каждое событие получает свой профиль: число запросов, время в базе, документы
+            handler = profiler.profiled(event_name, getattr(view_instance, handler_name))
+            socketio.on(event_name)(socket_event_seconds.timed(handler, event_name))
             break
 
 url_rules = [
@@ -90,23 +242,33 @@ url_rules = [
     ("/like_message", LikeMessageView.as_view('like_message', socketio=socketio), ['POST']),
     ("/remove_like_message", RemoveLikeMessageView.as_view('remove_like_message', socketio=socketio), ['POST']),
     ("/get_message_likes/<string:message_id>", GetMessageLikesView.as_view('get_message_likes'), ['GET']),
+    ("/get_likes", GetLikesView.as_view('get_likes', socketio=socketio), ['POST']),
     ("/ignore_user", IgnoreUserView.as_view('ignore_user', socketio=socketio), ['POST']),
     ("/unignore_user", UnignoreUserView.as_view('unignore_user', socketio=socketio), ['POST']),
     ("/get_ignored_users/<int:user_id>", GetIgnoredUsersView.as_view('get_ignored_users'), ['GET']),
     ("/report_message", ReportMessageView.as_view('report_message', socketio=socketio), ['POST']),
     ("/report_comment", ReportCommentView.as_view('report_comment', socketio=socketio), ['POST']),
-    ("/get_top_users", GetTopUsersView.as_view('get_top_users'), ['GET']),
+    ("/get_top_users", GetTopUsersView.as_view('get_top_users', socketio=socketio), ['GET']),
     ("/get_recent_messages", GetRecentMessagesView.as_view('get_recent_messages'), ['GET']),
     ("/send_notification", SendNotificationView.as_view('send_notification', socketio=socketio), ['POST']),
-    ("/get_message_comments/<string:message_id>", GetMessageCommentsView.as_view('get_message_comments'), ['GET']),
+    ("/get_message_comments/<string:message_id>",
+     GetMessageCommentsView.as_view('get_message_comments', socketio=socketio), ['GET']),
+    ("/get_subcomments/<string:comment_id>", GetSubcommentsView.as_view('get_subcomments', socketio=socketio),
+     ['GET']),
     ("/get_user_posts/<int:user_id>", GetUserPostsView.as_view('get_user_posts'), ['GET']),
     ("/create_subcomment", CreateSubCommentView.as_view('create_subcomment', socketio=socketio), ['POST']),
     ("/delete_subcomment", DeleteSubCommentView.as_view('delete_subcomment', socketio=socketio), ['POST']),
     ("/update_subcomment", UpdateSubCommentView.as_view('update_subcomment', socketio=socketio), ['POST']),
+    ("/admin/query_stats", QueryStatsView.as_view('query_stats', socketio=socketio), ['GET']),
+    ("/admin/purge_status", PurgeStatusView.as_view('purge_status', socketio=socketio), ['GET']),
+    ("/metrics", MetricsView.as_view('metrics', socketio=socketio), ['GET']),
 ]
 
 for url_rule, view, methods in url_rules:
     app.add_url_rule(url_rule, view_func=view, methods=methods)
 
 if __name__ == "__main__":
+    ensure_indexes()
+    # Надгробия, оставшиеся после остановки прошлого процесса
+    purge_worker.wake()
     socketio.run(app, debug=True)
@@ -1,113 +1,199 @@
+import os
+import threading
+import time
 import unittest
+from contextlib import contextmanager, ExitStack
+from datetime import datetime, timezone
 from unittest.mock import Mock, patch, call, MagicMock
-from user_functions import UserService
+
+import mongoengine
+from bson import ObjectId
+from pymongo import monitoring
+
+from user_functions import UserService, MAX_COMMENTS_PAGE
+from feed_assembler import TOP_COMMENTS, TOP_SUBCOMMENTS
+from leaderboard import Leaderboard
+from user_cache import CachedUser
+from invalidation_bus import InMemoryBus, FEED_CHANNEL
+# Регистрирует слушатель команд до того, как тесты создадут MongoClient
+from profiler_singleton import profiler
+from query_profiler import mongomock_commands
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
 
 
 class TestUserService(unittest.TestCase):
 
-    @patch("user_functions.User")
-    def test_user_exists(self, mock_user):
-        mock_user.objects.get.return_value = Mock()
+    def setUp(self):
+        # Счётчики рейтинга пишутся напрямую в коллекцию пользователей
+        patcher = patch("leaderboard.User")
+        self.leaderboard_user = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def leaderboard_increments(self) -> list:
+        bulk_write = self.leaderboard_user._get_collection.return_value.bulk_write
+        return [(operation._filter['_id'], operation._doc['$inc'])
+                for call in bulk_write.call_args_list for operation in call.args[0]]
+
+    @staticmethod
+    def cached_user(forum_id, **fields):
+        defaults = dict(id=ObjectId(), forum_id=forum_id, username=f"user{forum_id}", avatar_url="avatar.png",
+                        banned=False, ignored_ids=frozenset())
+        defaults.update(fields)
+        return CachedUser(**defaults)
+
+    @staticmethod
+    def service_with_users(*users):
         service = UserService()
+        service.user_cache = Mock()
+        known = {user.forum_id: user for user in users}
+        service.user_cache.get.side_effect = known.get
+        return service
+
+    def test_user_exists(self):
+        service = self.service_with_users(self.cached_user(1))
         self.assertTrue(service.user_exists(1))
-        mock_user.objects.get.assert_called_once_with(forum_id=1)
+        self.assertFalse(service.user_exists(2))
+        service.user_cache.get.assert_any_call(1)
 
     @patch("user_functions.User")
     def test_create_user(self, mock_user):
         mock_user.return_value = Mock()
-        service = UserService()
+        service = self.service_with_users()
         service.create_user(1, "username", "avatar_url")
         mock_user.assert_called_once_with(username="username", forum_id=1, avatar_url="avatar_url")
         mock_user.return_value.save.assert_called_once()
+        service.user_cache.invalidate.assert_called_once_with(1)
 
     @patch("user_functions.User")
     def test_update_username_and_avatar(self, mock_user):
-        mock_user.objects.get.return_value = Mock(username="old_username", avatar_url="old_avatar_url")
-        service = UserService()
+        user = self.cached_user(1, username="old_username", avatar_url="old_avatar_url")
+        service = self.service_with_users(user)
         service.update_username_and_avatar(1, "new_username", "new_avatar_url")
-        mock_user.objects.get.assert_called_once_with(forum_id=1)
-        self.assertEqual(mock_user.objects.get.return_value.username, "new_username")
-        self.assertEqual(mock_user.objects.get.return_value.avatar_url, "new_avatar_url")
-        mock_user.objects.get.return_value.save.assert_called_once()
+        mock_user.objects.assert_called_once_with(id=user.id)
+        mock_user.objects.return_value.update_one.assert_called_once_with(
+            set__username="new_username", set__avatar_url="new_avatar_url")
+        service.user_cache.invalidate.assert_called_once_with(1)
 
-    @patch("user_functions.Message")
     @patch("user_functions.User")
-    def test_create_message(self, mock_user, mock_message):
-        mock_user.objects.get.return_value = Mock()
-        mock_message.return_value = Mock()
-        service = UserService()
+    def test_update_username_and_avatar_unchanged(self, mock_user):
+        service = self.service_with_users(self.cached_user(1, username="name", avatar_url="avatar"))
+        service.update_username_and_avatar(1, "name", "avatar")
+        mock_user.objects.assert_not_called()
+        service.user_cache.invalidate.assert_not_called()
+
+    @patch("user_functions.Message")
+    def test_create_message(self, mock_message):
+        user = self.cached_user(1)
+        mock_message.return_value.to_mongo.return_value = {'_id': ObjectId(), 'created_at': datetime.utcnow()}
+        service = self.service_with_users(user)
         service.create_message(1, "content")
-        mock_user.objects.get.assert_called_once_with(forum_id=1)
-        mock_message.assert_called_once_with(user=mock_user.objects.get.return_value, content="content")
+        service.user_cache.get.assert_called_once_with(1)
+        mock_message.assert_called_once_with(user=user.id, content="content")
         mock_message.return_value.save.assert_called_once()
+        self.assertEqual(self.leaderboard_increments(), [(user.id, {'messages_count': 1})])
 
     @patch("user_functions.Message")
     @patch("user_functions.User")
     def test_delete_message(self, mock_user, mock_message):
-        mock_message.objects.get.return_value = Mock(user=mock_user)
-        service = UserService()
+        author_id = ObjectId()
+        mock_message.objects.get.return_value = Mock(id="message_id", user=mock_user, _data={'user': author_id},
+                                                     likes_count=2)
+        purge = Mock()
+        service = UserService(purge=purge)
         service.delete_message("message_id", 1)
         mock_message.objects.get.assert_called_once_with(id="message_id")
         mock_message.objects.get.return_value.delete.assert_called_once()
+        # Комментарии, ответы и лайки вычищает PurgeWorker, сам запрос только ставит надгробие
+        purge.queue.assert_called_once_with('tweet', "message_id")
+        self.assertEqual(purge.on_removed, service.leaderboard.removed)
+        self.assertEqual(self.leaderboard_increments(), [(author_id, {'messages_count': -1, 'likes_received': -2})])
 
     @patch("user_functions.Message")
-    @patch("user_functions.User")
-    def test_edit_message(self, mock_user, mock_message):
-        mock_user.objects.get.return_value = Mock()
-        mock_message.objects.get.return_value = Mock(user=mock_user)
-        mock_message.objects.get.return_value.user.forum_id = 1
-        service = UserService()
+    def test_edit_message(self, mock_message):
+        user = self.cached_user(1)
+        mock_message.objects.get.return_value = Mock(_data={'user': user.id})
+        service = self.service_with_users(user)
         service.edit_message("message_id", 1, "new_content")
         mock_message.objects.get.assert_called_once_with(id="message_id")
         self.assertEqual(mock_message.objects.get.return_value.content, "new_content")
         mock_message.objects.get.return_value.save.assert_called_once()
 
+    @patch("user_functions.Message")
+    def test_edit_message_of_other_user(self, mock_message):
+        mock_message.objects.get.return_value = Mock(_data={'user': ObjectId()})
+        service = self.service_with_users(self.cached_user(1))
+        with self.assertRaises(PermissionError):
+            service.edit_message("message_id", 1, "new_content")
+        mock_message.objects.get.return_value.save.assert_not_called()
+
     @patch("user_functions.Comment")
     @patch("user_functions.Message")
-    @patch("user_functions.User")
-    def test_create_comment(self, mock_user, mock_message, mock_comment):
-        mock_user.objects.get.return_value = Mock()
+    def test_create_comment(self, mock_message, mock_comment):
+        user = self.cached_user(1)
         mock_message.objects.get.return_value = Mock()
-        mock_comment.return_value = Mock()
-        service = UserService()
+        mock_comment.return_value.to_mongo.return_value = {'_id': ObjectId(), 'created_at': datetime.utcnow()}
+        service = self.service_with_users(user)
         service.create_comment(1, "message_id", "content")
-        mock_user.objects.get.assert_called_once_with(forum_id=1)
+        service.user_cache.get.assert_called_once_with(1)
         mock_message.objects.get.assert_called_once_with(id="message_id")
-        mock_comment.assert_called_once_with(user=mock_user.objects.get.return_value,
+        mock_comment.assert_called_once_with(user=user.id,
                                              message=mock_message.objects.get.return_value, content="content")
         mock_comment.return_value.save.assert_called_once()
 
+    @patch("user_functions.Message")
     @patch("user_functions.Comment")
     @patch("user_functions.User")
-    def test_delete_comment(self, mock_user, mock_comment):
-        mock_comment.objects.get.return_value = Mock(user=mock_user)
-        service = UserService()
+    def test_delete_comment(self, mock_user, mock_comment, mock_message):
+        mock_comment.objects.get.return_value = Mock(id="comment_id", user=mock_user, subcomments_count=0,
+                                                     likes_count=0)
+        service = UserService(purge=Mock())
         service.delete_comment("comment_id", 1)
         mock_comment.objects.get.assert_called_once_with(id="comment_id")
         mock_comment.objects.get.return_value.delete.assert_called_once()
+        service.purge.queue.assert_called_once_with('comment', "comment_id")
+        mock_message.objects.return_value.update_one.assert_called_once()
 
     @patch("user_functions.Like")
     @patch("user_functions.Message")
-    @patch("user_functions.User")
-    def test_like(self, mock_user, mock_message, mock_like):
-        mock_user.objects.get.return_value = Mock()
-        mock_message.objects.get.return_value = Mock()
-        mock_message.objects.get.return_value.likes = [Mock()]
-        mock_like.return_value = Mock()
-        service = UserService()
-        service.like(1, "message_id", 1)
-        mock_user.objects.get.assert_called_once_with(forum_id=1)
-        mock_message.objects.get.assert_called_once_with(id="message_id")
-        mock_like.assert_called_once_with(user=mock_user.objects.get.return_value, value=1)
-        self.assertIn(mock_like.return_value, mock_message.objects.get.return_value.likes)
-        mock_message.objects.get.return_value.save.assert_called_once()
+    def test_like(self, mock_message, mock_like):
+        user = self.cached_user(1)
+        message_id = str(ObjectId())
+        modify = mock_message.objects.return_value.only.return_value.modify
+        modify.return_value = Mock(likes_count=3, _data={'user': None})
+        service = self.service_with_users(user)
+        self.assertEqual(service.like(1, message_id, "tweet", 1), 3)
+        service.user_cache.get.assert_called_once_with(1)
+        mock_like.assert_called_once_with(target_type="tweet", target_id=ObjectId(message_id), user=user.id, value=1)
+        mock_like.return_value.save.assert_called_once()
+        mock_message.objects.assert_called_once_with(id=message_id)
+        modify.assert_called_once_with(new=True, inc__likes_count=1)
+
+        # Цель исчезла между вставкой лайка и $inc: лайк откатывается
+        modify.return_value = None
+        with self.assertRaisesRegex(ValueError, "does not exist"):
+            service.like(1, message_id, "tweet", 1)
+        mock_like.return_value.delete.assert_called_once()
+
+    @patch("user_functions.Like")
+    @patch("user_functions.Message")
+    def test_like_twice(self, mock_message, mock_like):
+        from mongoengine import NotUniqueError
+        mock_like.return_value.save.side_effect = NotUniqueError()
+        service = self.service_with_users(self.cached_user(1))
+        with self.assertRaisesRegex(ValueError, "already liked"):
+            service.like(1, str(ObjectId()), "tweet", 1)
+        mock_message.objects.assert_not_called()
 
     @patch("user_functions.Message")
     @patch("user_functions.User")
     def test_get_user_posts(self, mock_user, mock_message):
         from datetime import datetime
         mock_message.objects.filter.return_value.order_by.return_value.limit.return_value = [
-            Mock(id="post_id", content="content", date=datetime.now(), comments=[], likes=[])]
+            Mock(id="post_id", content="content", date=datetime.now(), comments=[], likes_count=0)]
         service = UserService()
         posts = service.get_user_posts(1)
         expected = [
@@ -122,154 +208,180 @@ class TestUserService(unittest.TestCase):
     @patch("user_functions.Like")
     @patch("user_functions.Message")
     def test_get_likes(self, mock_message, mock_like):
-        mock_likes = [Mock(value=i) for i in range(10)]
-        mock_message.objects.get.return_value.likes = mock_likes
-        service = UserService()
-        likes = service.get_likes("message_id")
-        mock_message.objects.get.assert_called_once_with(id="message_id")
-        self.assertEqual(likes, sum(like.value for like in mock_likes))
+        user = self.cached_user(1)
+        message_id = str(ObjectId())
+        queryset = mock_message.objects.return_value.only.return_value
+        queryset.as_pymongo.return_value = [{"_id": ObjectId(message_id), "likes_count": 3}]
+        mock_like.objects.return_value.only.return_value.as_pymongo.return_value = [
+            {"target_type": "tweet", "target_id": ObjectId(message_id)}]
+        service = self.service_with_users(user)
+        self.assertEqual(service.get_likes(1, message_id, "tweet"), {"total": 3, "user_liked": True})
+        mock_message.objects.assert_called_once_with(id__in=[ObjectId(message_id)])
+        mock_like.objects.assert_called_once_with(target_type__in=["tweet"], target_id__in=[ObjectId(message_id)],
+                                                  user=user.id)
 
+        queryset.as_pymongo.return_value = []
+        with self.assertRaises(ValueError):
+            service.get_likes(1, message_id, "tweet")
+
+    @patch("user_functions.Like")
     @patch("user_functions.Message")
-    @patch("user_functions.User")
-    def test_remove_like(self, mock_user, mock_message):
-        mock_like = Mock(user=mock_user)
-        mock_message.objects.get.return_value.likes = [mock_like]
-        service = UserService()
-        like = Mock()
-        like.user.forum_id = 1
-        mock_message.objects.get.return_value.likes = [like]
-        service.remove_like(1, "message_id")
-        mock_user.objects.get.assert_called_once_with(forum_id=1)
-        mock_message.objects.get.assert_called_once_with(id="message_id")
-        self.assertNotIn(mock_like, mock_message.objects.get.return_value.likes)
-        mock_message.objects.get.return_value.save.assert_called_once()
+    def test_remove_like(self, mock_message, mock_like):
+        user = self.cached_user(1)
+        message_id = str(ObjectId())
+        modify = mock_message.objects.return_value.only.return_value.modify
+        modify.return_value = Mock(likes_count=0, _data={'user': None})
+        mock_like.objects.return_value.delete.return_value = 1
+        service = self.service_with_users(user)
+        self.assertEqual(service.remove_like(1, message_id, "tweet"), 0)
+        service.user_cache.get.assert_called_once_with(1)
+        mock_like.objects.assert_called_once_with(target_type="tweet", target_id=ObjectId(message_id), user=user.id)
+        mock_message.objects.assert_called_once_with(id=message_id)
+        modify.assert_called_once_with(new=True, inc__likes_count=-1)
+
+        mock_like.objects.return_value.delete.return_value = 0
+        with self.assertRaisesRegex(ValueError, "has not liked"):
+            service.remove_like(1, message_id, "tweet")
 
     @patch("user_functions.User")
     def test_ban_user(self, mock_user):
-        mock_user.objects.get.return_value = Mock(banned=False)
-        service = UserService()
+        mock_user.objects.return_value.update_one.return_value = 1
+        service = self.service_with_users()
         service.ban_user(1)
-        mock_user.objects.get.assert_called_once_with(forum_id=1)
-        self.assertTrue(mock_user.objects.get.return_value.banned)
-        mock_user.objects.get.return_value.save.assert_called_once()
+        mock_user.objects.assert_called_once_with(forum_id=1)
+        mock_user.objects.return_value.update_one.assert_called_once_with(set__banned=True)
+        service.user_cache.invalidate.assert_called_once_with(1)
+
+        mock_user.objects.return_value.update_one.return_value = 0
+        with self.assertRaises(ValueError):
+            service.ban_user(2)
 
     @patch("user_functions.User")
     def test_unban_user(self, mock_user):
-        mock_user.objects.get.return_value = Mock(banned=True)
-        service = UserService()
+        mock_user.objects.return_value.update_one.return_value = 1
+        service = self.service_with_users()
         service.unban_user(1)
-        mock_user.objects.get.assert_called_once_with(forum_id=1)
-        self.assertFalse(mock_user.objects.get.return_value.banned)
-        mock_user.objects.get.return_value.save.assert_called_once()
+        mock_user.objects.assert_called_once_with(forum_id=1)
+        mock_user.objects.return_value.update_one.assert_called_once_with(set__banned=False)
+        service.user_cache.invalidate.assert_called_once_with(1)
 
     @patch("user_functions.User")
     def test_ignore_user(self, mock_user):
-        mock_user.objects.get.return_value = Mock()
-        ignored_user = Mock()
-        mock_user.objects.get.return_value.ignored_users = [ignored_user]
-        service = UserService()
+        user, ignored_user = self.cached_user(1), self.cached_user(2)
+        service = self.service_with_users(user, ignored_user)
         service.ignore_user(1, 2)
-        mock_user.objects.get.assert_any_call(forum_id=1)
-        mock_user.objects.get.assert_any_call(forum_id=2)
-        self.assertIn(ignored_user, mock_user.objects.get.return_value.ignored_users)
-        mock_user.objects.get.return_value.save.assert_called_once()
+        service.user_cache.get.assert_any_call(1)
+        service.user_cache.get.assert_any_call(2)
+        mock_user.objects.assert_called_once_with(id=user.id)
+        mock_user.objects.return_value.update_one.assert_called_once_with(add_to_set__ignored_users=ignored_user.id)
+        service.user_cache.invalidate.assert_called_once_with(1)
 
     @patch("user_functions.User")
     def test_unignore_user(self, mock_user):
-        mock_user_instance = Mock()
-        ignored_user = Mock()
-        def side_effect(forum_id):
-            return mock_user_instance if forum_id == 1 else ignored_user
-        mock_user.objects.get.side_effect = side_effect
-        mock_ignored_users = MagicMock()
-        mock_ignored_users.__contains__.return_value = True
-        mock_user_instance.ignored_users = mock_ignored_users
-        service = UserService()
+        ignored_user = self.cached_user(2)
+        user = self.cached_user(1, ignored_ids=frozenset([ignored_user.id]))
+        service = self.service_with_users(user, ignored_user)
         service.unignore_user(1, 2)
-        mock_user.objects.get.assert_any_call(forum_id=1)
-        mock_user.objects.get.assert_any_call(forum_id=2)
-        mock_user_instance.ignored_users.remove.assert_called_once_with(ignored_user)
-        mock_user_instance.save.assert_called_once()
+        service.user_cache.get.assert_any_call(1)
+        service.user_cache.get.assert_any_call(2)
+        mock_user.objects.assert_called_once_with(id=user.id)
+        mock_user.objects.return_value.update_one.assert_called_once_with(pull__ignored_users=ignored_user.id)
+        service.user_cache.invalidate.assert_called_once_with(1)
 
-    @patch("user_functions.User")
-    def test_get_ignored_users(self, mock_user):
-        mock_ignored_users = [Mock(forum_id=i) for i in range(5)]
-        mock_user.objects.get.return_value.ignored_users = mock_ignored_users
-        service = UserService()
-        ignored_users = service.get_ignored_users(1)
-        mock_user.objects.get.assert_called_once_with(forum_id=1)
-        self.assertEqual(ignored_users, list(range(5)))
+    def test_get_ignored_users(self):
+        ignored_users = [self.cached_user(i) for i in range(2, 7)]
+        user = self.cached_user(1, ignored_ids=frozenset(ignored.id for ignored in ignored_users))
+        service = self.service_with_users(user, *ignored_users)
+        service.user_cache.get_many_by_ids.side_effect = lambda ids: {
+            ignored.id: ignored for ignored in ignored_users if ignored.id in ids}
+        result = service.get_ignored_users(1)
+        service.user_cache.get.assert_called_once_with(1)
+        self.assertEqual(sorted(ignored["id"] for ignored in result), list(range(2, 7)))
 
     @patch("user_functions.Report")
     @patch("user_functions.Message")
-    @patch("user_functions.User")
-    def test_report_message(self, mock_user, mock_message, mock_report):
-        mock_user.objects.get.return_value = Mock()
+    def test_report_message(self, mock_message, mock_report):
+        user = self.cached_user(1)
         mock_message.objects.get.return_value = Mock()
         mock_report.return_value = Mock()
-        service = UserService()
+        service = self.service_with_users(user)
         service.report_message(1, "message_id", "reason")
-        mock_user.objects.get.assert_called_once_with(forum_id=1)
+        service.user_cache.get.assert_called_once_with(1)
         mock_message.objects.get.assert_called_once_with(id="message_id")
-        mock_report.assert_called_once_with(user=mock_user.objects.get.return_value,
+        mock_report.assert_called_once_with(user=user.id,
                                             message=mock_message.objects.get.return_value, reason="reason")
         mock_report.return_value.save.assert_called_once()
 
     @patch("user_functions.Report")
     @patch("user_functions.Comment")
-    @patch("user_functions.User")
-    def test_report_comment(self, mock_user, mock_comment, mock_report):
-        mock_user.objects.get.return_value = Mock()
+    def test_report_comment(self, mock_comment, mock_report):
+        user = self.cached_user(1)
         mock_comment.objects.get.return_value = Mock()
         mock_report.return_value = Mock()
-        service = UserService()
+        service = self.service_with_users(user)
         service.report_comment(1, "comment_id", "reason")
-        mock_user.objects.get.assert_called_once_with(forum_id=1)
+        service.user_cache.get.assert_called_once_with(1)
         mock_comment.objects.get.assert_called_once_with(id="comment_id")
-        mock_report.assert_called_once_with(user=mock_user.objects.get.return_value,
+        mock_report.assert_called_once_with(user=user.id,
                                             comment=mock_comment.objects.get.return_value, reason="reason")
         mock_report.return_value.save.assert_called_once()
 
-    @patch("user_functions.User")
-    def test_get_top_users(self, mock_user):
-        mock_top_users = [Mock() for _ in range(5)]
-        mock_user.objects.order_by.return_value = mock_top_users
+    def test_get_top_users(self):
+        rows = [{"forum_id": i, "username": f"user{i}", "avatar_url": "a.png", "messages_count": 10 - i}
+                for i in range(3)]
+        query = self.leaderboard_user.objects.order_by.return_value.only.return_value.limit.return_value
+        query.as_pymongo.return_value = rows
         service = UserService()
         top_users = service.get_top_users()
-        mock_user.objects.order_by.assert_called_once_with('-message', '-comment', '-likes')
-        self.assertEqual(top_users, mock_top_users)
+        self.leaderboard_user.objects.order_by.assert_called_once_with(
+            '-messages_count', '-comments_count', '-likes_received')
+        self.leaderboard_user.objects.order_by.return_value.only.return_value.limit.assert_called_once_with(10)
+        self.assertEqual([user["id"] for user in top_users], [0, 1, 2])
+        self.assertEqual(top_users[0], {"id": 0, "username": "user0", "avatar_url": "a.png", "messages": 10,
+                                        "comments": 0, "likes": 0})
+        # Рейтинг кэшируется на короткое время
+        self.assertEqual(service.get_top_users(), top_users)
+        self.leaderboard_user.objects.order_by.assert_called_once()
 
     @patch("user_functions.Message")
     def test_get_recent_messages(self, mock_message):
-        mock_recent_messages = [Mock() for _ in range(5)]
-        mock_message.objects.order_by.return_value = mock_recent_messages
+        mock_recent_messages = [{'_id': ObjectId()} for _ in range(5)]
+        mock_queryset = mock_message.objects.order_by.return_value.only.return_value
+        mock_queryset.limit.return_value.as_pymongo.return_value = mock_recent_messages
         service = UserService()
+        service.feed_assembler = Mock()
+        service.feed_assembler.build.return_value = [{"content": "assembled", "comments": []}]
         recent_messages = service.get_recent_messages()
-        mock_message.objects.order_by.assert_called_once_with('-created_at')
-        self.assertEqual(recent_messages, mock_recent_messages)
+        mock_message.objects.order_by.assert_called_once_with('-created_at', '-id')
+        mock_queryset.limit.assert_called_once_with(11)
+        service.feed_assembler.build.assert_called_once_with(mock_recent_messages)
+        expected = {"messages": [{"content": "assembled", "comments": []}], "has_more_messages": False,
+                    "next_cursor": None, "liked_ids": []}
+        self.assertEqual(recent_messages, expected)
+        # Повторный запрос первой страницы отдаётся из кэша
+        self.assertEqual(service.get_recent_messages(), expected)
+        service.feed_assembler.build.assert_called_once()
 
     @patch("user_functions.Notification")
-    @patch("user_functions.User")
-    def test_send_notification(self, mock_user, mock_notification):
-        mock_user.objects.get.return_value = Mock()
+    def test_send_notification(self, mock_notification):
+        user = self.cached_user(1)
         mock_notification.return_value = Mock()
-        service = UserService()
+        service = self.service_with_users(user)
         service.send_notification(1, "text")
-        mock_user.objects.get.assert_called_once_with(forum_id=1)
-        mock_notification.assert_called_once_with(user=mock_user.objects.get.return_value, text="text")
+        service.user_cache.get.assert_called_once_with(1)
+        mock_notification.assert_called_once_with(user=user.id, text="text")
         mock_notification.return_value.save.assert_called_once()
 
     @patch("user_functions.Comment")
-    @patch("user_functions.Message")
-    def test_get_message_comments(self, mock_message, mock_comment):
-        mock_comments = [Mock() for _ in range(5)]
-        mock_comment.objects.return_value = mock_comments
-        mock_message.objects.get.return_value = Mock()
+    def test_get_message_comments_validates_arguments(self, mock_comment):
         service = UserService()
-        comments = service.get_message_comments("message_id")
-        mock_message.objects.get.assert_called_once_with(id="message_id")
-        mock_comment.objects.assert_called_once_with(message=mock_message.objects.get.return_value)
-        self.assertEqual(comments, mock_comments)
+        with self.assertRaises(ValueError):
+            service.get_message_comments("message_id")
+        with self.assertRaises(ValueError):
+            service.get_subcomments("comment_id")
+        with self.assertRaises(ValueError):
+            service.get_message_comments(str(ObjectId()), limit=MAX_COMMENTS_PAGE + 1)
+        mock_comment.objects.return_value.no_dereference.assert_not_called()
 
     def test_check_required_fields(self):
         service = UserService()
@@ -285,5 +397,1793 @@ class TestUserService(unittest.TestCase):
         with self.assertRaises(ValueError):
             service.check_message_length(message, 50)
 
+MONGODB_TEST_URI = os.environ.get('MONGODB_TEST_URI')
+
+
+@unittest.skipIf(mongomock is None and not MONGODB_TEST_URI, "neither mongomock nor MONGODB_TEST_URI is available")
+class TestMessageManager(unittest.TestCase):
+
+    @staticmethod
+    def make_author():
+        return CachedUser(id=ObjectId(), forum_id=1, username="user", avatar_url="a.png", banned=False,
+                          ignored_ids=frozenset())
+
+    def test_iso_time_is_utc_with_milliseconds(self):
+        from message_manager import MessageManager
+        self.assertEqual(MessageManager.iso_time(datetime(2023, 7, 1, 12, 30, 5, 123456)), "2023-07-01T12:30:05.123Z")
+        self.assertIsNone(MessageManager.iso_time(None))
+
+    def test_serialized_message_does_not_depend_on_now(self):
+        from message_manager import MessageManager
+        message = Mock(id="id", content="content", created_at=datetime(2023, 7, 1), likes_count=0,
+                       comments_count=0, subcomments_count=0)
+        author = self.make_author()
+        first = MessageManager.message_to_dict(message, author=author)
+        with patch("message_manager.datetime") as mock_datetime:
+            mock_datetime.now.return_value = datetime(2030, 1, 1, tzinfo=timezone.utc)
+            self.assertEqual(MessageManager.message_to_dict(message, author=author), first)
+        self.assertEqual(first['created_at'], "2023-07-01T00:00:00.000Z")
+
+    def test_render_adds_compat_field_on_request(self):
+        from feed_assembler import FeedAssembler, CREATED_AT
+        node = {'message_id': 'id', 'created_at': "2023-07-01T00:00:00.000Z",
+                CREATED_AT: datetime.now(timezone.utc), 'comments': []}
+        self.assertEqual(FeedAssembler.render(node), {'message_id': 'id', 'created_at': "2023-07-01T00:00:00.000Z",
+                                                      'comments': []})
+        rendered = FeedAssembler.render(node, relative_times=True)
+        self.assertEqual(list(rendered), ['message_id', 'created_at', 'created_ago', 'comments'])
+        self.assertEqual(rendered['created_ago'], "только что")
+
+
+class MongoTestCase(unittest.TestCase):
+    """
+    Base class for tests that need a real query engine: a local mongod
+    when MONGODB_TEST_URI is set, in-memory mongomock otherwise
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        mongoengine.disconnect()
+        if MONGODB_TEST_URI:
+            mongoengine.connect('mybb_twitter_test', host=MONGODB_TEST_URI)
+        else:
+            mongoengine.connect('mybb_twitter_test', mongo_client_class=mongomock.MongoClient)
+
+    @classmethod
+    def tearDownClass(cls):
+        mongoengine.disconnect()
+
+    def setUp(self):
+        from models import INDEXED_DOCUMENTS, ensure_indexes
+        for model in INDEXED_DOCUMENTS:
+            model.drop_collection()
+        ensure_indexes()
+
+    def count_finds(self):
+        """Counts find/find_one calls on every collection while the context is active"""
+        if MONGODB_TEST_URI:
+            self.skipTest("find counting relies on mongomock")
+        counter = {'find': 0, 'find_one': 0}
+        original_find = mongomock.collection.Collection.find
+        original_find_one = mongomock.collection.Collection.find_one
+
+        def find(collection, *args, **kwargs):
+            counter['find'] += 1
+            return original_find(collection, *args, **kwargs)
+
+        def find_one(collection, *args, **kwargs):
+            counter['find_one'] += 1
+            return original_find_one(collection, *args, **kwargs)
+
+        patcher = patch.multiple(mongomock.collection.Collection, find=find, find_one=find_one)
+        return patcher, counter
+
+    @contextmanager
+    def query_budget(self, max_queries: int):
+        """Profiles the block like a request and fails if it sent more than max_queries commands"""
+        with ExitStack() as stack:
+            if not MONGODB_TEST_URI:
+                stack.enter_context(self.mongomock_commands())
+            profile = stack.enter_context(profiler.profile(self.id()))
+            yield profile
+        self.assertLessEqual(profile.queries, max_queries, profile.as_dict())
+
+    @staticmethod
+    def mongomock_commands():
+        """mongomock has no command monitoring: report its outermost collection calls to the profiler instead"""
+        return mongomock_commands(profiler)
+
+
+class TestFeedAssembler(MongoTestCase):
+
+    def create_thread(self, author, commenter, comments=3, subcomments=2):
+        service = UserService()
+        message_id = service.create_message(author.forum_id, "tweet")
+        for i in range(comments):
+            comment_id = service.create_comment(commenter.forum_id, message_id, f"comment {i}")
+            for j in range(subcomments):
+                service.create_subcomment(author.forum_id, comment_id, f"sub {i}.{j}")
+        return message_id
+
+    def test_recent_messages_use_constant_number_of_queries(self):
+        from models import User
+        author = User(username="author", forum_id=10, avatar_url="a.png").save()
+        commenter = User(username="commenter", forum_id=11, avatar_url="c.png").save()
+        for _ in range(4):
+            # Треды, которые помещаются в ленту целиком
+            self.create_thread(author, commenter, comments=TOP_COMMENTS, subcomments=TOP_SUBCOMMENTS)
+
+        service = UserService()
+        with self.query_budget(4) as profile:
+            result = service.get_recent_messages(limit=10)
+
+        # messages, comments, subcomments, users
+        self.assertEqual(profile.queries, 4)
+        self.assertEqual(len(result['messages']), 4)
+        self.assertFalse(result['has_more_messages'])
+
+    def test_long_threads_are_cut_and_paged_by_cursor(self):
+        from models import User, Comment, SubComment
+        author = User(username="author", forum_id=10, avatar_url="a.png").save()
+        commenter = User(username="commenter", forum_id=11, avatar_url="c.png").save()
+        message_id = self.create_thread(author, commenter, comments=10, subcomments=0)
+        self.create_thread(author, commenter, comments=1, subcomments=1)
+        service = UserService()
+        first_comment_id = str(Comment.objects(message=message_id).order_by('created_at', 'id').first().id)
+        for i in range(7):
+            service.create_subcomment(10, first_comment_id, f"reply {i}")
+
+        with self.query_budget(4) as profile:
+            thread = service.get_recent_messages()['messages'][1]
+        # Длинные треды не добавляют запросов: messages, comments, subcomments, users
+        self.assertEqual(profile.queries, 4)
+        self.assertEqual(len(thread['comments']), TOP_COMMENTS)
+        self.assertEqual(thread['comments_count'], 10)
+        self.assertIsNotNone(thread['comments_cursor'])
+        first_comment = thread['comments'][0]
+        self.assertEqual(first_comment['comment_id'], first_comment_id)
+        self.assertEqual(len(first_comment['subcomments']), TOP_SUBCOMMENTS)
+        self.assertEqual(first_comment['subcomments_count'], 7)
+        self.assertIsNone(thread['comments'][1]['subcomments_cursor'])
+
+        comment_ids = [comment['comment_id'] for comment in thread['comments']]
+        cursor = thread['comments_cursor']
+        while cursor:
+            page = service.get_message_comments(message_id, cursor, limit=4)
+            self.assertLessEqual(len(page['comments']), 4)
+            comment_ids += [comment['comment_id'] for comment in page['comments']]
+            cursor = page['next_cursor']
+        self.assertEqual(comment_ids, [str(comment.id) for comment in
+                                       Comment.objects(message=message_id).order_by('created_at', 'id')])
+
+        replies = service.get_subcomments(first_comment_id, first_comment['subcomments_cursor'], limit=10)
+        self.assertIsNone(replies['next_cursor'])
+        self.assertEqual([subcomment['subcomment_id'] for subcomment in first_comment['subcomments']] +
+                         [subcomment['subcomment_id'] for subcomment in replies['subcomments']],
+                         [str(subcomment.id) for subcomment in
+                          SubComment.objects(parent_comment=first_comment_id).order_by('created_at', 'id')])
+
+        service.like(11, first_comment_id, 'comment', 1)
+        self.assertEqual(service.get_message_comments(message_id, user_id=11)['liked_ids'], [first_comment_id])
+
+    def test_page_of_long_threads_stays_within_budget(self):
+        from models import User
+        author = User(username="author", forum_id=10, avatar_url="a.png").save()
+        commenter = User(username="commenter", forum_id=11, avatar_url="c.png").save()
+        for _ in range(10):
+            self.create_thread(author, commenter, comments=TOP_COMMENTS + 1, subcomments=TOP_SUBCOMMENTS + 1)
+        service = UserService()
+        with self.query_budget(4) as profile:
+            page = service.get_recent_messages(limit=10)
+        self.assertEqual(profile.queries, 4)
+        self.assertEqual(len(page['messages']), 10)
+        for thread in page['messages']:
+            self.assertEqual(len(thread['comments']), TOP_COMMENTS)
+            self.assertIsNotNone(thread['comments_cursor'])
+            for comment in thread['comments']:
+                self.assertEqual(len(comment['subcomments']), TOP_SUBCOMMENTS)
+                self.assertIsNotNone(comment['subcomments_cursor'])
+
+    def test_assembled_tree_matches_serializers(self):
+        from models import User, Message, Comment, SubComment
+        from message_manager import MessageManager
+        author = User(username="author", forum_id=10, avatar_url="a.png").save()
+        commenter = User(username="commenter", forum_id=11, avatar_url="c.png").save()
+        message_id = self.create_thread(author, commenter, comments=2, subcomments=2)
+
+        service = UserService()
+        message_dict = service.get_recent_messages()['messages'][0]
+
+        expected = MessageManager.message_to_dict(Message.objects.get(id=message_id))
+        expected['comments'] = [MessageManager.comment_to_dict(comment)
+                                for comment in Comment.objects(message=message_id)]
+        expected.update(comments_count=2, comments_cursor=None)
+        for comment_dict in expected['comments']:
+            comment_dict['subcomments'] = [MessageManager.subcomment_to_dict(subcomment) for subcomment in
+                                           SubComment.objects(parent_comment=comment_dict['comment_id'])]
+            comment_dict.update(subcomments_count=2, subcomments_cursor=None)
+        self.assertEqual(message_dict, expected)
+        self.assertEqual(message_dict['subcomments'], 4)
+        self.assertEqual(message_dict['comments'][0]['username'], "commenter")
+
+    def test_row_serializers_match_document_serializers(self):
+        from models import User, Message, Comment, SubComment
+        from message_manager import MessageManager
+        author = User(username="author", forum_id=10, avatar_url="a.png").save()
+        commenter = User(username="commenter", forum_id=11, avatar_url="c.png").save()
+        self.create_thread(author, commenter, comments=1, subcomments=1)
+        # Документ старой версии: без счётчиков и текста, их заменяют значения по умолчанию
+        Message._get_collection().insert_one({'user': author.id, 'created_at': datetime(2023, 7, 1, 12, 30, 5, 123456)})
+        cached = UserService().user_cache.get_many_by_ids([author.id, commenter.id])
+
+        for model, serializer, row_serializer in (
+                (Message, MessageManager.message_to_dict, MessageManager.message_row_to_dict),
+                (Comment, MessageManager.comment_to_dict, MessageManager.comment_row_to_dict),
+                (SubComment, MessageManager.subcomment_to_dict, MessageManager.subcomment_row_to_dict)):
+            documents = list(model.objects.order_by('id'))
+            rows = list(model.objects.order_by('id').as_pymongo())
+            for document, row in zip(documents, rows):
+                for author_of in (lambda user_id: cached[user_id], lambda user_id: None):
+                    self.assertEqual(row_serializer(row, author_of(row['user'])),
+                                     serializer(document, author=author_of(document.user.id)))
+
+    def test_feed_and_thread_reads_build_no_documents(self):
+        from mongoengine.base import BaseDocument
+        from models import User, Comment
+        author = User(username="author", forum_id=10, avatar_url="a.png").save()
+        commenter = User(username="commenter", forum_id=11, avatar_url="c.png").save()
+        message_id = self.create_thread(author, commenter, comments=5, subcomments=5)
+        comment_id = str(Comment.objects(message=message_id).first().id)
+        service = UserService()
+        service.get_recent_messages(user_id=11)
+        service.feed_cache.clear()
+
+        with patch.object(BaseDocument, '__init__', autospec=True, side_effect=BaseDocument.__init__) as init:
+            page = service.get_recent_messages(user_id=11)
+            comments = service.get_message_comments(message_id, page['messages'][0]['comments_cursor'])
+            replies = service.get_subcomments(comment_id, page['messages'][0]['comments'][0]['subcomments_cursor'])
+        self.assertEqual((len(comments['comments']), len(replies['subcomments'])), (2, 2))
+        # Пользователи уже в кэше, а твиты, комментарии и ответы приходят словарями
+        self.assertEqual(init.call_count, 0)
+
+
+class TestQueryProfiler(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from models import User
+        from query_profiler import QueryProfiler
+        self.author = User(username="author", forum_id=10, avatar_url="a.png").save()
+        self.reader = User(username="reader", forum_id=11, avatar_url="r.png").save()
+        self.profiler = QueryProfiler(max_queries=3, max_ms=None)
+
+    @staticmethod
+    def command(name, reply=None, duration=1000):
+        return Mock(command_name=name, reply=reply or {}, duration_micros=duration)
+
+    def test_feed_page_query_budget(self):
+        service = UserService()
+        for i in range(5):
+            message_id = service.create_message(10, f"tweet {i}")
+            comment_id = service.create_comment(11, message_id, "comment")
+            service.create_subcomment(10, comment_id, "reply")
+            service.like(11, message_id, "tweet", 1)
+
+        service.user_cache.clear()
+        # Холодная лента: твиты, комментарии, сабкомментарии и авторы
+        with self.query_budget(5) as profile:
+            service.get_recent_messages()
+        self.assertEqual(profile.dereferences, 0)
+        # Страница из кэша ленты: читатель и его лайки по одному запросу на коллекцию
+        with self.query_budget(4):
+            service.get_recent_messages(user_id=11)
+
+    def test_lazy_references_are_counted_as_dereferences(self):
+        from models import Message
+        service = UserService()
+        message_id = service.create_message(10, "tweet")
+        with profiler.profile('dereference') as profile:
+            self.assertEqual(Message.objects.get(id=message_id).user.username, "author")
+        self.assertEqual(profile.dereferences, 1)
+
+    def test_listener_charges_commands_to_current_profile(self):
+        self.profiler.started(self.command('find'))
+        with self.profiler.profile('get recent messages') as profile:
+            self.profiler.started(self.command('find'))
+            self.profiler.succeeded(self.command('find', {'cursor': {'firstBatch': [{}, {}]}}, duration=1500))
+            self.profiler.started(self.command('hello'))
+            self.profiler.succeeded(self.command('hello'))
+            self.profiler.started(self.command('update'))
+            self.profiler.failed(self.command('update', duration=500))
+        self.assertEqual((profile.queries, profile.documents, profile.db_time), (2, 2, 0.002))
+
+    def test_profile_follows_calls_into_executor_threads(self):
+        from db_executor import DBExecutor
+        executor = DBExecutor('threads')
+        with self.profiler.profile('like message') as profile:
+            executor.run(self.profiler.started, self.command('update'))
+        executor.pool.shutdown()
+        self.assertEqual(profile.queries, 1)
+
+    def test_over_budget_handlers_are_logged_and_aggregated(self):
+        with self.assertLogs('query_profiler', 'WARNING') as logs:
+            for queries in (1, 5):
+                with self.profiler.profile('get recent messages'):
+                    for _ in range(queries):
+                        self.profiler.started(self.command('find'))
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("5 queries", logs.output[0])
+
+        stats = self.profiler.stats()['handlers']['get recent messages']
+        self.assertEqual((stats['count'], stats['queries'], stats['queries_max'], stats['queries_avg'],
+                          stats['over_budget']), (2, 6, 5, 3.0, 1))
+
+
+class TestUserCache(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from models import User
+        self.author = User(username="author", forum_id=10, avatar_url="a.png").save()
+        self.other = User(username="other", forum_id=11, avatar_url="o.png").save()
+        self.service = UserService()
+
+    def test_warm_path_does_not_query_users(self):
+        message_id = self.service.create_message(10, "tweet")
+        self.service.like(11, message_id, "tweet", 1)
+        self.service.get_recent_messages()
+
+        patcher, counter = self.count_finds()
+        with patcher:
+            self.assertTrue(self.service.user_exists(10))
+            self.service.get_likes(11, message_id, "tweet")
+            self.service.get_recent_messages(user_id=11)
+        # Счётчик и лайк сообщения, лайки пользователя на странице: пользователи и сама лента уже в памяти
+        self.assertEqual(counter['find_one'], 0)
+        self.assertEqual(counter['find'], 3)
+        self.assertGreater(self.service.user_cache.stats()['hits'], 0)
+
+    def test_counts_hits_and_misses(self):
+        self.service.user_cache.get(10)
+        self.service.user_cache.get(10)
+        self.service.user_cache.get(12)
+        self.assertEqual(self.service.user_cache.stats(), {"size": 1, "hits": 1, "misses": 2})
+
+    def test_read_racing_invalidate_is_not_cached(self):
+        from user_cache import UserCache
+        snapshot = UserCache.snapshot
+        writes = []
+
+        def snapshot_then_rename(user):
+            cached = snapshot(user)
+            # Старый документ уже прочитан, а обновление с invalidate() успевает до записи в кэш
+            if not writes:
+                writes.append(user.forum_id)
+                self.service.update_username_and_avatar(user.forum_id, f"renamed{user.forum_id}", "r.png")
+            return cached
+
+        with patch.object(UserCache, 'snapshot', staticmethod(snapshot_then_rename)):
+            self.assertEqual(self.service.user_cache.get(10).username, "author")
+        self.assertEqual(writes, [10])
+        self.assertEqual(self.service.user_cache.get(10).username, "renamed10")
+
+        with patch.object(UserCache, 'snapshot', staticmethod(snapshot_then_rename)):
+            writes.clear()
+            self.service.user_cache.clear()
+            self.assertEqual(self.service.user_cache.get_many_by_ids([self.other.id])[self.other.id].username,
+                             "other")
+        self.assertEqual(self.service.user_cache.get_many_by_ids([self.other.id])[self.other.id].username,
+                         "renamed11")
+
+    def test_update_invalidates(self):
+        self.assertEqual(self.service.get_user(10).username, "author")
+        self.service.update_username_and_avatar(10, "renamed", "r.png")
+        cached = self.service.get_user(10)
+        self.assertEqual((cached.username, cached.avatar_url), ("renamed", "r.png"))
+
+    def test_ban_and_unban_invalidate(self):
+        self.assertFalse(self.service.get_user(11).banned)
+        self.service.ban_user(11)
+        self.assertTrue(self.service.get_user(11).banned)
+        self.service.unban_user(11)
+        self.assertFalse(self.service.get_user(11).banned)
+        with self.assertRaises(ValueError):
+            self.service.ban_user(404)
+
+    def test_ignore_and_unignore_invalidate(self):
+        self.service.create_message(11, "hidden")
+        self.assertEqual(len(self.service.get_recent_messages(user_id=10)['messages']), 1)
+
+        self.service.ignore_user(10, 11)
+        self.assertEqual(self.service.get_user(10).ignored_ids, frozenset([self.other.id]))
+        self.assertEqual(self.service.get_recent_messages(user_id=10)['messages'], [])
+        self.assertEqual([user['id'] for user in self.service.get_ignored_users(10)], [11])
+
+        self.service.unignore_user(10, 11)
+        self.assertEqual(self.service.get_user(10).ignored_ids, frozenset())
+        self.assertEqual(len(self.service.get_recent_messages(user_id=10)['messages']), 1)
+
+
+class TestInvalidationBus(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from models import User
+        User(username="author", forum_id=10, avatar_url="a.png").save()
+        User(username="other", forum_id=11, avatar_url="o.png").save()
+        # Два воркера, подключённые к одной очереди
+        hub = []
+        self.worker_a = UserService(InMemoryBus(hub))
+        self.worker_b = UserService(InMemoryBus(hub))
+
+    def test_ban_on_one_worker_reaches_the_other(self):
+        self.assertFalse(self.worker_a.get_user(11).banned)
+        self.worker_b.ban_user(11)
+        with self.assertRaises(PermissionError):
+            self.worker_a.check_ban_status(11)
+        self.worker_b.unban_user(11)
+        self.assertFalse(self.worker_a.get_user(11).banned)
+
+    def test_profile_and_ignore_updates_reach_the_other(self):
+        self.worker_a.get_user(10)
+        self.worker_b.update_username_and_avatar(10, "renamed", "r.png")
+        self.assertEqual(self.worker_a.get_user(10).username, "renamed")
+
+        self.worker_b.create_message(11, "hidden")
+        self.assertEqual(len(self.worker_a.get_recent_messages(user_id=10)['messages']), 1)
+        self.worker_b.ignore_user(10, 11)
+        self.assertEqual(self.worker_a.get_recent_messages(user_id=10)['messages'], [])
+
+    def test_failing_handler_does_not_block_others(self):
+        bus = InMemoryBus()
+        received = []
+        bus.subscribe('users', Mock(side_effect=RuntimeError))
+        bus.subscribe('users', received.append)
+        bus.publish('users', 10)
+        self.assertEqual(received, [10])
+
+    def test_backend_selection(self):
+        from invalidation_bus import create_bus, socketio_queue_options, MongoBus, MongoManager
+        self.assertIsInstance(create_bus(None), InMemoryBus)
+        self.assertIsInstance(create_bus('mongodb://localhost:27017/mybb_twitter'), MongoBus)
+        with self.assertRaises(ValueError):
+            create_bus('redis://localhost')
+        self.assertEqual(socketio_queue_options(None), {})
+        self.assertEqual(socketio_queue_options('redis://localhost'), {'message_queue': 'redis://localhost'})
+        self.assertIsInstance(socketio_queue_options('mongodb://localhost')['client_manager'], MongoManager)
+
+    def test_listener_resumes_after_its_position(self):
+        from invalidation_bus import CappedCollection, CAPPED_QUEUE_BYTES
+        self.assertEqual(CappedCollection('mongodb://localhost', 'queue').size, CAPPED_QUEUE_BYTES)
+        transport = CappedCollection('mongodb://localhost', 'queue', size=4096)
+        transport.RETRY_INTERVAL = 0
+
+        class Cursor:
+            """Tailable cursor that dies after its documents, like one lost to a network error"""
+            def __init__(self, documents):
+                self.documents = documents
+                self.alive = True
+
+            def __iter__(self):
+                self.alive = False
+                return iter(self.documents)
+
+        # Последний документ при старте — 150; после потери курсора самые старые уже вытеснены до 200
+        collection = Mock(**{'find_one.side_effect': [{'seq': 150}, {'seq': 40}, {'seq': 200}],
+                             'find.side_effect': [Cursor([{'seq': 60}, {'seq': 151}, {'seq': 152}]),
+                                                  Cursor([{'seq': 151}, {'seq': 200}])]})
+        with patch.object(transport, 'collection', return_value=collection), \
+                self.assertLogs('invalidation_bus', 'WARNING'):
+            listener = transport.listen()
+            self.assertEqual([next(listener)['seq'] for _ in range(3)], [151, 152, 200])
+        # Сервер сам отбрасывает всё до позиции слушателя, с небольшим запасом на гонку номеров
+        queries = [find_call.args[0] for find_call in collection.find.call_args_list]
+        overlap = transport.RESUME_OVERLAP
+        self.assertEqual(queries, [{'seq': {'$gt': 150 - overlap}}, {'seq': {'$gt': 152 - overlap}}])
+        self.assertEqual(transport.overruns, 1)
+
+    def test_published_documents_are_numbered(self):
+        from invalidation_bus import CappedCollection
+        transport = CappedCollection('mongodb://localhost', 'queue')
+        transport.db = mongomock.MongoClient().mybb_twitter
+        for payload in ('a', 'b'):
+            transport.publish({'payload': payload})
+        self.assertEqual([(document['payload'], document['seq']) for document in transport.db['queue'].find()],
+                         [('a', 1), ('b', 2)])
+
+    @unittest.skipUnless(MONGODB_TEST_URI, "tailable cursors need a real mongod")
+    def test_mongo_bus_delivers_between_workers(self):
+        from invalidation_bus import MongoBus
+        url = MONGODB_TEST_URI.rstrip('/') + '/mybb_twitter_test'
+        publisher, subscriber = MongoBus(url), MongoBus(url)
+        received = threading.Event()
+        subscriber.subscribe('users', lambda forum_id: forum_id == 10 and received.set())
+        # Подписчик начинает с последнего документа: даём ему открыть курсор
+        time.sleep(1)
+        publisher.publish('users', 10)
+        self.assertTrue(received.wait(5))
+
+
+class TestFeedCache(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from models import User
+        User(username="author", forum_id=10, avatar_url="a.png").save()
+        User(username="other", forum_id=11, avatar_url="o.png").save()
+        hub = []
+        self.service = UserService(InMemoryBus(hub))
+        self.writer = UserService(InMemoryBus(hub))
+
+    def assertServedFromCache(self, like_lookups=0, **kwargs):
+        """
+        Страница из кэша совпадает со свежесобранной; к базе идут только запросы
+        личного состояния лайков — по одному на коллекцию
+        """
+        expected = UserService().get_recent_messages(limit=3, **kwargs)
+        patcher, counter = self.count_finds()
+        with patcher:
+            page = self.service.get_recent_messages(limit=3, **kwargs)
+        self.assertEqual(page, expected)
+        self.assertEqual(counter, {'find': like_lookups, 'find_one': 0})
+
+    def test_first_page_is_patched_in_place(self):
+        messages = [self.writer.create_message(10, f"tweet {i}") for i in range(4)]
+        self.service.get_recent_messages(limit=3)
+        self.assertServedFromCache()
+
+        comment_id = self.writer.create_comment(11, messages[-1], "comment")
+        subcomment_id = self.writer.create_subcomment(10, comment_id, "subcomment")
+        other_comment_id = self.writer.create_comment(10, messages[-1], "other comment")
+        self.writer.create_subcomment(11, other_comment_id, "other subcomment")
+        self.assertServedFromCache()
+
+        self.writer.like(11, messages[-1], "tweet", 1)
+        self.writer.like(11, comment_id, "comment", 1)
+        self.writer.like(10, subcomment_id, "subcomment", 1)
+        self.writer.remove_like(11, comment_id, "comment")
+        self.assertServedFromCache()
+
+        self.writer.edit_message(messages[-1], 10, "edited tweet")
+        self.writer.update_comment(comment_id, 11, "edited comment")
+        self.writer.edit_subcomment(subcomment_id, 10, "edited subcomment")
+        self.assertServedFromCache()
+
+        self.writer.delete_subcomment(subcomment_id, 10)
+        self.writer.delete_comment(other_comment_id, 10)
+        self.assertServedFromCache()
+
+        self.writer.create_message(11, "newest")
+        self.assertServedFromCache()
+
+    def test_late_events_do_not_duplicate_items(self):
+        # Отдельная шина писателя: его события доходят до читателя только когда их доставит тест
+        late = []
+        writer = UserService(InMemoryBus())
+        writer.bus.subscribe(FEED_CHANNEL, late.append)
+        writer.create_message(10, "old")
+        message_id = writer.create_message(10, "new")
+        comment_id = writer.create_comment(11, message_id, "comment")
+        writer.create_subcomment(10, comment_id, "reply")
+
+        # Страница собрана после сохранения, а события приходят следом, одно из них дважды
+        self.service.get_recent_messages(limit=3)
+        for event in late + late[-1:]:
+            self.service.apply_feed_event(event)
+        self.assertServedFromCache()
+        thread = self.service.get_recent_messages(limit=3)['messages'][0]
+        self.assertEqual((thread['comments_count'], thread['subcomments']), (1, 1))
+        self.assertEqual(thread['comments'][0]['subcomments_count'], 1)
+
+    def test_long_threads_stay_cut_in_cached_pages(self):
+        message_id = self.writer.create_message(10, "tweet")
+        self.service.get_recent_messages(limit=3)
+        comment_ids = [self.writer.create_comment(11, message_id, f"comment {i}") for i in range(TOP_COMMENTS + 2)]
+        reply_ids = [self.writer.create_subcomment(10, comment_ids[0], f"reply {i}")
+                     for i in range(TOP_SUBCOMMENTS + 1)]
+        self.assertServedFromCache()
+        thread = self.service.get_recent_messages(limit=3)['messages'][0]
+        self.assertEqual(len(thread['comments']), TOP_COMMENTS)
+        self.assertEqual(thread['comments_count'], TOP_COMMENTS + 2)
+
+        # Скрытые элементы удаляются без пересборки страницы
+        self.writer.delete_comment(comment_ids[-1], 11)
+        self.writer.delete_subcomment(reply_ids[-1], 10)
+        self.assertServedFromCache()
+
+        # На место показанного встал бы скрытый комментарий, поэтому страница собирается заново
+        self.writer.delete_comment(comment_ids[1], 11)
+        self.assertEqual(self.service.feed_cache.stats()['size'], 0)
+        self.service.get_recent_messages(limit=3)
+        self.assertServedFromCache()
+
+    def test_ignored_authors_do_not_enter_their_pages(self):
+        self.writer.create_message(10, "tweet")
+        self.writer.ignore_user(11, 10)
+        self.service.get_recent_messages(limit=3, user_id=11)
+        self.service.get_recent_messages(limit=3)
+
+        self.writer.create_message(10, "hidden from 11")
+        self.writer.create_message(11, "visible to all")
+        self.assertServedFromCache(like_lookups=1, user_id=11)
+        self.assertServedFromCache()
+
+    def test_readers_share_one_page_without_ignored_authors(self):
+        message_id = self.writer.create_message(11, "tweet")
+        comment_id = self.writer.create_comment(10, message_id, "hidden comment")
+        self.writer.create_subcomment(10, self.writer.create_comment(11, message_id, "comment"), "hidden reply")
+        self.writer.create_subcomment(11, comment_id, "reply under a hidden comment")
+        self.writer.ignore_user(11, 10)
+
+        self.service.get_recent_messages(limit=3)
+        page = self.service.get_recent_messages(limit=3, user_id=11)
+        self.assertEqual(self.service.feed_cache.stats()['size'], 1)
+        thread = page['messages'][0]
+        self.assertEqual([comment['content'] for comment in thread['comments']], ["comment"])
+        self.assertEqual(thread['comments_count'], 1)
+        self.assertEqual(thread['comments'][0]['subcomments'], [])
+        self.assertEqual(thread['comments'][0]['subcomments_count'], 0)
+        self.assertEqual(len(self.service.get_recent_messages(limit=3)['messages'][0]['comments']), 2)
+        self.assertEqual([comment['content'] for comment in
+                          self.service.get_message_comments(message_id, user_id=11)['comments']], ["comment"])
+
+    def test_page_of_ignored_authors_is_refilled(self):
+        older = [self.writer.create_message(11, f"older {i}") for i in range(2)]
+        for i in range(4):
+            self.writer.create_message(10, f"newer {i}")
+        self.writer.ignore_user(11, 10)
+
+        with self.query_budget(7):
+            page = self.service.get_recent_messages(limit=3, user_id=11)
+        self.assertEqual([message['message_id'] for message in page['messages']], older[::-1])
+        self.assertFalse(page['has_more_messages'])
+
+    def test_deleting_from_a_full_page_rebuilds_it(self):
+        messages = [self.writer.create_message(10, f"tweet {i}") for i in range(4)]
+        self.service.get_recent_messages(limit=3)
+        self.writer.delete_message(messages[-1], 10)
+        self.assertEqual(self.service.feed_cache.stats()['size'], 0)
+        page = self.service.get_recent_messages(limit=3)
+        self.assertEqual(page, UserService().get_recent_messages(limit=3))
+        self.assertFalse(page['has_more_messages'])
+
+        self.writer.delete_message(messages[-2], 10)
+        self.assertServedFromCache()
+
+    def test_rename_drops_pages_showing_the_author(self):
+        self.writer.create_message(10, "tweet")
+        self.service.get_recent_messages(limit=3)
+        self.writer.update_username_and_avatar(10, "renamed", "r.png")
+        self.assertEqual(self.service.get_recent_messages(limit=3)['messages'][0]['username'], "renamed")
+
+    def test_cached_page_is_reused_until_an_event(self):
+        message_id = self.writer.create_message(10, "tweet")
+        self.service.get_recent_messages(limit=3)
+        feed_cache = self.service.feed_cache
+        first = feed_cache.get(3)
+        self.assertIs(feed_cache.get(3), first)
+        self.assertEqual(feed_cache.get(3, relative_times=True)['messages'][0]['created_ago'],
+                         "только что")
+
+        self.writer.like(11, message_id, "tweet", 1)
+        self.assertIsNot(feed_cache.get(3), first)
+        self.assertEqual(feed_cache.get(3)['messages'][0]['likes'], 1)
+
+    def test_page_built_during_a_write_is_not_stored(self):
+        self.writer.create_message(10, "tweet")
+        version = self.service.feed_cache.version
+        self.writer.create_message(10, "concurrent write")
+        self.service.feed_cache.store(3, [], False, version)
+        self.assertIsNone(self.service.feed_cache.get(3))
+
+
+class TestCounters(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from models import User
+        self.author = User(username="author", forum_id=10, avatar_url="a.png").save()
+        self.reader = User(username="reader", forum_id=11, avatar_url="r.png").save()
+        self.service = UserService()
+
+    def test_write_paths_maintain_counters(self):
+        from models import Message, Comment
+        message_id = self.service.create_message(10, "tweet")
+        comment_id = self.service.create_comment(11, message_id, "comment")
+        subcomment_id = self.service.create_subcomment(10, comment_id, "reply")
+        self.service.create_subcomment(11, comment_id, "reply 2")
+        self.service.like(11, message_id, 'tweet', 1)
+        self.service.like(10, comment_id, 'comment', 1)
+
+        message = Message.objects.get(id=message_id)
+        comment = Comment.objects.get(id=comment_id)
+        self.assertEqual((message.comments_count, message.subcomments_count, message.likes_count), (1, 2, 1))
+        self.assertEqual((comment.subcomments_count, comment.likes_count), (2, 1))
+
+        self.service.delete_subcomment(subcomment_id, 10)
+        self.service.remove_like(11, message_id, 'tweet')
+        message.reload()
+        self.assertEqual((message.comments_count, message.subcomments_count, message.likes_count), (1, 1, 0))
+
+        self.service.delete_comment(comment_id, 11)
+        message.reload()
+        self.assertEqual((message.comments_count, message.subcomments_count), (0, 0))
+
+    def test_serializing_feed_runs_no_aggregation(self):
+        message_id = self.service.create_message(10, "tweet")
+        self.service.create_comment(11, message_id, "comment")
+        if MONGODB_TEST_URI:
+            self.skipTest("aggregation spying relies on mongomock")
+        pipelines = []
+        aggregate = mongomock.collection.Collection.aggregate
+
+        def recorded(collection, pipeline, *args, **kwargs):
+            pipelines.append(pipeline)
+            return aggregate(collection, pipeline, *args, **kwargs)
+
+        with patch.object(mongomock.collection.Collection, 'aggregate', recorded):
+            message_dict = self.service.get_recent_messages()['messages'][0]
+        # Агрегации только читают первые дочерние документы; счётчики берутся из полей, а не считаются
+        self.assertTrue(pipelines)
+        self.assertNotIn('$sum', repr(pipelines))
+        self.assertNotIn('$count', repr(pipelines))
+        self.assertEqual(message_dict['likes'], 0)
+        self.assertEqual(len(message_dict['comments']), 1)
+
+    def test_repair_counters(self):
+        from models import Message, Comment, SubComment, Like
+        from maintenance import repair_counters
+        message = Message(user=self.author, content="tweet").save()
+        Like(target_type='tweet', target_id=message.id, user=self.reader).save()
+        comment = Comment(user=self.reader, message=message, content="comment").save()
+        SubComment(user=self.author, parent_comment=comment, content="reply").save()
+        reply = SubComment(user=self.author, parent_comment=comment, content="reply 2").save()
+        Like(target_type='subcomment', target_id=reply.id, user=self.reader).save()
+
+        repair_counters()
+
+        message.reload()
+        comment.reload()
+        self.assertEqual((message.likes_count, message.comments_count, message.subcomments_count), (1, 1, 2))
+        self.assertEqual((comment.likes_count, comment.subcomments_count), (0, 2))
+        self.assertEqual(sorted(SubComment.objects.scalar('likes_count')), [0, 1])
+        self.author.reload()
+        self.assertEqual((self.author.messages_count, self.author.comments_count, self.author.likes_received),
+                         (1, 2, 2))
+
+    def test_migrate_embedded_likes(self):
+        from models import Message, Comment, Like
+        from maintenance import migrate_likes
+        message = Message(user=self.author, content="tweet").save()
+        comment = Comment(user=self.reader, message=message, content="comment").save()
+        # Документы в старом формате: лайки внутри самой цели
+        Message._get_collection().update_one({'_id': message.id}, {'$set': {'likes': [
+            {'user': self.reader.id, 'value': 1}, {'user': self.author.id, 'value': 1}]}})
+        Comment._get_collection().update_one({'_id': comment.id}, {'$set': {'likes': [
+            {'user': self.author.id, 'value': 1}]}})
+
+        migrated = migrate_likes()
+
+        self.assertEqual((migrated['tweet'], migrated['comment'], migrated['subcomment']), (2, 1, 0))
+        self.assertEqual(Message._get_collection().count_documents({'likes': {'$exists': True}}), 0)
+        self.assertEqual(sorted((like.target_type, like.user.id) for like in Like.objects),
+                         sorted([('tweet', self.reader.id), ('tweet', self.author.id), ('comment', self.author.id)]))
+        message.reload()
+        comment.reload()
+        self.assertEqual((message.likes_count, comment.likes_count), (2, 1))
+        self.author.reload()
+        self.assertEqual(self.author.likes_received, 2)
+        # Повторный запуск ничего не дублирует
+        self.assertEqual(migrate_likes()['tweet'], 0)
+        self.assertEqual(Like.objects.count(), 3)
+
+    def test_leaderboard_follows_write_paths(self):
+        from maintenance import repair_counters
+        message_id = self.service.create_message(10, "tweet")
+        comment_id = self.service.create_comment(11, message_id, "comment")
+        self.service.create_subcomment(10, comment_id, "reply")
+        self.service.like(11, message_id, 'tweet', 1)
+        self.service.like(10, comment_id, 'comment', 1)
+        self.service.create_message(11, "another tweet")
+        self.service.create_message(11, "third tweet")
+        self.service.delete_message(self.service.create_message(10, "deleted"), 10)
+
+        top = Leaderboard(ttl=0).top()
+        self.assertEqual([(user["id"], user["messages"], user["comments"], user["likes"]) for user in top],
+                         [(11, 2, 1, 1), (10, 1, 1, 1)])
+
+        # Каскадное удаление твита забирает очки и у комментаторов
+        self.service.delete_message(message_id, 10)
+        top = Leaderboard(ttl=0).top()
+        self.assertEqual([(user["id"], user["messages"], user["comments"], user["likes"]) for user in top],
+                         [(11, 2, 0, 0), (10, 0, 0, 0)])
+        repair_counters()
+        self.assertEqual(Leaderboard(ttl=0).top(), top)
+
+
+class TestPurge(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from models import User
+        from purge import PurgeWorker
+        for forum_id in (10, 11):
+            User(username=f"user{forum_id}", forum_id=forum_id, avatar_url="a.png").save()
+        self.purge = PurgeWorker(batch_size=300)
+        self.service = UserService(purge=self.purge)
+
+    def big_thread(self, replies: int) -> tuple:
+        from models import User, SubComment
+        from maintenance import repair_counters
+        message_id = self.service.create_message(10, "tweet")
+        comment_ids = [self.service.create_comment(11, message_id, "comment") for _ in range(2)]
+        replier = User.objects.get(forum_id=10).id
+        SubComment._get_collection().insert_many([
+            {'user': replier, 'parent_comment': ObjectId(comment_ids[index % 2]), 'content': "reply",
+             'created_at': datetime.utcnow(), 'likes_count': 0} for index in range(replies)])
+        self.service.like(10, comment_ids[0], 'comment', 1)
+        self.service.like(11, message_id, 'tweet', 1)
+        self.service.report_comment(10, comment_ids[0], "spam")
+        # Ответы вставлены в обход сервиса: счётчики и рейтинг догоняем пересчётом
+        repair_counters()
+        return message_id, comment_ids
+
+    def test_deleting_a_big_thread_only_writes_a_tombstone(self):
+        from models import Comment, SubComment, Like, Report, Purge
+        message_id, comment_ids = self.big_thread(1000)
+        self.service.get_recent_messages()
+
+        with patch.object(self.purge, 'wake') as wake, self.query_budget(6):
+            self.service.delete_message(message_id, 10)
+        wake.assert_called_once()
+        self.assertEqual(SubComment.objects.count(), 1000)
+
+        # Лента и дочитывание треда не видят удалённое, пока зависимые документы ещё на месте
+        self.assertEqual(self.service.get_recent_messages()['messages'], [])
+        self.assertEqual(self.service.get_message_comments(message_id)['comments'], [])
+        self.assertEqual(self.service.get_subcomments(comment_ids[0])['subcomments'], [])
+        self.assertEqual([(row['target_type'], row['removed']) for row in self.service.get_purge_status()['pending']],
+                         [('tweet', 0)])
+
+        self.purge.wake()
+        thread = self.purge.thread
+        if thread is not None:
+            thread.join(10)
+        self.assertEqual([model.objects.count() for model in (Comment, SubComment, Like, Report, Purge)],
+                         [0, 0, 0, 0, 0])
+        stats = self.service.get_purge_status()
+        self.assertEqual((stats['removed'], stats['batches'], stats['completed'], stats['pending']),
+                         ({'sub_comment': 1000, 'comment': 2}, 5, 1, []))
+        # Авторы вычищенных комментариев и ответов теряют очки рейтинга
+        top = Leaderboard(ttl=0).top()
+        self.assertEqual(sorted((user["id"], user["messages"], user["comments"], user["likes"]) for user in top),
+                         [(10, 0, 0, 0), (11, 0, 0, 0)])
+
+    def test_deleted_comment_takes_its_replies(self):
+        from models import Message, SubComment, Like, Report
+        message_id, comment_ids = self.big_thread(10)
+        self.purge.background = False
+        self.service.delete_comment(comment_ids[0], 11)
+        self.assertEqual(SubComment.objects(parent_comment=ObjectId(comment_ids[1])).count(), 5)
+        self.assertEqual(SubComment.objects.count(), 5)
+        self.assertEqual((Like.objects.count(), Report.objects.count()), (1, 0))
+        message = Message.objects.get(id=message_id)
+        self.assertEqual((message.comments_count, message.subcomments_count), (1, 5))
+
+    def test_tombstone_of_a_stopped_worker_is_resumed(self):
+        from models import Message, Comment, Purge
+        message_id, _ = self.big_thread(10)
+        # Прошлый процесс поставил надгробие, но не успел удалить твит и истёк срок его аренды
+        Purge(target_type='tweet', target_id=ObjectId(message_id), leased_until=datetime(2000, 1, 1)).save()
+        other = Purge(target_type='comment', target_id=ObjectId(), leased_until=datetime(2100, 1, 1)).save()
+
+        self.assertEqual(self.purge.drain(), 1)
+        self.assertEqual((Message.objects.count(), Comment.objects.count()), (0, 0))
+        # Надгробие, которое держит другой воркер, не трогаем
+        self.assertEqual(list(Purge.objects.scalar('id')), [other.id])
+
+    def test_failed_purge_is_retried_after_the_lease(self):
+        from models import Message, Comment, Purge
+        from purge import PurgeWorker
+        message_id, _ = self.big_thread(10)
+        self.purge = PurgeWorker(lease=0.05)
+        purge = self.purge.purge
+        calls = []
+
+        def flaky(tombstone):
+            calls.append(tombstone.target_id)
+            if len(calls) == 1:
+                raise RuntimeError("connection reset")
+            purge(tombstone)
+
+        with patch.object(self.purge, 'purge', flaky):
+            UserService(purge=self.purge).delete_message(message_id, 10)
+            deadline = time.monotonic() + 5
+            while not self.purge.completed and time.monotonic() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual((self.purge.failures, self.purge.completed), (1, 1))
+        self.assertEqual((Message.objects.count(), Comment.objects.count(), Purge.objects.count()), (0, 0, 0))
+
+
+class TestConcurrentLikes(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.service = UserService()
+        for forum_id in range(1, 17):
+            self.service.create_user(forum_id, f"user{forum_id}", "avatar.png")
+        self.message_id = self.service.create_message(1, "tweet")
+        self.comment_id = self.service.create_comment(2, self.message_id, "comment")
+        self.subcomment_id = self.service.create_subcomment(3, self.comment_id, "reply")
+
+    def run_in_parallel(self, calls):
+        barrier = threading.Barrier(len(calls))
+        errors = []
+
+        def worker(call):
+            barrier.wait()
+            try:
+                call()
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(call,)) for call in calls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def stored_likes(self, message_type, message_id):
+        from models import Like
+        document = self.service.get_model_by_type(message_type).objects.get(id=message_id)
+        likes = Like.objects(target_type=message_type, target_id=ObjectId(message_id))
+        return document.likes_count, [like.user.forum_id for like in likes]
+
+    def test_parallel_clicks_of_one_user_like_once(self):
+        for message_type, message_id in (('tweet', self.message_id), ('comment', self.comment_id),
+                                         ('subcomment', self.subcomment_id)):
+            errors = self.run_in_parallel(
+                [lambda: self.service.like(5, message_id, message_type, 1) for _ in range(16)])
+            self.assertEqual(len(errors), 15)
+            self.assertEqual(self.stored_likes(message_type, message_id), (1, [5]))
+
+    def test_parallel_likes_of_many_users_are_all_counted(self):
+        errors = self.run_in_parallel(
+            [lambda forum_id=forum_id: self.service.like(forum_id, self.message_id, 'tweet', 1)
+             for forum_id in range(1, 17)])
+        self.assertEqual(errors, [])
+        likes_count, likers = self.stored_likes('tweet', self.message_id)
+        self.assertEqual(likes_count, 16)
+        self.assertEqual(sorted(likers), list(range(1, 17)))
+
+        errors = self.run_in_parallel(
+            [lambda forum_id=forum_id: self.service.remove_like(forum_id, self.message_id, 'tweet')
+             for forum_id in range(1, 17)] * 2)
+        self.assertEqual(len(errors), 16)
+        self.assertEqual(self.stored_likes('tweet', self.message_id), (0, []))
+
+
+class SocketTestCase(MongoTestCase):
+    """
+    Runs socket events through flask-socketio test clients against the in-memory database
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        import server
+        cls.app = server.app
+        cls.socketio = server.socketio
+        super().setUpClass()
+
+    def setUp(self):
+        super().setUp()
+        # Сервис из views живёт между тестами, а база пересоздаётся
+        import views
+        views.user_service.user_cache.clear()
+        views.user_service.feed_cache.clear()
+
+    def connect(self, user_id, username=None):
+        UserService().create_user(user_id, username or f"user{user_id}", "avatar.png")
+        client = self.socketio.test_client(self.app)
+        client.emit('join', {'room': 'room', 'user_id': user_id})
+        return client
+
+    @staticmethod
+    def received(client):
+        return [packet['name'] for packet in client.get_received()]
+
+
+class TestRoomRouting(SocketTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.author = self.connect(1)
+        self.reader = self.connect(2)
+        self.author.emit('create message', {'user_id': 1, 'username': 'user1', 'avatar_url': 'avatar.png',
+                                            'content': 'tweet'})
+        self.message_id = self.author.get_received()[0]['args'][0]['message_id']
+        self.reader.get_received()
+
+    def test_new_tweet_is_broadcast(self):
+        self.author.emit('create message', {'user_id': 1, 'username': 'user1', 'avatar_url': 'avatar.png',
+                                            'content': 'second'})
+        self.assertEqual(self.received(self.author), ['new tweet'])
+        self.assertEqual(self.received(self.reader), ['new tweet'])
+
+    def test_feed_page_goes_only_to_requester(self):
+        self.reader.emit('get recent messages', {'user_id': 2})
+        self.assertEqual(self.received(self.reader), ['recent messages'])
+        self.assertEqual(self.received(self.author), [])
+
+    def test_thread_events_reach_only_thread_subscribers(self):
+        self.reader.emit('join threads', {'message_ids': [self.message_id]})
+        self.author.emit('create comment', {'user_id': 1, 'message_id': self.message_id, 'content': 'comment'})
+        self.assertEqual(self.received(self.reader), ['new comment'])
+        self.assertEqual(self.received(self.author), [])
+
+        self.reader.emit('leave threads', {'message_ids': [self.message_id]})
+        self.author.emit('update message', {'user_id': 1, 'message_id': self.message_id, 'new_content': 'edited'})
+        self.assertEqual(self.received(self.reader), [])
+
+    def test_like_state_is_private_and_count_goes_to_thread(self):
+        self.author.emit('join threads', {'message_ids': [self.message_id]})
+        self.reader.emit('join threads', {'message_ids': [self.message_id]})
+        self.reader.emit('like message', 2, self.message_id, 'tweet')
+
+        self.assertEqual([packet['args'][0]['likes'] for packet in self.reader.get_received()],
+                         [{'total': 1, 'user_liked': True}])
+        # Счётчик для треда копится до конца окна
+        self.assertEqual(self.received(self.author), [])
+
+        import views
+        views.like_emits.flush()
+        expected = [[{'message_type': 'tweet', 'message_id': self.message_id, 'total': 1}]]
+        self.assertEqual([packet['args'][0]['likes'] for packet in self.author.get_received()], expected)
+        self.assertEqual([packet['args'][0]['likes'] for packet in self.reader.get_received()], expected)
+
+    def test_bulk_likes_reply_only_to_requester(self):
+        self.reader.emit('like message', 2, self.message_id, 'tweet')
+        self.reader.get_received()
+        self.reader.emit('get likes', {'user_id': 2, 'items': [['tweet', self.message_id]]})
+        packets = self.reader.get_received()
+        self.assertEqual([packet['name'] for packet in packets], ['likes'])
+        self.assertEqual(packets[0]['args'][0]['likes'],
+                         [{'message_type': 'tweet', 'message_id': self.message_id, 'total': 1, 'user_liked': True}])
+        self.assertEqual(self.received(self.author), [])
+
+    def test_busy_database_is_reported_to_requester(self):
+        import views
+        with patch.object(views.db_executor, 'max_in_flight', 0):
+            self.reader.emit('get recent messages', {'user_id': 2})
+            response = self.app.test_client().post('/get_likes', json={'user_id': 2,
+                                                                       'items': [['tweet', self.message_id]]})
+        packets = self.reader.get_received()
+        self.assertEqual([packet['name'] for packet in packets], ['server busy'])
+        self.assertEqual(packets[0]['args'][0]['event'], 'get recent messages')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.received(self.author), [])
+
+    def test_query_stats_are_admin_only(self):
+        http = self.app.test_client()
+        self.assertEqual(http.get('/admin/query_stats?user_id=3').status_code, 403)
+        response = http.get('/admin/query_stats?user_id=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('create message', response.get_json()['handlers'])
+        self.author.get_received()
+
+        self.author.emit('get query stats', {'user_id': 1})
+        packets = self.author.get_received()
+        self.assertEqual([packet['name'] for packet in packets], ['query stats'])
+        self.assertGreaterEqual(packets[0]['args'][0]['handlers']['create message']['count'], 1)
+
+    def test_metrics_cover_events_emits_rooms_and_caches(self):
+        # Метрики общие для всего процесса, поэтому сравниваем приращения
+        before = self.metric_values()
+        self.connect(3).emit('join threads', {'message_ids': [self.message_id]})
+        self.reader.emit('get recent messages', {'user_id': 2})
+        self.author.emit('create message', {'user_id': 1, 'username': 'user1', 'avatar_url': 'avatar.png',
+                                            'content': 'tweet'})
+        after = self.metric_values()
+
+        def delta(key):
+            return float(after.get(key, 0)) - float(before.get(key, 0))
+
+        self.assertEqual(delta('socketio_event_duration_seconds_count{event="create message"}'), 1)
+        self.assertEqual(delta('socketio_event_duration_seconds_count{event="get recent messages"}'), 1)
+        self.assertEqual(delta('http_request_duration_seconds_count{method="GET",route="/metrics",status="200"}'), 1)
+        # 'new tweet' ушёл каждому подключённому клиенту, включая оставшихся от прошлых тестов
+        self.assertEqual(delta('socketio_emits_total{event="new tweet"}'), float(after['socketio_connected_clients']))
+        self.assertGreater(delta('socketio_emit_bytes_total{event="recent messages"}'), 0)
+        self.assertEqual(delta('socketio_connected_clients'), 1)
+        self.assertEqual(delta('socketio_room_members{kind="thread"}'), 1)
+        self.assertEqual(delta('socketio_room_members{kind="user"}'), 1)
+        self.assertIn('cache_hit_ratio{cache="feed"}', after)
+        self.assertEqual(after['db_executor_in_flight'], '0')
+
+    def metric_values(self) -> dict:
+        body = self.app.test_client().get('/metrics').get_data(as_text=True)
+        return dict(line.rsplit(' ', 1) for line in body.splitlines() if not line.startswith('#'))
+
+
+class TestIndexes(SocketTestCase):
+
+    def test_first_request_builds_missing_indexes(self):
+        import models
+        from models import Like
+        Like.drop_collection()
+        with patch.object(models, 'indexes_ready', False):
+            self.assertNotIn('target_type_1_target_id_1_user_1', Like._get_collection().index_information())
+            self.app.test_client().get('/metrics')
+            self.assertTrue(models.indexes_ready)
+        self.assertIn('target_type_1_target_id_1_user_1', Like._get_collection().index_information())
+
+
+class TestLoadBenchmark(SocketTestCase):
+
+    def test_mix_runs_against_the_app(self):
+        import random
+        import sys
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+        from load import LoadRun, DBOpCounter, MIX, emit
+        run = LoadRun(self.app, self.socketio, clients=3, seed_messages=5, rng=random.Random(1),
+                      counter=DBOpCounter())
+        report = run.report(run.run(60))
+
+        self.assertEqual(report['total']['requests'], 60)
+        self.assertLessEqual(set(report['events']) - {'connect'}, set(MIX))
+        self.assertEqual(sum(stats['errors'] for stats in report['events'].values()), 0)
+        self.assertGreater(report['bytes_emitted_per_client']['mean'], 0)
+
+        # Ответ 404 через сокет не бросает исключение, но считается ошибкой
+        socket = run.clients[0].socket
+        run.timed('get ignored users', lambda: emit(socket, 'get ignored users', {'user_id': 404}))
+        run.timed('get ignored users', lambda: emit(socket, 'get ignored users', {'user_id': 1}))
+        self.assertEqual(run.report(1)['events']['get ignored users']['errors'], 1)
+
+    def test_error_results(self):
+        import sys
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+        from flask import Response
+        from load import is_error
+        self.assertTrue(is_error(({"message": "User does not exist"}, 404)))
+        self.assertTrue(is_error(Response(status=500)))
+        self.assertTrue(is_error({"error": "banned"}))
+        self.assertTrue(is_error({"status": 403}))
+        self.assertFalse(is_error((Response(), 201)))
+        self.assertFalse(is_error({"messages": []}))
+        self.assertFalse(is_error(None))
+
+
+class TestWireFormat(SocketTestCase):
+
+    def setUp(self):
+        super().setUp()
+        import views
+        self.reader = self.connect(1)
+        for user_id in (2, 3):
+            UserService().create_user(user_id, f"user{user_id}", "avatar.png")
+        # Через сервис из views, чтобы его кэш ленты узнал о новых твитах
+        for index in range(4):
+            message_id = views.user_service.create_message(2 + index % 2, f'tweet {index}')
+            for user_id in (2, 3, 2):
+                views.user_service.create_comment(user_id, message_id, 'comment')
+
+    def feed(self, **request) -> dict:
+        self.reader.emit('get recent messages', dict(request, user_id=1))
+        packets = self.reader.get_received()
+        self.assertEqual([packet['name'] for packet in packets], ['recent messages'])
+        return packets[0]['args'][0]
+
+    def test_compact_page_expands_to_the_json_page(self):
+        from wire_format import expand
+        page = self.feed()
+        compact = self.feed(wire='compact')
+
+        # Каждый автор в таблице один раз, элементы ссылаются на него индексом
+        self.assertEqual(sorted(user[0] for user in compact['users']), ['2', '3'])
+        comment = compact['messages'][0]['comments'][0]
+        self.assertNotIn('username', comment)
+        self.assertEqual(compact['users'][comment['user']][0], page['messages'][0]['comments'][0]['user_id'])
+        self.assertEqual(expand(compact), page)
+
+    def test_msgpack_falls_back_to_compact_without_the_package(self):
+        with patch('wire_format.msgpack', None):
+            self.assertIn('users', self.feed(wire='msgpack'))
+
+    def test_msgpack_is_sent_as_bytes(self):
+        from wire_format import compact
+        packb = Mock(return_value=b'packed')
+        with patch('wire_format.msgpack', Mock(packb=packb)):
+            self.assertEqual(self.feed(wire='msgpack'), b'packed')
+        self.assertEqual(packb.call_args.args[0], compact(self.feed()))
+
+    def test_unknown_format_is_rejected(self):
+        self.reader.emit('get recent messages', {'user_id': 1, 'wire': 'xml'})
+        self.assertEqual(self.reader.get_received(), [])
+
+    def test_websocket_deflates_only_large_messages(self):
+        from eventlet.websocket import RFC6455WebSocket
+        from wire_format import deflate_websocket_above
+        self.addCleanup(setattr, RFC6455WebSocket, 'compression_threshold',
+                        getattr(RFC6455WebSocket, 'compression_threshold', 0))
+        self.assertTrue(deflate_websocket_above(100))
+        websocket = RFC6455WebSocket(Mock(), {}, extensions={'permessage-deflate': {}})
+
+        # Бит RSV1 в первом байте кадра помечает сжатое сообщение
+        self.assertFalse(websocket._pack_message('x' * 99)[0] & 0x40)
+        self.assertTrue(websocket._pack_message('x' * 1000)[0] & 0x40)
+        self.assertFalse(websocket._pack_message('x' * 10)[0] & 0x40)
+
+    def test_websocket_patch_fails_loudly_on_other_eventlet(self):
+        from wire_format import deflate_websocket_above
+        # Версия eventlet без приватных методов, которые подменяет патч
+        with patch('eventlet.websocket.RFC6455WebSocket', type('RFC6455WebSocket', (), {})), \
+                self.assertRaises(RuntimeError):
+            deflate_websocket_above(100)
+
+    def test_emitted_bytes_are_the_encoded_packet(self):
+        from metrics import packet_size
+        from metrics_singleton import socket_emit_bytes
+        self.assertEqual(packet_size('2["likes",{"a":1}]'), 18)
+        header = '451-["recent messages",{"_placeholder":true,"num":0}]'
+        self.assertEqual(packet_size([header, b'\x00' * 10]), len(header) + 10)
+
+        before = socket_emit_bytes.merged().get(('probe',), 0)
+        encoded = self.socketio.server.packet_class(2, data=['probe', {'a': 1}]).encode()
+        self.assertEqual(socket_emit_bytes.merged()[('probe',)] - before, len(encoded))
+
+
+class TestResume(SocketTestCase):
+
+    def resume(self, client, **position) -> list:
+        client.emit('resume', dict(position, user_id=2))
+        return client.get_received()
+
+    def test_first_connect_only_gets_the_position(self):
+        from event_log_singleton import event_log
+        before = event_log.stats()
+        packets = self.resume(self.socketio.test_client(self.app))
+        self.assertEqual([packet['name'] for packet in packets], ['resumed'])
+        self.assertFalse(packets[0]['args'][0]['complete'])
+        # Первое подключение не переподключение: в счётчики перезагрузок и возобновлений не попадает
+        after = event_log.stats()
+        self.assertEqual((after['reloads'], after['resumes']), (before['reloads'], before['resumes']))
+
+    def test_reconnect_replays_only_missed_events(self):
+        author = self.connect(1)
+        author.emit('create message', {'user_id': 1, 'username': 'user1', 'avatar_url': 'avatar.png',
+                                       'content': 'followed'})
+        followed_id = author.get_received()[0]['args'][0]['message_id']
+        UserService().create_user(2, "user2", "avatar.png")
+        reader = self.socketio.test_client(self.app)
+        position = self.resume(reader, message_ids=[followed_id])[-1]['args'][0]
+        reader.disconnect()
+
+        author.emit('create message', {'user_id': 1, 'username': 'user1', 'avatar_url': 'avatar.png',
+                                       'content': 'missed'})
+        other_id = author.get_received()[0]['args'][0]['message_id']
+        for message_id in (followed_id, other_id):
+            author.emit('create comment', {'user_id': 1, 'message_id': message_id, 'content': 'comment'})
+
+        reader = self.socketio.test_client(self.app)
+        packets = self.resume(reader, epoch=position['epoch'], seq=position['seq'], message_ids=[followed_id])
+        # Комментарий в чужом треде клиенту не положен и не повторяется
+        self.assertEqual([(packet['name'], packet['args'][0].get('content')) for packet in packets],
+                         [('new tweet', 'missed'), ('new comment', 'comment'), ('resumed', None)])
+        resumed = packets[-1]['args'][0]
+        self.assertEqual((resumed['complete'], resumed['replayed']), (True, 2))
+        # Позиция учитывает и события чужого треда, которые клиенту не отправлялись
+        self.assertEqual(packets[1]['args'][0]['seq'], resumed['seq'] - 1)
+
+        # Дальше события приходят вживую, с продолжением нумерации
+        author.emit('update comment', {'user_id': 1, 'comment_id': packets[1]['args'][0]['comment_id'],
+                                       'new_content': 'edited'})
+        live = reader.get_received()
+        self.assertEqual([packet['name'] for packet in live], ['update comment'])
+        self.assertEqual(live[0]['args'][0]['seq'], resumed['seq'] + 1)
+
+    def test_resume_from_another_worker_reloads(self):
+        packets = self.resume(self.socketio.test_client(self.app), epoch='restarted', seq=1)
+        self.assertEqual([packet['name'] for packet in packets], ['resumed'])
+        self.assertFalse(packets[0]['args'][0]['complete'])
+
+
+class TestEventLog(unittest.TestCase):
+
+    def test_only_replayable_payloads_are_numbered(self):
+        from event_log import EventLog, replayable
+        log = EventLog()
+        self.assertEqual(log.stamp('room', 'likes', {'total': 1}), {'total': 1})
+        self.assertEqual(log.stamp('room', 'tweet', replayable({'id': 1})), {'id': 1, 'seq': 1})
+        self.assertEqual(log.stamp('room', 'page', b'packed'), b'packed')
+        self.assertEqual(log.stats()['size'], 1)
+
+    def test_gap_beyond_the_buffer_is_not_replayed(self):
+        from event_log import EventLog, replayable
+        log = EventLog(size=3)
+        for index in range(5):
+            log.stamp(['user:1', 'thread:a'] if index % 2 else 'room', 'event', replayable({'index': index}))
+
+        self.assertEqual([data['index'] for _, data in log.since(log.epoch, 2, ['room', 'user:1'])], [2, 3, 4])
+        self.assertEqual([data['index'] for _, data in log.since(log.epoch, 3, ['thread:a'])], [3])
+        self.assertEqual(log.since(log.epoch, 5, ['room']), [])
+        # Событие 2 уже вытеснено, номер из будущего или чужой эпохи повторить нельзя
+        for epoch, seq in ((log.epoch, 1), (log.epoch, 6), ('other', 3), (log.epoch, None)):
+            self.assertIsNone(log.since(epoch, seq, ['room']))
+        self.assertEqual(log.stats()['reloads'], 4)
+
+    def test_fresh_connect_is_not_a_reload(self):
+        from event_log import EventLog, replayable
+        log = EventLog()
+        log.stamp('room', 'event', replayable({}))
+        self.assertIsNone(log.since(None, None, ['room']))
+        self.assertEqual((log.stats()['reloads'], log.stats()['resumes']), (0, 0))
+
+
+class TestBulkLikes(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from models import User
+        User(username="author", forum_id=10, avatar_url="a.png").save()
+        User(username="reader", forum_id=11, avatar_url="r.png").save()
+        self.service = UserService()
+        self.message_id = self.service.create_message(10, "tweet")
+        self.other_message_id = self.service.create_message(10, "other tweet")
+        self.comment_id = self.service.create_comment(10, self.message_id, "comment")
+        self.subcomment_id = self.service.create_subcomment(10, self.comment_id, "subcomment")
+        self.service.like(11, self.message_id, "tweet", 1)
+        self.service.like(10, self.message_id, "tweet", 1)
+        self.service.like(11, self.subcomment_id, "subcomment", 1)
+
+    def test_one_query_per_collection(self):
+        items = [("subcomment", self.subcomment_id), ("tweet", self.message_id), ("comment", self.comment_id),
+                 ("tweet", self.other_message_id), ("tweet", str(ObjectId()))]
+        patcher, counter = self.count_finds()
+        with patcher:
+            likes = self.service.get_likes_bulk(11, items)
+        # Счётчики по одному запросу на коллекцию и один запрос к лайкам пользователя
+        self.assertEqual(counter, {'find': 4, 'find_one': 0})
+        self.assertEqual(likes, [
+            {"message_type": "subcomment", "message_id": self.subcomment_id, "total": 1, "user_liked": True},
+            {"message_type": "tweet", "message_id": self.message_id, "total": 2, "user_liked": True},
+            {"message_type": "comment", "message_id": self.comment_id, "total": 0, "user_liked": False},
+            {"message_type": "tweet", "message_id": self.other_message_id, "total": 0, "user_liked": False},
+        ])
+
+    def test_anonymous_and_single_item(self):
+        self.assertEqual(self.service.get_likes_bulk(None, [("tweet", self.message_id)])[0]["user_liked"], False)
+        self.assertEqual(self.service.get_likes(10, self.message_id, "tweet"), {"total": 2, "user_liked": True})
+
+    def test_rejects_bad_input(self):
+        with self.assertRaises(ValueError):
+            self.service.get_likes_bulk(11, [("retweet", self.message_id)])
+        with self.assertRaises(ValueError):
+            self.service.get_likes_bulk(11, [("tweet", "not an id")])
+        with self.assertRaises(ValueError):
+            self.service.get_likes_bulk(11, [("tweet", self.message_id)] * 201)
+
+    def test_feed_embeds_like_state(self):
+        page = self.service.get_recent_messages(user_id=11)
+        self.assertEqual(sorted(page['liked_ids']), sorted([self.message_id, self.subcomment_id]))
+        self.assertEqual([message['likes'] for message in page['messages']], [0, 2])
+        self.assertEqual(self.service.get_recent_messages()['liked_ids'], [])
+        # Кэшированная страница общая, а liked_ids у каждого свои
+        self.assertEqual(self.service.get_recent_messages(user_id=10)['liked_ids'], [self.message_id])
+
+
+class TestEmitAggregator(unittest.TestCase):
+
+    def setUp(self):
+        from emit_aggregator import EmitAggregator
+        self.socketio = Mock()
+        self.aggregator = EmitAggregator(self.socketio, window=0.2, max_batch=10)
+
+    @staticmethod
+    def target(message_id, total):
+        return {"message_type": "tweet", "message_id": message_id, "total": total}
+
+    def test_storm_is_coalesced_into_one_emit_per_room(self):
+        for total in range(1, 101):
+            self.aggregator.add("thread:a", self.target("a", total))
+        self.aggregator.add("thread:a", self.target("c", 1))
+        self.aggregator.add("thread:b", self.target("b", 7))
+        # Окно запускается один раз, а не на каждый клик
+        self.socketio.start_background_task.assert_called_once_with(self.aggregator.flush_after_window)
+        self.socketio.emit.assert_not_called()
+
+        self.aggregator.flush()
+        self.assertEqual(self.socketio.emit.call_args_list, [
+            call('likes', {"likes": [self.target("a", 100), self.target("c", 1)], "seq": None}, room="thread:a"),
+            call('likes', {"likes": [self.target("b", 7)], "seq": None}, room="thread:b"),
+        ])
+        self.assertEqual(self.aggregator.stats(), {"queued": 102, "coalesced": 99, "sent": 2, "pending": 0})
+
+        self.aggregator.add("thread:a", self.target("a", 101))
+        self.assertEqual(self.socketio.start_background_task.call_count, 2)
+
+    def test_full_batch_is_flushed_early(self):
+        for message_id in "abcdefghij":
+            self.aggregator.add("thread:a", self.target(message_id, 1))
+        self.socketio.emit.assert_called_once()
+        self.assertEqual(self.aggregator.stats()["pending"], 0)
+
+    def test_zero_window_sends_immediately(self):
+        from emit_aggregator import EmitAggregator
+        aggregator = EmitAggregator(self.socketio, window=0)
+        aggregator.add("thread:a", self.target("a", 1))
+        self.socketio.emit.assert_called_once_with('likes', {"likes": [self.target("a", 1)], "seq": None},
+                                                   room="thread:a")
+        self.socketio.start_background_task.assert_not_called()
+
+
+class TestLikeWriter(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        from models import User, Message, Comment, SubComment, Like
+        from like_writer import LikeWriter
+        for forum_id in range(10, 20):
+            User(username=f"user{forum_id}", forum_id=forum_id, avatar_url="a.png").save()
+        # Таймер не должен сработать посреди теста: пишем только явным flush()
+        self.writer = LikeWriter({'tweet': Message, 'comment': Comment, 'subcomment': SubComment}, Like,
+                                  interval=60)
+        self.addCleanup(self.writer.flush)
+        self.service = UserService(like_writer=self.writer)
+        self.writer.on_flush = self.service.publish_like_totals
+        self.message_id = self.service.create_message(10, "tweet")
+
+    def stored_likes(self):
+        from models import Message, Like
+        message = Message.objects.no_dereference().get(id=self.message_id)
+        return message.likes_count, Like.objects(target_type='tweet', target_id=message.id).count()
+
+    def test_acting_user_reads_own_write_before_flush(self):
+        self.assertEqual(self.service.like(11, self.message_id, "tweet", 1), 1)
+        self.assertEqual(self.stored_likes(), (0, 0))
+        self.assertTrue(self.writer.timer.is_alive())
+
+        self.assertEqual(self.service.get_likes(11, self.message_id, "tweet"), {"total": 1, "user_liked": True})
+        self.assertEqual(self.service.get_likes(12, self.message_id, "tweet"), {"total": 1, "user_liked": False})
+        self.assertEqual(self.service.get_recent_messages(user_id=11)['liked_ids'], [self.message_id])
+        with self.assertRaisesRegex(ValueError, "already liked"):
+            self.service.like(11, self.message_id, "tweet", 1)
+
+        self.writer.flush()
+        self.assertIsNone(self.writer.timer)
+        self.assertEqual(self.stored_likes(), (1, 1))
+        self.assertEqual(self.service.get_likes(11, self.message_id, "tweet"), {"total": 1, "user_liked": True})
+
+    def test_storm_is_written_with_one_bulk_write(self):
+        original = mongomock.collection.Collection.bulk_write
+        calls = []
+
+        def bulk_write(collection, requests, *args, **kwargs):
+            calls.append((collection.name, len(requests)))
+            return original(collection, requests, *args, **kwargs)
+
+        for forum_id in range(10, 20):
+            self.service.like(forum_id, self.message_id, "tweet", 1)
+        self.service.remove_like(10, self.message_id, "tweet")
+        with patch.object(mongomock.collection.Collection, 'bulk_write', bulk_write):
+            self.writer.flush()
+        # Лайки, счётчик твита и очки его автора в рейтинге — по одной пачке
+        self.assertEqual(calls, [('like', 9), ('message', 1), ('user', 1)])
+        self.assertEqual(self.stored_likes(), (9, 9))
+        self.assertEqual(self.writer.stats(), {"queued": 11, "coalesced": 1, "written": 9, "skipped": 1,
+                                               "pending": 0})
+
+    def test_like_stored_by_another_worker_is_recounted(self):
+        from models import Like, User
+        self.service.like(11, self.message_id, "tweet", 1)
+        self.service.like(12, self.message_id, "tweet", 1)
+        # Другой воркер успел записать тот же лайк
+        Like(target_type='tweet', target_id=ObjectId(self.message_id), user=User.objects.get(forum_id=11)).save()
+        self.writer.flush()
+        self.assertEqual(self.stored_likes(), (2, 2))
+
+    def test_like_and_unlike_in_one_window_write_nothing(self):
+        self.service.like(11, self.message_id, "tweet", 1)
+        self.assertEqual(self.service.remove_like(11, self.message_id, "tweet"), 0)
+        with self.assertRaisesRegex(ValueError, "not liked"):
+            self.service.remove_like(11, self.message_id, "tweet")
+        self.writer.flush()
+        self.assertEqual(self.stored_likes(), (0, 0))
+        self.assertEqual(self.writer.stats()["written"], 0)
+
+    def test_flush_publishes_stored_totals_to_the_feed(self):
+        self.service.get_recent_messages()
+        self.service.like(11, self.message_id, "tweet", 1)
+        self.service.like(12, self.message_id, "tweet", 1)
+        self.writer.flush()
+        self.assertEqual(self.service.get_recent_messages()['messages'][0]['likes'], 2)
+        self.assertEqual(self.service.feed_cache.stats()['misses'], 1)
+
+    def test_queued_clicks_reach_the_bus_once_per_flush(self):
+        published = []
+        self.service.bus.subscribe(FEED_CHANNEL, published.append)
+        self.service.get_recent_messages()
+        for forum_id in range(11, 16):
+            self.service.like(forum_id, self.message_id, "tweet", 1)
+        # Свой кэш уже показывает ожидаемый счётчик, а другим воркерам ещё ничего не отправлено
+        self.assertEqual(self.service.get_recent_messages()['messages'][0]['likes'], 5)
+        self.assertEqual(self.service.feed_cache.stats()['misses'], 1)
+        self.assertEqual(published, [])
+
+        self.writer.flush()
+        self.assertEqual(published, [{'op': 'liked', 'message_type': 'tweet', 'message_id': self.message_id,
+                                      'likes': 5}])
+
+
+class TestDBExecutor(unittest.TestCase):
+
+    def test_blocking_call_in_tpool_keeps_heartbeat_flat(self):
+        from db_executor import DBExecutor
+        self.assertLess(self.heartbeat_lag(DBExecutor('tpool')), 0.1)
+        # Тот же вызов прямо в хабе останавливает все зелёные потоки на время запроса
+        self.assertGreater(self.heartbeat_lag(DBExecutor('inline')), 0.25)
+
+    @staticmethod
+    def heartbeat_lag(executor) -> float:
+        import eventlet
+        lags = []
+
+        def heartbeat():
+            while True:
+                started = time.monotonic()
+                eventlet.sleep(0.01)
+                lags.append(time.monotonic() - started - 0.01)
+
+        beat = eventlet.spawn(heartbeat)
+        eventlet.sleep(0.02)
+        # time.sleep не пропатчен и блокирует поток, как синхронный запрос pymongo
+        executor.run(time.sleep, 0.3)
+        eventlet.sleep(0.02)
+        beat.kill()
+        return max(lags)
+
+    def test_timed_out_call_keeps_its_slot_until_it_finishes(self):
+        from db_executor import DBExecutor, DBTimeout, DBOverloaded
+        executor = DBExecutor('threads', max_in_flight=1, timeout=0.05)
+        release = threading.Event()
+        with self.assertRaises(DBTimeout):
+            executor.run(release.wait)
+        with self.assertRaises(DBOverloaded):
+            executor.run(len, [])
+        release.set()
+        executor.pool.shutdown(wait=True)
+        self.assertEqual(executor.stats(), {"backend": "threads", "in_flight": 0, "completed": 1,
+                                            "timeouts": 1, "rejected": 1})
+
+    def test_green_backend_times_out(self):
+        import eventlet
+        from db_executor import DBExecutor, DBTimeout
+        executor = DBExecutor('green', timeout=0.05)
+        with self.assertRaises(DBTimeout):
+            executor.run(eventlet.sleep, 1)
+        self.assertEqual(executor.run(sum, [1, 2], start=3), 6)
+        self.assertEqual(executor.in_flight, 0)
+
+    def test_offloaded_service_keeps_the_interface(self):
+        from db_executor import DBExecutor, OffloadedService
+        service = Mock(feed_cache=object())
+        executor = Mock(spec=DBExecutor)
+        offloaded = OffloadedService(service, executor, timeouts={'get_recent_messages': 15},
+                                     inline=('check_message_length',))
+
+        offloaded.get_recent_messages(user_id=1)
+        offloaded.like(1, 'id', 'tweet', 1)
+        offloaded.check_message_length('text', 500)
+
+        self.assertEqual(executor.run.call_args_list, [
+            call(service.get_recent_messages, user_id=1, timeout=15),
+            call(service.like, 1, 'id', 'tweet', 1, timeout=None),
+        ])
+        service.check_message_length.assert_called_once_with('text', 500)
+        self.assertIs(offloaded.feed_cache, service.feed_cache)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        from metrics import Registry
+        self.registry = Registry()
+
+    def test_counters_from_several_threads_add_up(self):
+        counter = self.registry.counter('emits_total', 'Emits', ('event',))
+        threads = [threading.Thread(target=lambda: [counter.inc('new "tweet"') for _ in range(1000)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc('likes', amount=2.5)
+
+        self.assertEqual(self.registry.render().splitlines(), [
+            '# HELP emits_total Emits',
+            '# TYPE emits_total counter',
+            'emits_total{event="likes"} 2.5',
+            'emits_total{event="new \\"tweet\\""} 4000',
+        ])
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.histogram('latency_seconds', 'Latency', ('event',), buckets=(0.01, 0.1))
+        for value in (0.005, 0.05, 0.05, 3):
+            histogram.observe('like', value=value)
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'latency_seconds_bucket{event="like",le="0.01"} 1',
+            'latency_seconds_bucket{event="like",le="0.1"} 3',
+            'latency_seconds_bucket{event="like",le="+Inf"} 4',
+            'latency_seconds_sum{event="like"} 3.105',
+            'latency_seconds_count{event="like"} 4',
+        ])
+
+    def test_room_stats_aggregate_by_kind(self):
+        from metrics import room_stats
+        server = Mock()
+        server.manager.rooms = {'/': {
+            None: {'a': 'ea', 'b': 'eb'}, 'a': {'a': 'ea'}, 'b': {'b': 'eb'},
+            'room': {'a': 'ea', 'b': 'eb'}, 'user:1': {'a': 'ea'}, 'user:2': {'b': 'eb'},
+            'thread:x': {'a': 'ea', 'b': 'eb'},
+        }}
+        self.assertEqual(room_stats(server), {"connected": 2, "kinds": {
+            "room": {"rooms": 1, "members": 2, "max_members": 2},
+            "user": {"rooms": 2, "members": 2, "max_members": 1},
+            "thread": {"rooms": 1, "members": 2, "max_members": 2},
+        }})
+        self.assertEqual(room_stats(None), {"connected": 0, "kinds": {}})
+
+
+class TestKeysetPagination(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.service = UserService()
+        self.service.create_user(1, "author", "a.png")
+        self.message_ids = [self.service.create_message(1, f"tweet {i}") for i in range(7)]
+
+    def walk(self, limit):
+        seen, cursor = [], None
+        while True:
+            page = self.service.get_recent_messages(limit=limit, cursor=cursor)
+            seen.extend(message['message_id'] for message in page['messages'])
+            cursor = page['next_cursor']
+            if not page['has_more_messages']:
+                self.assertIsNone(cursor)
+                return seen
+
+    def test_cursor_walks_whole_feed_in_order(self):
+        self.assertEqual(self.walk(limit=3), list(reversed(self.message_ids)))
+
+    def test_new_messages_do_not_shift_pages(self):
+        first_page = self.service.get_recent_messages(limit=3)
+        self.service.create_message(1, "arrived while scrolling")
+        second_page = self.service.get_recent_messages(limit=3, cursor=first_page['next_cursor'])
+        self.assertEqual([message['message_id'] for message in second_page['messages']],
+                         list(reversed(self.message_ids))[3:6])
+
+    def test_same_timestamp_is_ordered_by_id(self):
+        from models import Message
+        Message.objects.update(set__created_at=Message.objects.first().created_at)
+        self.assertEqual(self.walk(limit=2), list(reversed(self.message_ids)))
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            self.service.get_recent_messages(cursor="not-a-cursor")
+
+    def test_offset_mode_still_supported(self):
+        page = self.service.get_recent_messages(offset=5, limit=3)
+        self.assertEqual([message['message_id'] for message in page['messages']],
+                         list(reversed(self.message_ids))[5:])
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """
+    pymongo command listener that keeps every query-shaped command sent to the server
+    """
+    QUERY_COMMANDS = ('find', 'count', 'aggregate', 'update', 'delete', 'findAndModify')
+    SESSION_FIELDS = ('lsid', '$db', '$clusterTime', '$readPreference', 'txnNumber', 'readConcern', 'writeConcern')
+
+    def __init__(self):
+        self.commands = []
+        self.recording = False
+
+    def started(self, event):
+        if self.recording and event.command_name in self.QUERY_COMMANDS:
+            command = {key: value for key, value in event.command.items() if key not in self.SESSION_FIELDS}
+            self.commands.append((event.database_name, command))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+@unittest.skipUnless(MONGODB_TEST_URI, "explain() needs a real mongod, set MONGODB_TEST_URI")
+class TestQueryPlans(MongoTestCase):
+    """
+    Replays every command issued by UserService through explain() and fails on collection scans
+    """
+
+    recorder = CommandRecorder()
+
+    @classmethod
+    def setUpClass(cls):
+        # Слушатель должен быть зарегистрирован до создания клиента
+        monitoring.register(cls.recorder)
+        super().setUpClass()
+
+    @staticmethod
+    def stages(plan):
+        yield plan.get('stage')
+        for key in ('inputStage', 'queryPlan'):
+            if key in plan:
+                yield from TestQueryPlans.stages(plan[key])
+        for child in plan.get('inputStages', []):
+            yield from TestQueryPlans.stages(child)
+
+    def winning_plans(self, explain):
+        planner = explain.get('queryPlanner')
+        if planner is not None:
+            yield planner['winningPlan']
+        for stage in explain.get('stages', []):
+            cursor = stage.get('$cursor')
+            if cursor is not None:
+                yield cursor['queryPlanner']['winningPlan']
+
+    def exercise_service(self):
+        service = UserService()
+        service.create_user(1, "author", "a.png")
+        service.create_user(2, "reader", "r.png")
+        service.user_exists(1)
+        service.update_username_and_avatar(1, "author", "a2.png")
+        message_id = service.create_message(1, "tweet")
+        service.edit_message(message_id, 1, "edited")
+        comment_id = service.create_comment(2, message_id, "comment")
+        service.update_comment(comment_id, 2, "edited")
+        subcomment_id = service.create_subcomment(1, comment_id, "reply")
+        service.edit_subcomment(subcomment_id, 1, "edited")
+        for message_type, target_id in (('tweet', message_id), ('comment', comment_id),
+                                         ('subcomment', subcomment_id)):
+            service.like(2, target_id, message_type, 1)
+            service.get_likes(2, target_id, message_type)
+            service.remove_like(2, target_id, message_type)
+            service.get_thread_id(message_type, target_id)
+        service.ignore_user(2, 1)
+        service.get_recent_messages(user_id=2)
+        service.get_ignored_users(2)
+        service.unignore_user(2, 1)
+        service.get_recent_messages()
+        service.get_message_comments(message_id)
+        service.report_message(2, message_id, "spam")
+        service.report_comment(1, comment_id, "spam")
+        service.send_notification(2, "hello")
+        service.ban_user(2)
+        service.check_ban_status(1)
+        service.unban_user(2)
+        service.delete_subcomment(subcomment_id, 1)
+        service.delete_comment(comment_id, 2)
+        service.delete_message(message_id, 1)
+
+    def test_user_service_queries_use_indexes(self):
+        from mongoengine.connection import get_db
+        self.recorder.commands = []
+        self.recorder.recording = True
+        try:
+            self.exercise_service()
+        finally:
+            self.recorder.recording = False
+        self.assertTrue(self.recorder.commands)
+
+        database = get_db()
+        for _, command in self.recorder.commands:
+            explain = database.command('explain', command, verbosity='queryPlanner')
+            for plan in self.winning_plans(explain):
+                self.assertNotIn('COLLSCAN', list(self.stages(plan)), f"collection scan for {command}")
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,119 @@
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from bson import ObjectId
+
+from cache import LRUCache
+from models import User
+
+
+class CachedUser(NamedTuple):
+    """
+    Immutable snapshot of the User fields the request handlers need
+    """
+    id: ObjectId
+    forum_id: int
+    username: str
+    avatar_url: str
+    banned: bool
+    ignored_ids: frozenset
+
+
+class UserCache:
+    """
+    LRU/TTL cache of users keyed by forum_id, with a secondary index by ObjectId.
+    Every write to a user must go through invalidate(). A read that started before an invalidate()
+    of the same user is returned to its caller but not cached, so it cannot bring the old document back
+    """
+    FIELDS = ('id', 'forum_id', 'username', 'avatar_url', 'banned', 'ignored_users')
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.users = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.forum_ids = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        # Номер последнего invalidate() и номер, с которым был сброшен каждый пользователь, старые в начале.
+        # Вытесненные из invalidated номера поднимают floor: чтения, начатые до него, не кэшируются
+        self.maxsize = maxsize
+        self.generation = 0
+        self.invalidated = OrderedDict()
+        self.floor = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def snapshot(user) -> CachedUser:
+        return CachedUser(
+            id=user.id,
+            forum_id=user.forum_id,
+            username=user.username,
+            avatar_url=user.avatar_url,
+            banned=bool(user.banned),
+            # Без разыменования: нужны только id игнорируемых
+            ignored_ids=frozenset(ref.id for ref in user.ignored_users or []),
+        )
+
+    def remember(self, user, generation: Optional[int] = None) -> CachedUser:
+        """
+        Caches the snapshot unless the user was invalidated after generation,
+        the value of self.generation taken before the user was read
+        """
+        cached = self.snapshot(user)
+        with self.lock:
+            if generation is not None and max(self.floor, self.invalidated.get(cached.forum_id, 0)) > generation:
+                return cached
+            self.users.set(cached.forum_id, cached)
+            self.forum_ids.set(cached.id, cached.forum_id)
+        return cached
+
+    def get(self, forum_id: int) -> Optional[CachedUser]:
+        with self.lock:
+            cached = self.users.get(forum_id)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            self.misses += 1
+            generation = self.generation
+        user = User.objects(forum_id=forum_id).only(*self.FIELDS).no_dereference().first()
+        return self.remember(user, generation) if user is not None else None
+
+    def get_many_by_ids(self, user_ids) -> dict:
+        found, missing = {}, []
+        with self.lock:
+            for user_id in user_ids:
+                forum_id = self.forum_ids.get(user_id)
+                cached = self.users.get(forum_id) if forum_id is not None else None
+                if cached is not None:
+                    found[user_id] = cached
+                else:
+                    missing.append(user_id)
+            self.hits += len(found)
+            self.misses += len(missing)
+            generation = self.generation
+        if missing:
+            for user in User.objects(id__in=missing).only(*self.FIELDS).no_dereference():
+                found[user.id] = self.remember(user, generation)
+        return found
+
+    def invalidate(self, forum_id: int) -> None:
+        with self.lock:
+            self.generation += 1
+            self.invalidated[forum_id] = self.generation
+            self.invalidated.move_to_end(forum_id)
+            while len(self.invalidated) > self.maxsize:
+                self.floor = self.invalidated.popitem(last=False)[1]
+            cached = self.users.pop(forum_id)
+            if cached is not None:
+                self.forum_ids.pop(cached.id)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.users.clear()
+            self.forum_ids.clear()
+            self.generation += 1
+            self.floor = self.generation
+            self.invalidated.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"size": len(self.users), "hits": self.hits, "misses": self.misses}
@@ -1,35 +1,91 @@
+from collections import defaultdict
 from typing import Optional
 
-from mongoengine import DoesNotExist
+from bson import ObjectId
+from mongoengine import DoesNotExist, NotUniqueError
 from mongoengine.queryset.visitor import Q
 from admins import ADMIN_IDS
 from models import User, Message, Comment, Like, Report, Notification, SubComment
 from message_manager import MessageManager
+from feed_assembler import FeedAssembler, MESSAGE_FIELDS, COMMENT_FIELDS, SUBCOMMENT_FIELDS
+from feed_cache import FeedCache
+from leaderboard import Leaderboard
+from purge import PurgeWorker
+from cache import LRUCache
+from pagination import encode_cursor, older_than, newer_than
+from user_cache import UserCache, CachedUser
+from invalidation_bus import InMemoryBus, USERS_CHANNEL, FEED_CHANNEL
+
+# Сколько (тип, id) можно запросить в одном get likes
+MAX_LIKES_BATCH = 200
+# Порция комментариев или ответов, которую клиент дочитывает по кнопке «ещё»
+COMMENTS_PAGE = 20
+MAX_COMMENTS_PAGE = 100
+# Сколько раз лента добирает твиты, если на странице остались одни игнорируемые авторы
+MAX_FEED_REFILLS = 3
 
 
 class UserService:
+    def __init__(self, bus=None, like_writer=None, purge=None):
+        # Шина рассылает сбросы кэшей всем воркерам, включая текущий
+        self.bus = bus if bus is not None else InMemoryBus()
+        self.bus.subscribe(USERS_CHANNEL, self.forget_user)
+        self.bus.subscribe(FEED_CHANNEL, self.apply_feed_event)
+        self.user_cache = UserCache()
+        self.feed_assembler = FeedAssembler(self.user_cache)
+        self.feed_cache = FeedCache()
+        self.leaderboard = Leaderboard()
+        # Необязательная отложенная запись лайков (LikeWriter); без неё каждый клик пишется сразу
+        self.like_writer = like_writer
+        # Зависимые документы удалённых твитов и комментариев; без фонового воркера вычищаются сразу
+        self.purge = purge if purge is not None else PurgeWorker(background=False)
+        self.purge.on_removed = self.leaderboard.removed
+        # (тип, id) комментария/сабкомментария -> id твита; связь никогда не меняется
+        self.thread_ids = LRUCache(maxsize=50000)
+
+    def forget_user(self, user_id: int) -> None:
+        self.user_cache.invalidate(user_id)
+        self.feed_cache.forget_author(user_id)
+
+    def invalidate_user(self, user_id: int) -> None:
+        self.bus.publish(USERS_CHANNEL, user_id)
+
+    def apply_feed_event(self, event: dict) -> None:
+        self.feed_cache.apply(event)
+
+    def publish_feed_event(self, op: str, **fields) -> None:
+        self.bus.publish(FEED_CHANNEL, dict(op=op, **fields))
+
+    def get_user(self, user_id: int) -> CachedUser:
+        user = self.user_cache.get(user_id)
+        if user is None:
+            raise User.DoesNotExist(f"User with id {user_id} does not exist")
+        return user
+
     def user_exists(self, user_id: int) -> bool:
-        try:
-            User.objects.get(forum_id=user_id)
-            return True
-        except DoesNotExist:
-            return False
+        return self.user_cache.get(user_id) is not None
+
+    def is_author(self, document, user_id: int) -> bool:
+        user = self.user_cache.get(user_id)
+        return user is not None and self.reference_id(document, 'user') == user.id
 
     def create_user(self, user_id: int, username: str, avatar_url: str) -> None:
         new_user = User(username=username, forum_id=user_id, avatar_url=avatar_url)
         new_user.save()
+        self.invalidate_user(user_id)
 
     def update_username_and_avatar(self, user_id: int, username: str, avatar_url: str) -> None:
-        user = User.objects.get(forum_id=user_id)
+        user = self.get_user(user_id)
         if user.username != username or user.avatar_url != avatar_url:
-            user.username = username
-            user.avatar_url = avatar_url
-            user.save()
+            User.objects(id=user.id).update_one(set__username=username, set__avatar_url=avatar_url)
+            self.invalidate_user(user_id)
 
     def create_message(self, user_id: int, content: str) -> str:
-        user = User.objects.get(forum_id=user_id)
-        new_message = Message(user=user, content=content)
+        user = self.get_user(user_id)
+        new_message = Message(user=user.id, content=content)
         new_message.save()
+        self.leaderboard.add(user.id, messages=1)
+        self.publish_feed_event('message_created', node=FeedAssembler.message_node(new_message.to_mongo(), user))
         return str(new_message.id)
 
     def delete_message(self, message_id: str, user_id: int) -> None:
@@ -38,26 +94,38 @@ class UserService:
         except DoesNotExist:
             raise ValueError("Message does not exist")
 
-        if message.user.forum_id == user_id or user_id in ADMIN_IDS:
+        if user_id in ADMIN_IDS or self.is_author(message, user_id):
+            # Надгробие раньше удаления: если процесс остановится между ними, твит удалит PurgeWorker.
+            # Комментарии, ответы, жалобы и лайки он вычищает пачками, авторы комментариев теряют очки там же
+            self.purge.queue('tweet', message.id)
             message.delete()
+            self.leaderboard.removed(
+                messages=[{'user': self.reference_id(message, 'user'), 'likes_count': message.likes_count}])
+            self.publish_feed_event('message_deleted', message_id=str(message.id))
         else:
             raise PermissionError("User does not have permission to delete this message")
 
     def edit_message(self, message_id: str, user_id: int, new_content: str) -> None:
-        user = User.objects.get(forum_id=user_id)
-        if not user:
-            raise DoesNotExist("User does not exist")
+        self.get_user(user_id)
         message = Message.objects.get(id=message_id)
-        if message.user.forum_id != user_id:
+        if not self.is_author(message, user_id):
             raise PermissionError("User does not have permission to edit this message")
         message.content = new_content
         message.save()
+        self.publish_feed_event('message_updated', message_id=str(message.id), content=new_content)
 
     def create_comment(self, user_id: int, message_id: str, content: str) -> str:
-        user = User.objects.get(forum_id=user_id)
+        user = self.get_user(user_id)
         message = Message.objects.get(id=message_id)
-        new_comment = Comment(user=user, message=message, content=content)
+        new_comment = Comment(user=user.id, message=message, content=content)
         new_comment.save()
+        # Счётчики после вставки уходят в событие: кэш ленты ставит их как есть, а не прибавляет
+        counts = Message.objects(id=message.id).only('comments_count').modify(new=True, inc__comments_count=1)
+        self.leaderboard.add(user.id, comments=1)
+        self.thread_ids.set(('comment', str(new_comment.id)), str(message.id))
+        self.publish_feed_event('comment_created', message_id=str(message.id),
+                                node=FeedAssembler.comment_node(new_comment.to_mongo(), user),
+                                comments_count=counts.comments_count if counts else None)
         return str(new_comment.id)
 
     def delete_comment(self, comment_id: str, user_id: int) -> None:
@@ -66,22 +134,44 @@ class UserService:
         except DoesNotExist:
             raise ValueError("Comment does not exist")
 
-        if comment.user.forum_id == user_id or user_id in ADMIN_IDS:
+        if user_id in ADMIN_IDS or self.is_author(comment, user_id):
+            # Ответы, жалобы и лайки комментария вычистит PurgeWorker
+            self.purge.queue('comment', comment.id)
             comment.delete()
+            self.leaderboard.removed(comments=[{'user': self.reference_id(comment, 'user'),
+                                                'likes_count': comment.likes_count}])
+            thread_id = self.reference_id(comment, 'message')
+            Message.objects(id=thread_id).update_one(
+                dec__comments_count=1, dec__subcomments_count=comment.subcomments_count)
+            self.publish_feed_event('comment_deleted', message_id=str(thread_id), comment_id=str(comment.id),
+                                    subcomments=comment.subcomments_count)
         else:
             raise PermissionError("User does not have permission to delete this comment")
 
     def update_comment(self, comment_id: str, user_id: int, new_content: str) -> None:
         comment = Comment.objects.get(id=comment_id)
-        if comment.user.forum_id == user_id or user_id in ADMIN_IDS:
+        if user_id in ADMIN_IDS or self.is_author(comment, user_id):
             comment.content = new_content
             comment.save()
+            self.publish_feed_event('comment_updated', message_id=str(self.reference_id(comment, 'message')),
+                                    comment_id=str(comment.id), content=new_content)
 
     def create_subcomment(self, user_id: int, comment_id: str, content: str) -> str:
-        user = User.objects.get(forum_id=user_id)
+        user = self.get_user(user_id)
         comment = Comment.objects.get(id=comment_id)
-        new_subcomment = SubComment(user=user, parent_comment=comment, content=content)
+        new_subcomment = SubComment(user=user.id, parent_comment=comment, content=content)
         new_subcomment.save()
+        thread_id = self.reference_id(comment, 'message')
+        comment_counts = Comment.objects(id=comment.id).only('subcomments_count') \
+            .modify(new=True, inc__subcomments_count=1)
+        thread_counts = Message.objects(id=thread_id).only('subcomments_count') \
+            .modify(new=True, inc__subcomments_count=1)
+        self.leaderboard.add(user.id, comments=1)
+        self.thread_ids.set(('subcomment', str(new_subcomment.id)), str(thread_id))
+        self.publish_feed_event('subcomment_created', message_id=str(thread_id), comment_id=str(comment.id),
+                                node=FeedAssembler.subcomment_node(new_subcomment.to_mongo(), user),
+                                subcomments_count=comment_counts.subcomments_count if comment_counts else None,
+                                thread_subcomments=thread_counts.subcomments_count if thread_counts else None)
         return str(new_subcomment.id)
 
     def delete_subcomment(self, subcomment_id: str, user_id: int) -> None:
@@ -90,20 +180,62 @@ class UserService:
         except DoesNotExist:
             raise ValueError("Subcomment does not exist")
 
-        if subcomment.user.forum_id == user_id or user_id in ADMIN_IDS:
+        if user_id in ADMIN_IDS or self.is_author(subcomment, user_id):
             subcomment.delete()
+            self.forget_likes('subcomment', [subcomment.id])
+            self.leaderboard.removed(comments=[{'user': self.reference_id(subcomment, 'user'),
+                                                'likes_count': subcomment.likes_count}])
+            parent_comment = Comment.objects(id=self.reference_id(subcomment, 'parent_comment')) \
+                .no_dereference().modify(dec__subcomments_count=1)
+            if parent_comment:
+                thread_id = self.reference_id(parent_comment, 'message')
+                Message.objects(id=thread_id).update_one(dec__subcomments_count=1)
+                self.publish_feed_event('subcomment_deleted', message_id=str(thread_id),
+                                        comment_id=str(parent_comment.id), subcomment_id=str(subcomment.id))
         else:
             raise PermissionError("User does not have permission to delete this subcomment")
 
     def edit_subcomment(self, subcomment_id: str, user_id: int, new_content: str) -> None:
-        user = User.objects.get(forum_id=user_id)
-        if not user:
-            raise DoesNotExist("User does not exist")
+        self.get_user(user_id)
         subcomment = SubComment.objects.get(id=subcomment_id)
-        if subcomment.user.forum_id != user_id:
+        if not self.is_author(subcomment, user_id):
             raise PermissionError("User does not have permission to edit this subcomment")
         subcomment.content = new_content
         subcomment.save()
+        self.publish_feed_event('subcomment_updated', message_id=self.get_thread_id('subcomment', subcomment.id),
+                                comment_id=str(self.reference_id(subcomment, 'parent_comment')),
+                                subcomment_id=str(subcomment.id), content=new_content)
+
+    @staticmethod
+    def forget_likes(message_type: str, target_ids: list) -> None:
+        if target_ids:
+            Like.objects(target_type=message_type, target_id__in=target_ids).delete()
+
+    @staticmethod
+    def reference_id(document, field_name: str):
+        # Id из ReferenceField без разыменования связанного документа
+        value = document._data.get(field_name)
+        return getattr(value, 'id', value)
+
+    def get_thread_id(self, message_type: str, message_id: str) -> Optional[str]:
+        """Id твита, к которому относится сообщение любого типа"""
+        if message_type == 'tweet':
+            return str(message_id)
+        self.get_model_by_type(message_type)
+
+        key = (message_type, str(message_id))
+        thread_id = self.thread_ids.get(key)
+        if thread_id is None:
+            comment_id = message_id
+            if message_type == 'subcomment':
+                parent = SubComment.objects(id=message_id).only('parent_comment').as_pymongo().first()
+                comment_id = parent.get('parent_comment') if parent else None
+            comment = Comment.objects(id=comment_id).only('message').as_pymongo().first() if comment_id else None
+            if comment is None or comment.get('message') is None:
+                return None
+            thread_id = str(comment['message'])
+            self.thread_ids.set(key, thread_id)
+        return thread_id
 
     def get_model_by_type(self, message_type: str):
         MODEL_MAPPING = {
@@ -116,44 +248,176 @@ class UserService:
             raise ValueError(f"Invalid message type: {message_type}")
         return model
 
-    def like(self, user_id: int, message_id: str, message_type: str, value: int) -> None:
+    def like(self, user_id: int, message_id: str, message_type: str, value: int) -> int:
         model = self.get_model_by_type(message_type)
+        user = self.user_cache.get(user_id)
+        if user is None or not ObjectId.is_valid(message_id):
+            raise ValueError("User or message does not exist")
+        if self.like_writer is not None:
+            return self.queue_like(message_type, message_id, user, True)
+
+        # Уникальный индекс (цель, пользователь) не даёт лайкнуть дважды даже при параллельных кликах
+        like = Like(target_type=message_type, target_id=ObjectId(message_id), user=user.id, value=value)
         try:
-            user = User.objects.get(forum_id=user_id)
-            message = model.objects.get(id=message_id)
-            # Check if the user has already liked the message
-            if any(like for like in message.likes if like.user.forum_id == user_id):
-                raise ValueError("User has already liked this message")
-            like = Like(user=user, value=value)
-            message.likes.append(like)
-            message.save()
-        except DoesNotExist:
+            like.save()
+        except NotUniqueError:
+            raise ValueError("User has already liked this message")
+        updated = model.objects(id=message_id).only('likes_count', 'user').modify(new=True, inc__likes_count=1)
+        if updated is None:
+            like.delete()
             raise ValueError("User or message does not exist")
+        self.leaderboard.add(self.reference_id(updated, 'user'), likes=1)
+        self.publish_feed_event('liked', message_type=message_type, message_id=str(message_id),
+                                likes=updated.likes_count)
+        return updated.likes_count
 
     def get_likes(self, user_id: int, message_id: str, message_type: str) -> dict:
-        model = self.get_model_by_type(message_type)
-        if not model:
-            raise ValueError("Invalid message type")
-
-        try:
-            message = model.objects.get(id=message_id)
-        except model.DoesNotExist:
+        likes = self.get_likes_bulk(user_id, [(message_type, message_id)])
+        if not likes:
             raise ValueError(f"{message_type.capitalize()} with ID {message_id} does not exist")
-
-        total_likes = sum(like.value for like in message.likes)
-        user_liked = any(like for like in message.likes if like.user.forum_id == user_id)
-        return {"total": total_likes, "user_liked": user_liked}
-
-    def remove_like(self, user_id: int, message_id: str, message_type: str) -> None:
+        return {"total": likes[0]["total"], "user_liked": likes[0]["user_liked"]}
+
+    def get_likes_bulk(self, user_id: Optional[int], items: list) -> list:
+        """
+        Лайки для списка пар (тип, id): один запрос с проекцией на коллекцию.
+        Несуществующие сообщения в ответ не попадают
+        """
+        if len(items) > MAX_LIKES_BATCH:
+            raise ValueError(f"Too many items, maximum is {MAX_LIKES_BATCH}")
+
+        ids_by_type = defaultdict(list)
+        for message_type, message_id in items:
+            self.get_model_by_type(message_type)
+            if not ObjectId.is_valid(message_id):
+                raise ValueError(f"Invalid message id: {message_id}")
+            ids_by_type[message_type].append(ObjectId(message_id))
+
+        user = self.user_cache.get(user_id) if user_id is not None else None
+        liked = self.liked_targets(user, ids_by_type) if user is not None else set()
+        found = {}
+        for message_type, ids in ids_by_type.items():
+            for row in self.get_model_by_type(message_type).objects(id__in=ids).only('likes_count').as_pymongo():
+                total, user_liked = row.get('likes_count', 0), (message_type, row['_id']) in liked
+                if self.like_writer is not None:
+                    # Ещё не записанные клики: пользователь видит свои лайки сразу
+                    total += self.like_writer.delta(message_type, row['_id'])
+                    intent = self.like_writer.intent(message_type, row['_id'], user.id) if user else None
+                    user_liked = user_liked if intent is None else intent
+                found[(message_type, str(row['_id']))] = {"total": total, "user_liked": user_liked}
+
+        return [dict(message_type=message_type, message_id=str(message_id), **found[(message_type, str(message_id))])
+                for message_type, message_id in items if (message_type, str(message_id)) in found]
+
+    def get_liked_ids(self, user_id: Optional[int], nodes: list) -> list:
+        """
+        Id твитов, комментариев и сабкомментариев, которые лайкнул пользователь:
+        для страницы ленты или порции комментариев/ответов
+        """
+        user = self.user_cache.get(user_id) if user_id is not None else None
+        if user is None:
+            return []
+
+        ids_by_type = defaultdict(list)
+        self.collect_ids(nodes, ids_by_type)
+
+        liked = self.liked_targets(user, ids_by_type)
+        liked_ids = []
+        for message_type, ids in ids_by_type.items():
+            if self.like_writer is not None:
+                for target_id in ids:
+                    intent = self.like_writer.intent(message_type, target_id, user.id)
+                    if intent is True:
+                        liked.add((message_type, target_id))
+                    elif intent is False:
+                        liked.discard((message_type, target_id))
+            liked_ids.extend(str(target_id) for target_id in ids if (message_type, target_id) in liked)
+        return liked_ids
+
+    @staticmethod
+    def liked_targets(user: CachedUser, ids_by_type: dict) -> set:
+        """
+        Какие из целей лайкнул пользователь: один запрос к лайкам по уникальному индексу
+        (тип и id из коротких списков $in, пользователь — точное совпадение)
+        """
+        ids = [target_id for type_ids in ids_by_type.values() for target_id in type_ids]
+        if not ids:
+            return set()
+        rows = Like.objects(target_type__in=list(ids_by_type), target_id__in=ids, user=user.id) \
+            .only('target_type', 'target_id').as_pymongo()
+        return {(row['target_type'], row['target_id']) for row in rows}
+
+    @staticmethod
+    def collect_ids(nodes: list, ids_by_type: dict) -> None:
+        for node in nodes:
+            # Проверяем от вложенных к верхним: у узла твита 'subcomments' — это число, а не id
+            for message_type, key in (('subcomment', 'subcomment_id'), ('comment', 'comment_id'),
+                                      ('tweet', 'message_id')):
+                if key in node:
+                    ids_by_type[message_type].append(ObjectId(node[key]))
+                    break
+            for children_key in ('comments', 'subcomments'):
+                if isinstance(node.get(children_key), list):
+                    UserService.collect_ids(node[children_key], ids_by_type)
+
+    def remove_like(self, user_id: int, message_id: str, message_type: str) -> int:
         model = self.get_model_by_type(message_type)
-        user = User.objects.get(forum_id=user_id)
-        message = model.objects.get(id=message_id)
-        # Check if the user has liked the message
-        if any(like for like in message.likes if like.user.forum_id == user_id):
-            message.likes = [like for like in message.likes if like.user.forum_id != user_id]
-            message.save()
-        else:
+        user = self.get_user(user_id)
+        if not ObjectId.is_valid(message_id):
             raise ValueError("User has not liked this message")
+        if self.like_writer is not None:
+            return self.queue_like(message_type, message_id, user, False)
+        if not Like.objects(target_type=message_type, target_id=ObjectId(message_id), user=user.id).delete():
+            raise ValueError("User has not liked this message")
+        updated = model.objects(id=message_id).only('likes_count', 'user').modify(new=True, inc__likes_count=-1)
+        if updated is None:
+            raise ValueError("User or message does not exist")
+        self.leaderboard.add(self.reference_id(updated, 'user'), likes=-1)
+        self.publish_feed_event('liked', message_type=message_type, message_id=str(message_id),
+                                likes=updated.likes_count)
+        return updated.likes_count
+
+    def queue_like(self, message_type: str, message_id: str, user: CachedUser, liked: bool) -> int:
+        """
+        Лайк/отмена в режиме отложенной записи: одно чтение вместо записи,
+        возвращает ожидаемый счётчик с учётом ещё не записанных кликов
+        """
+        model = self.get_model_by_type(message_type)
+        if not ObjectId.is_valid(message_id):
+            raise ValueError("User or message does not exist")
+        target_id = ObjectId(message_id)
+        row = model.objects(id=target_id).only('likes_count').as_pymongo().first()
+        if row is None:
+            raise ValueError("User or message does not exist")
+
+        stored = bool(Like.objects(target_type=message_type, target_id=target_id, user=user.id).count(
+            with_limit_and_skip=True))
+        current = self.like_writer.intent(message_type, target_id, user.id)
+        if (stored if current is None else current) == liked:
+            raise ValueError("User has already liked this message" if liked else "User has not liked this message")
+
+        self.like_writer.submit(message_type, target_id, user.id, liked, stored)
+        total = row.get('likes_count', 0) + self.like_writer.delta(message_type, target_id)
+        # Ожидаемый счётчик правит только кэш этого воркера: по шине идут лишь итоги записи
+        # из publish_like_totals, одна публикация на цель за окно, сколько бы ни было кликов
+        self.feed_cache.apply(dict(op='liked', message_type=message_type, message_id=str(message_id), likes=total))
+        return total
+
+    def publish_like_totals(self, targets: dict) -> None:
+        """
+        После записи очереди лайков рассылает настоящие счётчики из базы
+        и начисляет авторам полученные лайки; targets: (тип, id) -> изменение счётчика
+        """
+        ids_by_type = defaultdict(list)
+        for message_type, message_id in targets:
+            ids_by_type[message_type].append(message_id)
+        received = defaultdict(lambda: [0, 0, 0])
+        for message_type, ids in ids_by_type.items():
+            rows = self.get_model_by_type(message_type).objects(id__in=ids).only('likes_count', 'user').as_pymongo()
+            for row in rows:
+                received[row.get('user')][2] += targets[(message_type, row['_id'])]
+                self.publish_feed_event('liked', message_type=message_type, message_id=str(row['_id']),
+                                        likes=row.get('likes_count', 0))
+        self.leaderboard.add_many(received)
 
     def get_user_posts(self, user_id: int) -> list:
         user_posts = Message.objects.filter(user_id=user_id).order_by('-date').limit(10)
@@ -165,134 +429,191 @@ class UserService:
                 "post_date": post.date.isoformat(),
                 "comments": [{"comment_id": str(comment.id), "comment_content": comment.content} for comment in
                              post.comments],
-                "likes": len(post.likes)
+                "likes": post.likes_count
             }
             posts_data.append(post_data)
         return posts_data
 
     def ban_user(self, user_id: int) -> None:
-        try:
-            user = User.objects.get(forum_id=user_id)
-            user.banned = True
-            user.save()
-        except DoesNotExist as e:
-            raise ValueError("User does not exist") from e
-
-    def check_ban_status(self, user_id: int) -> Optional[User]:
-        user = User.objects.get(forum_id=user_id)
+        if not User.objects(forum_id=user_id).update_one(set__banned=True):
+            raise ValueError("User does not exist")
+        self.invalidate_user(user_id)
+
+    def check_ban_status(self, user_id: int) -> Optional[CachedUser]:
+        user = self.get_user(user_id)
         if user.banned:
             raise PermissionError("User is banned")
         return user
 
     def unban_user(self, user_id: int) -> None:
-        try:
-            user = User.objects.get(forum_id=user_id)
-            user.banned = False
-            user.save()
-        except DoesNotExist as e:
-            raise ValueError("User does not exist") from e
+        if not User.objects(forum_id=user_id).update_one(set__banned=False):
+            raise ValueError("User does not exist")
+        self.invalidate_user(user_id)
 
     def ignore_user(self, user_id: int, ignored_user_id: int) -> None:
-        try:
-            user = User.objects.get(forum_id=user_id)
-            ignored_user = User.objects.get(forum_id=ignored_user_id)
-            if ignored_user not in user.ignored_users:
-                user.ignored_users.append(ignored_user)
-                user.save()
-        except DoesNotExist as e:
-            raise ValueError("User or ignored user does not exist") from e
-
-        user = User.objects.get(forum_id=user_id)
-        ignored_user = User.objects.get(forum_id=ignored_user_id)
-        if ignored_user not in user.ignored_users:
-            user.ignored_users.append(ignored_user)
-            user.save()
+        user = self.user_cache.get(user_id)
+        ignored_user = self.user_cache.get(ignored_user_id)
+        if user is None or ignored_user is None:
+            raise ValueError("User or ignored user does not exist")
+
+        if ignored_user.id not in user.ignored_ids:
+            User.objects(id=user.id).update_one(add_to_set__ignored_users=ignored_user.id)
+            self.invalidate_user(user_id)
 
     def unignore_user(self, user_id: int, ignored_user_id: int) -> None:
-        if User.objects(forum_id=user_id).count() == 0:
+        user = self.user_cache.get(user_id)
+        if user is None:
             raise ValueError(f"User with id {user_id} does not exist")
 
-        if User.objects(forum_id=ignored_user_id).count() == 0:
+        ignored_user = self.user_cache.get(ignored_user_id)
+        if ignored_user is None:
             raise ValueError(f"User to unignore with id {ignored_user_id} does not exist")
 
-        user = User.objects.get(forum_id=user_id)
-        ignored_user = User.objects.get(forum_id=ignored_user_id)
-        if ignored_user in user.ignored_users:
-            user.ignored_users.remove(ignored_user)
-            user.save()
+        if ignored_user.id in user.ignored_ids:
+            User.objects(id=user.id).update_one(pull__ignored_users=ignored_user.id)
+            self.invalidate_user(user_id)
 
     def get_ignored_users(self, user_id: int) -> list:
-        if User.objects(forum_id=user_id).count() == 0:
+        user = self.user_cache.get(user_id)
+        if user is None:
             raise ValueError(f"User with id {user_id} does not exist")
 
-        user = User.objects.get(forum_id=user_id)
-        return [MessageManager.user_to_dict(ignored_user) for ignored_user in user.ignored_users]
+        ignored_users = self.user_cache.get_many_by_ids(user.ignored_ids)
+        return [MessageManager.user_to_dict(ignored_user) for ignored_user in ignored_users.values()]
 
     def report_message(self, user_id: int, message_id: str, reason: str) -> None:
         try:
-            user = User.objects.get(forum_id=user_id)
+            user = self.get_user(user_id)
             message = Message.objects.get(id=message_id)
-            new_report = Report(user=user, message=message, reason=reason)
+            new_report = Report(user=user.id, message=message, reason=reason)
             new_report.save()
         except DoesNotExist:
             raise ValueError("User or message does not exist")
 
     def report_comment(self, user_id: int, comment_id: str, reason: str) -> None:
-        user = User.objects.get(forum_id=user_id)
+        user = self.get_user(user_id)
         comment = Comment.objects.get(id=comment_id)
-        new_report = Report(user=user, comment=comment, reason=reason)
+        new_report = Report(user=user.id, comment=comment, reason=reason)
         new_report.save()
 
     def get_top_users(self) -> list:
-        return list(User.objects.order_by('-message', '-comment', '-likes'))
-
-    def get_recent_messages(self, offset=0, limit=10, user_id=None) -> dict:
-        if user_id:
-            # Получаем пользователя по user_id
-            user = User.objects.get(forum_id=user_id)
-
-            # Исключаем сообщения от игнорируемых пользователей
-            recent_messages_objects = list(
-                Message.objects(user__nin=user.ignored_users).order_by('-created_at').skip(offset).limit(limit + 1))
-        else:
-            recent_messages_objects = list(Message.objects.order_by('-created_at').skip(offset).limit(limit + 1))
+        return self.leaderboard.top()
+
+    def get_purge_status(self) -> dict:
+        """Счётчики PurgeWorker и надгробия, которые ещё не вычищены"""
+        return dict(self.purge.stats(), pending=self.purge.progress())
+
+    def get_recent_messages(self, offset=0, limit=10, user_id=None, cursor: Optional[str] = None,
+                            relative_times: bool = False) -> dict:
+        # Игнорируемые авторы отсекаются в памяти при отрисовке, а не через $nin в запросе:
+        # страница у всех общая, а цена фильтра не зависит от длины списка
+        ignored_ids = self.get_user(user_id).ignored_ids if user_id else frozenset()
+        page = self.feed_page(limit, offset, cursor, relative_times, ignored_ids)
+        messages = page['messages']
+        refills = 0
+        while len(messages) < limit and page['has_more_messages'] and refills < MAX_FEED_REFILLS:
+            # Недостачу после фильтра добираем следующими твитами, не больше нескольких раз
+            page = self.feed_page(limit - len(messages), 0, page['next_cursor'], relative_times, ignored_ids)
+            messages = messages + page['messages']
+            refills += 1
+        return {
+            "messages": messages,
+            "has_more_messages": page['has_more_messages'],
+            "next_cursor": page['next_cursor'],
+            "liked_ids": self.get_liked_ids(user_id, messages)
+        }
 
-        has_more_messages = len(recent_messages_objects) > limit
+    def feed_page(self, limit: int, offset: int, cursor: Optional[str], relative_times: bool,
+                  ignored_ids: frozenset) -> dict:
+        # Первую страницу запрашивает каждый клиент при подключении — она отдаётся из памяти
+        first_page = not cursor and not offset
+        if first_page:
+            page = self.feed_cache.get(limit, relative_times, ignored_ids)
+            if page is not None:
+                return page
+            version = self.feed_cache.version
+
+        # _id как второй ключ сортировки делает порядок однозначным для курсора
+        queryset = Message.objects.order_by('-created_at', '-id').only(*MESSAGE_FIELDS)
+        if cursor:
+            # Keyset-пагинация: страница N стоит столько же, сколько первая
+            queryset = queryset.filter(older_than(cursor))
+        elif offset:
+            queryset = queryset.skip(offset)
+        recent_messages = list(queryset.limit(limit + 1).as_pymongo())
+
+        has_more_messages = len(recent_messages) > limit
         if has_more_messages:
-            recent_messages_objects = recent_messages_objects[:-1]
-
-        messages_dicts = []
-        for message in recent_messages_objects:
-            message_dict = MessageManager.message_to_dict(message)
-
-            # Fetch comments for the message
-            comments = Comment.objects(message=message.id)
-            message_dict['comments'] = [MessageManager.comment_to_dict(comment) for comment in comments]
+            recent_messages = recent_messages[:-1]
 
-            # For each comment, fetch subcomments
-            for comment_dict in message_dict['comments']:
-                subcomments = SubComment.objects(parent_comment=comment_dict['comment_id'])
-                comment_dict['subcomments'] = [MessageManager.subcomment_to_dict(subcomment) for subcomment in
-                                               subcomments]
-
-            messages_dicts.append(message_dict)
-
-        return {
-            "messages": messages_dicts,
-            "has_more_messages": has_more_messages
-        }
+        nodes = self.feed_assembler.build(recent_messages)
+        if first_page:
+            self.feed_cache.store(limit, nodes, has_more_messages, version)
+        return FeedCache.render({'messages': nodes, 'has_more_messages': has_more_messages}, relative_times,
+                                ignored_ids)
 
     def send_notification(self, user_id: int, text: str) -> None:
         try:
-            user = User.objects.get(forum_id=user_id)
-            new_notification = Notification(user=user, text=text)
+            user = self.get_user(user_id)
+            new_notification = Notification(user=user.id, text=text)
             new_notification.save()
         except DoesNotExist:
             raise ValueError("User does not exist")
 
-    def get_message_comments(self, message_id: str) -> list:
-        message = Message.objects.get(id=message_id)
-        return list(Comment.objects(message=message))
+    def get_message_comments(self, message_id: str, cursor: Optional[str] = None, limit: int = COMMENTS_PAGE,
+                             user_id: Optional[int] = None) -> dict:
+        """Следующая порция комментариев треда после курсора из ленты, каждый с первыми ответами"""
+        if not ObjectId.is_valid(message_id):
+            raise ValueError(f"Invalid message id: {message_id}")
+        self.check_page_limit(limit)
+        if self.purge.pending([('tweet', ObjectId(message_id))]):
+            # Твит удалён, его комментарии ещё вычищаются
+            return {"message_id": message_id, "comments": [], "next_cursor": None, "liked_ids": []}
+        queryset = Comment.objects(message=ObjectId(message_id))
+        comments, next_cursor = self.thread_page(queryset, COMMENT_FIELDS, cursor, limit)
+        ignored_ids = self.ignored_by(user_id)
+        nodes = [FeedAssembler.render(node, ignored_ids=ignored_ids) for node in
+                 FeedAssembler.visible(self.feed_assembler.build_comments(comments), ignored_ids)]
+        return {"message_id": message_id, "comments": nodes, "next_cursor": next_cursor,
+                "liked_ids": self.get_liked_ids(user_id, nodes)}
+
+    def get_subcomments(self, comment_id: str, cursor: Optional[str] = None, limit: int = COMMENTS_PAGE,
+                        user_id: Optional[int] = None) -> dict:
+        if not ObjectId.is_valid(comment_id):
+            raise ValueError(f"Invalid comment id: {comment_id}")
+        self.check_page_limit(limit)
+        thread_id = self.get_thread_id('comment', comment_id)
+        deleted = [('comment', ObjectId(comment_id))] + ([('tweet', ObjectId(thread_id))] if thread_id else [])
+        if thread_id is None or self.purge.pending(deleted):
+            return {"comment_id": comment_id, "subcomments": [], "next_cursor": None, "liked_ids": []}
+        queryset = SubComment.objects(parent_comment=ObjectId(comment_id))
+        subcomments, next_cursor = self.thread_page(queryset, SUBCOMMENT_FIELDS, cursor, limit)
+        ignored_ids = self.ignored_by(user_id)
+        nodes = [FeedAssembler.render(node) for node in
+                 FeedAssembler.visible(self.feed_assembler.build_subcomments(subcomments), ignored_ids)]
+        return {"comment_id": comment_id, "subcomments": nodes, "next_cursor": next_cursor,
+                "liked_ids": self.get_liked_ids(user_id, nodes)}
+
+    def ignored_by(self, user_id: Optional[int]) -> frozenset:
+        user = self.user_cache.get(user_id) if user_id is not None else None
+        return user.ignored_ids if user is not None else frozenset()
+
+    @staticmethod
+    def check_page_limit(limit: int) -> None:
+        if not 0 < limit <= MAX_COMMENTS_PAGE:
+            raise ValueError(f"Limit must be between 1 and {MAX_COMMENTS_PAGE}")
+
+    @staticmethod
+    def thread_page(queryset, fields: tuple, cursor: Optional[str], limit: int) -> tuple[list, Optional[str]]:
+        """Keyset-страница треда в порядке (created_at, _id), «сырыми» документами, и курсор следующей"""
+        queryset = queryset.order_by('created_at', 'id').only(*fields)
+        if cursor:
+            queryset = queryset.filter(newer_than(cursor))
+        rows = list(queryset.limit(limit + 1).as_pymongo())
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1]['created_at'], rows[-1]['_id'])
 
     def check_required_fields(self, data, required_fields):
         missing_fields = [field for field in required_fields if field not in data]
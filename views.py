@@ -1,18 +1,152 @@
+import atexit
+import os
 from typing import Any, Optional
-from flask import request, jsonify
+from flask import request, jsonify, Response
 from flask.views import MethodView
 from flask_cors import cross_origin
 from socketio_singleton import socketio
-from models import User, Comment
-from user_functions import UserService
-
-user_service = UserService()
+from bus_singleton import bus
+from models import Message, Comment, SubComment, Like
+from user_functions import UserService, COMMENTS_PAGE
+from admins import ADMIN_IDS
+from rooms import BROADCAST_ROOM, user_room, thread_room, current_sid
+from emit_aggregator import EmitAggregator
+from like_writer import LikeWriter
+from purge import PurgeWorker
+from db_executor import DBExecutor, OffloadedService, default_backend
+from profiler_singleton import profiler
+from metrics import room_stats
+from metrics_singleton import registry
+from wire_format import check_wire, encode
+from event_log import replayable
+from event_log_singleton import event_log
+
+# LIKE_WRITE_BEHIND_MS > 0 включает отложенную запись лайков пачками раз в указанный интервал
+like_writer = None
+if int(os.environ.get('LIKE_WRITE_BEHIND_MS', 0)) > 0:
+    like_writer = LikeWriter({'tweet': Message, 'comment': Comment, 'subcomment': SubComment}, Like,
+                             interval=int(os.environ['LIKE_WRITE_BEHIND_MS']) / 1000,
+                             max_batch=int(os.environ.get('LIKE_WRITE_BEHIND_MAX_BATCH', 1000)))
+    # Незаписанные клики не должны теряться при остановке воркера
+    atexit.register(like_writer.flush)
+
+# Удаление ставит надгробие, зависимые документы вычищаются в фоне пачками
+purge_worker = PurgeWorker(batch_size=int(os.environ.get('PURGE_BATCH_SIZE', 500)),
+                           pause=int(os.environ.get('PURGE_PAUSE_MS', 0)) / 1000)
+
+service = UserService(bus, like_writer, purge_worker)
+if like_writer is not None:
+    # Запись идёт из потока таймера LikeWriter, поэтому в обход DBExecutor
+    like_writer.on_flush = service.publish_like_totals
+
+# Синхронные вызовы pymongo выполняются вне хаба eventlet, чтобы медленный запрос не останавливал все сокеты
+db_executor = DBExecutor(backend=os.environ.get('DB_EXECUTOR') or default_backend(),
+                         max_workers=int(os.environ.get('DB_MAX_WORKERS', 20)),
+                         max_in_flight=int(os.environ.get('DB_MAX_IN_FLIGHT', 100)),
+                         timeout=int(os.environ.get('DB_TIMEOUT_MS', 5000)) / 1000 or None)
+# Лента и списки собираются несколькими запросами, им нужно больше времени
+feed_timeout = int(os.environ.get('DB_FEED_TIMEOUT_MS', 15000)) / 1000 or None
+user_service = OffloadedService(service, db_executor,
+                                timeouts={'get_recent_messages': feed_timeout, 'get_user_posts': feed_timeout,
+                                          'get_top_users': feed_timeout},
+                                inline=('check_required_fields', 'check_message_length'))
+# Счётчики лайков в треды уходят не чаще одного раза за окно, сколько бы ни было кликов
+like_emits = EmitAggregator(socketio,
+                            window=int(os.environ.get('LIKE_EMIT_WINDOW_MS', 200)) / 1000,
+                            max_batch=int(os.environ.get('LIKE_EMIT_MAX_BATCH', 500)))
+
+
+def cache_stats() -> dict:
+    return {'user': user_service.user_cache.stats(), 'feed': user_service.feed_cache.stats()}
+
+
+def hit_ratio(stats: dict) -> float:
+    lookups = stats['hits'] + stats['misses']
+    return stats['hits'] / lookups if lookups else 0.0
+
+
+def room_kinds(key: str) -> dict:
+    return {(kind,): stats[key] for kind, stats in room_stats(socketio.server)['kinds'].items()}
+
+
+# Значения, которые уже считают сами компоненты, читаются в момент запроса /metrics
+registry.gauge('socketio_connected_clients', 'Connected Socket.IO clients',
+               lambda: {(): room_stats(socketio.server)['connected']})
+registry.gauge('socketio_rooms', 'Rooms by kind', lambda: room_kinds('rooms'), ('kind',))
+registry.gauge('socketio_room_members', 'Room memberships by kind of room', lambda: room_kinds('members'), ('kind',))
+registry.gauge('socketio_room_members_max', 'Members of the largest room of each kind',
+               lambda: room_kinds('max_members'), ('kind',))
+registry.gauge('cache_hits_total', 'Cache hits',
+               lambda: {(name,): stats['hits'] for name, stats in cache_stats().items()}, ('cache',), 'counter')
+registry.gauge('cache_misses_total', 'Cache misses',
+               lambda: {(name,): stats['misses'] for name, stats in cache_stats().items()}, ('cache',), 'counter')
+registry.gauge('cache_hit_ratio', 'Share of cache lookups that hit',
+               lambda: {(name,): hit_ratio(stats) for name, stats in cache_stats().items()}, ('cache',))
+registry.gauge('cache_entries', 'Entries held by the cache',
+               lambda: {(name,): stats['size'] for name, stats in cache_stats().items()}, ('cache',))
+registry.gauge('db_executor_in_flight', 'Database operations in progress',
+               lambda: {(): db_executor.stats()['in_flight']})
+registry.gauge('db_executor_rejected_total', 'Database operations rejected over the in-flight cap',
+               lambda: {(): db_executor.stats()['rejected']}, metric_type='counter')
+registry.gauge('db_executor_timeouts_total', 'Database operations that timed out',
+               lambda: {(): db_executor.stats()['timeouts']}, metric_type='counter')
+registry.gauge('like_emits_coalesced_total', 'Like counters merged into an already pending thread update',
+               lambda: {(): like_emits.stats()['coalesced']}, metric_type='counter')
+registry.gauge('like_writes_pending', 'Like clicks waiting for the write-behind flush',
+               lambda: {(): like_writer.stats()['pending']} if like_writer is not None else {})
+registry.gauge('purge_removed_total', 'Documents of deleted threads removed by the background purge',
+               lambda: {(collection,): count for collection, count in purge_worker.stats()['removed'].items()},
+               ('collection',), 'counter')
+registry.gauge('purge_batches_total', 'delete_many batches run by the background purge',
+               lambda: {(): purge_worker.stats()['batches']}, metric_type='counter')
+registry.gauge('purge_completed_total', 'Deleted tweets and comments purged completely',
+               lambda: {(): purge_worker.stats()['completed']}, metric_type='counter')
+registry.gauge('purge_failures_total', 'Purge passes stopped by an error',
+               lambda: {(): purge_worker.stats()['failures']}, metric_type='counter')
+registry.gauge('event_log_entries', 'Broadcasts held for replay on resume', lambda: {(): event_log.stats()['size']})
+registry.gauge('event_log_replayed_total', 'Events replayed to resuming clients',
+               lambda: {(): event_log.stats()['replayed']}, metric_type='counter')
+registry.gauge('event_log_reloads_total', 'Resumes that fell back to a full reload',
+               lambda: {(): event_log.stats()['reloads']}, metric_type='counter')
 
 
 class BaseView(MethodView):
     def __init__(self, socketio):
         self.socketio = socketio
 
+    def broadcast(self, event: str, data) -> None:
+        # Событие действительно нужно всем подключённым клиентам
+        self.socketio.emit(event, replayable(data), room=BROADCAST_ROOM)
+
+    def emit_to_thread(self, event: str, data, message_id: Optional[str], skip_sender: bool = False) -> None:
+        # Только клиентам, у которых твит сейчас открыт в ленте
+        if message_id is None:
+            return
+        skip_sid = current_sid() if skip_sender else None
+        self.socketio.emit(event, replayable(data), room=thread_room(message_id), skip_sid=skip_sid)
+
+    def emit_like_count(self, message_type: str, message_id: str, total: int) -> None:
+        thread_id = user_service.get_thread_id(message_type, message_id)
+        if thread_id is not None:
+            like_emits.add(thread_room(thread_id),
+                           {"message_type": message_type, "message_id": message_id, "total": total})
+
+    def emit_to_user(self, event: str, data, user_id) -> None:
+        # Все вкладки конкретного пользователя
+        self.socketio.emit(event, replayable(data), room=user_room(user_id))
+
+    def emit_to_admins(self, event: str, data) -> None:
+        self.socketio.emit(event, replayable(data), room=[user_room(admin_id) for admin_id in ADMIN_IDS])
+
+    def reply(self, event: str, data, user_id=None) -> None:
+        # Ответ на запрос: сокету-отправителю, а для HTTP — вкладкам этого пользователя.
+        # Ответы не нумеруются: после переподключения клиент запросит их заново
+        sid = current_sid()
+        if sid is not None:
+            self.socketio.emit(event, data, room=sid)
+        elif user_id is not None:
+            self.socketio.emit(event, data, room=user_room(user_id))
+
 
 class UserView(BaseView):
     @cross_origin()
@@ -40,7 +174,7 @@ class UserView(BaseView):
             return jsonify({"message": f"User {username} already exists in the database."}), 200
         user_service.create_user(user_id, username, avatar_url)
 
-        self.socketio.emit('new user', data, room='room')
+        self.broadcast('new user', data)
         return jsonify({"message": f"User {username} has been added to the database."}), 201
 
 
@@ -77,14 +211,14 @@ class CreateMessageView(BaseView):
         else:
             user_service.update_username_and_avatar(user_id, username, avatar_url)
 
-        user = User.objects.get(forum_id=user_id)
+        user = user_service.get_user(user_id)
         if user.banned:
             return jsonify({"message": f"User {username} is banned and cannot create messages."}), 403
 
         message_id = user_service.create_message(user_id, content)
 
         data['message_id'] = message_id
-        self.socketio.emit('new tweet', data, room='room')
+        self.broadcast('new tweet', data)
         return jsonify({"message": f"Message has been created for user {username}.", "message_id": message_id}), 201
 
 
@@ -106,7 +240,7 @@ class DeleteMessageView(BaseView):
 
         user_service.delete_message(message_id, user_id)
 
-        self.socketio.emit('delete message', data, room='room')
+        self.emit_to_thread('delete message', data, message_id)
         return jsonify({"message": f"Message with id {message_id} has been deleted."}), 200
 
 
@@ -131,7 +265,7 @@ class UpdateMessageView(BaseView):
         except ValueError as e:
             return jsonify({"message": str(e)}), 400
         user_service.edit_message(message_id, user_id, new_content)
-        self.socketio.emit('update message', data, room='room')
+        self.emit_to_thread('update message', data, message_id)
         return jsonify({"message": f"Message with id {message_id} has been edited."}), 200
 
 
@@ -167,7 +301,7 @@ class CreateCommentView(BaseView):
 
         comment_id = user_service.create_comment(user_id, message_id, content)
         data['comment_id'] = comment_id  # Add the comment id to the data
-        self.socketio.emit('new comment', data, room='room')
+        self.emit_to_thread('new comment', data, message_id)
         return jsonify(
             {"message": f"Comment has been created for message {message_id}.", "comment_id": comment_id}), 201
 
@@ -191,8 +325,9 @@ class DeleteCommentView(BaseView):
         if not user_service.user_exists(user_id):
             return jsonify({"message": "User does not exist"}), 404
 
+        thread_id = user_service.get_thread_id('comment', comment_id)
         user_service.delete_comment(comment_id, user_id)
-        self.socketio.emit('delete comment', data, room='room')
+        self.emit_to_thread('delete comment', data, thread_id)
         return jsonify({"message": f"Comment {comment_id} has been deleted."}), 200
 
 
@@ -217,7 +352,7 @@ class UpdateCommentView(BaseView):
             return jsonify({"message": "User does not exist"}), 404
 
         user_service.update_comment(comment_id, user_id, new_content)
-        self.socketio.emit('update comment', data, room='room')
+        self.emit_to_thread('update comment', data, user_service.get_thread_id('comment', comment_id))
         return jsonify({"message": f"Comment {comment_id} has been updated."}), 200
 
 
@@ -260,7 +395,7 @@ class CreateSubCommentView(BaseView):
             return jsonify({"message": f"Comment with ID {message_id} does not exist."}), 404
 
         data['subcomment_id'] = subcomment_id  # Add the subcomment id to the data
-        self.socketio.emit('new subcomment', data, room='room')
+        self.emit_to_thread('new subcomment', data, user_service.get_thread_id('subcomment', subcomment_id))
         return jsonify(
             {"message": f"SubComment has been created for comment {message_id}.", "subcomment_id": subcomment_id}), 201
 
@@ -284,8 +419,9 @@ class DeleteSubCommentView(BaseView):
         if not user_service.user_exists(user_id):
             return jsonify({"message": "User does not exist"}), 404
 
+        thread_id = user_service.get_thread_id('subcomment', subcomment_id)
         user_service.delete_subcomment(subcomment_id, user_id)
-        self.socketio.emit('delete subcomment', data, room='room')
+        self.emit_to_thread('delete subcomment', data, thread_id)
         return jsonify({"message": f"Subcomment {subcomment_id} has been deleted."}), 200
 
 
@@ -310,7 +446,7 @@ class UpdateSubCommentView(BaseView):
         except ValueError as e:
             return jsonify({"message": str(e)}), 400
         user_service.edit_subcomment(subcomment_id, user_id, new_content)
-        self.socketio.emit('update subcomment', data, room='room')
+        self.emit_to_thread('update subcomment', data, user_service.get_thread_id('subcomment', subcomment_id))
         return jsonify({"message": f"Subcomment with id {subcomment_id} has been edited."}), 200
 
 
@@ -332,10 +468,10 @@ class LikeMessageView(BaseView):
 
     def handle_like_message(self, user_id: int, message_id: str, message_type: str):
         try:
-            user_service.like(user_id, message_id, message_type, 1)  # Передаем message_type в функцию
-            likes_data = user_service.get_likes(user_id, message_id, message_type)  # Передаем message_type в функцию
-            self.socketio.emit('like message', {"message_id": message_id, "likes": likes_data}, room='room')
-            self.socketio.emit('message likes', {"message_id": message_id, "likes": likes_data}, room='room')
+            total = user_service.like(user_id, message_id, message_type, 1)
+            self.reply('message likes', {"message_id": message_id, "likes": {"total": total, "user_liked": True}},
+                       user_id)
+            self.emit_like_count(message_type, message_id, total)
             return jsonify({"message": f"Message with id {message_id} has been liked."}), 200
         except ValueError as e:
             return jsonify({"message": str(e)}), 400
@@ -359,9 +495,10 @@ class RemoveLikeMessageView(BaseView):
 
     def handle_remove_like(self, user_id: int, message_id: str, message_type: str):
         try:
-            user_service.remove_like(user_id, message_id, message_type)  # Передаем message_type в функцию
-            likes_data = user_service.get_likes(user_id, message_id, message_type)  # Передаем message_type в функцию
-            self.socketio.emit('message likes', {"message_id": message_id, "likes": likes_data}, room='room')
+            total = user_service.remove_like(user_id, message_id, message_type)
+            self.reply('message likes', {"message_id": message_id, "likes": {"total": total, "user_liked": False}},
+                       user_id)
+            self.emit_like_count(message_type, message_id, total)
             return jsonify({"message": f"Like has been removed from message with id {message_id}."}), 200
         except ValueError:
             return jsonify({"message": "User has not liked this message"}), 400
@@ -378,7 +515,31 @@ class GetMessageLikesView(BaseView):
 
     def handle_get_likes(self, user_id: int, message_id: str, message_type: str):
         likes = user_service.get_likes(user_id, message_id, message_type)  # Передаем message_type в функцию
-        self.socketio.emit('message likes', {"message_id": message_id, "likes": likes}, room='room')
+        self.reply('message likes', {"message_id": message_id, "likes": likes}, user_id)
+        return jsonify({"likes": likes}), 200
+
+
+class GetLikesView(BaseView):
+    @cross_origin()
+    def post(self) -> tuple[Any, int]:
+        data: Optional[dict] = request.get_json()
+        if data is None:
+            return jsonify({"message": "No data provided"}), 400
+        return self.handle_get_likes_bulk(data)
+
+    @socketio.on('get likes')
+    def handle_get_likes_bulk_socket(self, data: dict):
+        return self.handle_get_likes_bulk(data)
+
+    def handle_get_likes_bulk(self, data: dict):
+        # items — список пар [тип, id]: лайки всей страницы ленты одним запросом
+        user_id = data.get('user_id')
+        try:
+            items = [(message_type, message_id) for message_type, message_id in data.get('items', [])]
+            likes = user_service.get_likes_bulk(user_id, items)
+        except (TypeError, ValueError) as e:
+            return jsonify({"message": str(e)}), 400
+        self.reply('likes', {"likes": likes}, user_id)
         return jsonify({"likes": likes}), 200
 
 
@@ -397,7 +558,7 @@ class BanUserView(BaseView):
         if user_service.check_ban_status(user_id):
             return jsonify({"message": "User is already banned"}), 400
         user_service.ban_user(user_id)
-        self.socketio.emit('ban user', {'user_id': user_id}, room='room')
+        self.broadcast('ban user', {'user_id': user_id})
         return jsonify({"message": f"User with id {user_id} has been banned."}), 200
 
 
@@ -416,7 +577,7 @@ class UnbanUserView(BaseView):
         if not user_service.check_ban_status(user_id):
             return jsonify({"message": "User is not banned"}), 400
         user_service.unban_user(user_id)
-        self.socketio.emit('unban user', {'user_id': user_id}, room='room')
+        self.broadcast('unban user', {'user_id': user_id})
         return jsonify({"message": f"User with id {user_id} has been unbanned."}), 200
 
 
@@ -443,8 +604,8 @@ class IgnoreUserView(BaseView):
 
         # Отправляем обновленный список игнорируемых пользователей
         ignored_users = user_service.get_ignored_users(user_id)
-        self.socketio.emit('update ignored users', ignored_users, room='room')
-        self.socketio.emit('ignore user', data, room='room')
+        self.reply('update ignored users', ignored_users, user_id)
+        self.emit_to_user('ignore user', data, user_id)
         return jsonify(
             {"message": f"User with id {ignored_user_id} has been added to ignore list of user {user_id}."}), 200
 
@@ -470,7 +631,7 @@ class UnignoreUserView(BaseView):
         except ValueError as e:
             return jsonify({"message": str(e)}), 400
 
-        self.socketio.emit('unignore user', data, room='room')
+        self.emit_to_user('unignore user', data, user_id)
         return jsonify(
             {"message": f"User with id {ignored_user_id} has been removed from ignore list of user {user_id}."}), 200
 
@@ -492,7 +653,7 @@ class GetIgnoredUsersView(BaseView):
             ignored_users = user_service.get_ignored_users(user_id)
         except ValueError as e:
             return jsonify({"message": str(e)}), 400
-        self.socketio.emit('update ignored users', ignored_users, room='room')
+        self.reply('update ignored users', ignored_users, user_id)
         return jsonify({"ignored_users": ignored_users}), 200
 
 
@@ -515,7 +676,7 @@ class ReportMessageView(BaseView):
 
         user_service.report_message(user_id, message_id, reason)
 
-        self.socketio.emit('report message', data, room='room')
+        self.emit_to_admins('report message', data)
         return jsonify({"message": f"Message with id {message_id} has been reported."}), 200
 
 
@@ -538,7 +699,7 @@ class ReportCommentView(BaseView):
 
         user_service.report_comment(user_id, comment_id, reason)
 
-        self.socketio.emit('report comment', data, room='room')
+        self.emit_to_admins('report comment', data)
         return jsonify({"message": f"Comment with id {comment_id} has been reported."}), 200
 
 
@@ -548,30 +709,43 @@ class GetTopUsersView(BaseView):
         return self.handle_get_top_users()
 
     @socketio.on('get top users')
-    def handle_get_top_users_socket(self):
+    def handle_get_top_users_socket(self, data: Optional[dict] = None):
         return self.handle_get_top_users()
 
     def handle_get_top_users(self):
         top_users = user_service.get_top_users()
-        return jsonify({"top_users": [user.forum_id for user in top_users]}), 200
+        self.reply('top users', top_users)
+        return jsonify({"top_users": [user["id"] for user in top_users], "leaderboard": top_users}), 200
 
 
 class GetRecentMessagesView(BaseView):
     @cross_origin()
     def get(self) -> tuple[Any, int]:
-        return self.handle_get_recent_messages()
+        return self.handle_get_recent_messages(request.args.get('user_id', type=int),
+                                               request.args.get('offset', 0, type=int),
+                                               request.args.get('cursor'),
+                                               bool(request.args.get('relative_times', 0, type=int)))
 
     @socketio.on('get recent messages')
     def handle_get_recent_messages_socket(self, data: dict):
         offset = data.get('offset', 0)
         user_id = data.get('user_id')
-        return self.handle_get_recent_messages(user_id, offset)
+        cursor = data.get('cursor')
+        relative_times = bool(data.get('relative_times', False))
+        return self.handle_get_recent_messages(user_id, offset, cursor, relative_times, data.get('wire'))
 
-    def handle_get_recent_messages(self, user_id, offset=0):
-        response_data = user_service.get_recent_messages(offset=offset, user_id=user_id)
+    def handle_get_recent_messages(self, user_id, offset=0, cursor=None, relative_times=False, wire=None):
+        try:
+            # Компактный формат только по запросу сокета: ответ на HTTP уходит во все вкладки пользователя
+            wire = check_wire(wire)
+            response_data = user_service.get_recent_messages(offset=offset, user_id=user_id, cursor=cursor,
+                                                             relative_times=relative_times)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
         recent_messages_dicts = response_data['messages']
-        self.socketio.emit('recent messages', response_data, room='room')
-        return jsonify({"recent_messages": [message['message_id'] for message in recent_messages_dicts]}), 200
+        self.reply('recent messages', encode(response_data, wire), user_id)
+        return jsonify({"recent_messages": [message['message_id'] for message in recent_messages_dicts],
+                        "next_cursor": response_data['next_cursor']}), 200
 
 
 class SendNotificationView(BaseView):
@@ -592,24 +766,56 @@ class SendNotificationView(BaseView):
 
         user_service.send_notification(user_id, text)
 
-        self.socketio.emit('send notification', data, room='room')
+        self.emit_to_user('send notification', data, user_id)
         return jsonify({"message": f"Notification has been sent to user with id {user_id}."}), 200
 
 
 class GetMessageCommentsView(BaseView):
     @cross_origin()
     def get(self, message_id: str) -> tuple[Any, int]:
-        return self.handle_get_message_comments(message_id)
+        return self.handle_get_message_comments(message_id, request.args.get('cursor'),
+                                                request.args.get('limit', COMMENTS_PAGE, type=int),
+                                                request.args.get('user_id', type=int))
 
     @socketio.on('get message comments')
     def handle_get_message_comments_socket(self, data: dict):
-        return self.handle_get_message_comments(data.get('message_id'))
+        return self.handle_get_message_comments(data.get('message_id'), data.get('cursor'),
+                                                data.get('limit', COMMENTS_PAGE), data.get('user_id'),
+                                                data.get('wire'))
+
+    def handle_get_message_comments(self, message_id: str, cursor=None, limit=COMMENTS_PAGE, user_id=None,
+                                    wire=None):
+        try:
+            wire = check_wire(wire)
+            response_data = user_service.get_message_comments(message_id, cursor, limit, user_id)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        self.reply('get message comments', encode(response_data, wire), user_id)
+        return jsonify({"comments": [comment['comment_id'] for comment in response_data['comments']],
+                        "next_cursor": response_data['next_cursor']}), 200
+
+
+class GetSubcommentsView(BaseView):
+    @cross_origin()
+    def get(self, comment_id: str) -> tuple[Any, int]:
+        return self.handle_get_subcomments(comment_id, request.args.get('cursor'),
+                                           request.args.get('limit', COMMENTS_PAGE, type=int),
+                                           request.args.get('user_id', type=int))
 
-    def handle_get_message_comments(self, message_id: str):
-        comments = user_service.get_message_comments(message_id)
-        self.socketio.emit('get message comments',
-                      {"message_id": message_id, "comments": [str(comment.id) for comment in comments]}, room='room')
-        return jsonify({"comments": [str(comment.id) for comment in comments]}), 200
+    @socketio.on('get subcomments')
+    def handle_get_subcomments_socket(self, data: dict):
+        return self.handle_get_subcomments(data.get('comment_id'), data.get('cursor'),
+                                           data.get('limit', COMMENTS_PAGE), data.get('user_id'), data.get('wire'))
+
+    def handle_get_subcomments(self, comment_id: str, cursor=None, limit=COMMENTS_PAGE, user_id=None, wire=None):
+        try:
+            wire = check_wire(wire)
+            response_data = user_service.get_subcomments(comment_id, cursor, limit, user_id)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        self.reply('subcomments', encode(response_data, wire), user_id)
+        return jsonify({"subcomments": [subcomment['subcomment_id'] for subcomment in response_data['subcomments']],
+                        "next_cursor": response_data['next_cursor']}), 200
 
 
 class GetUserPostsView(BaseView):
@@ -625,5 +831,44 @@ class GetUserPostsView(BaseView):
         if not user_service.user_exists(user_id):
             return jsonify({"message": "User does not exist"}), 404
         posts_data = user_service.get_user_posts(user_id)
-        self.socketio.emit('get user posts', {"user_id": user_id, "posts_data": posts_data}, room='room')
+        self.reply('get user posts', {"user_id": user_id, "posts_data": posts_data}, user_id)
         return jsonify({"user_posts": posts_data}), 200
+
+
+class QueryStatsView(BaseView):
+    @cross_origin()
+    def get(self) -> tuple[Any, int]:
+        return self.handle_get_query_stats(request.args.get('user_id', type=int))
+
+    @socketio.on('get query stats')
+    def handle_get_query_stats_socket(self, data: dict):
+        return self.handle_get_query_stats(data.get('user_id'))
+
+    def handle_get_query_stats(self, user_id: int):
+        if user_id not in ADMIN_IDS:
+            return jsonify({"message": "Only admins can see query stats"}), 403
+        stats = profiler.stats()
+        self.reply('query stats', stats, user_id)
+        return jsonify(stats), 200
+
+
+class PurgeStatusView(BaseView):
+    @cross_origin()
+    def get(self) -> tuple[Any, int]:
+        return self.handle_get_purge_status(request.args.get('user_id', type=int))
+
+    @socketio.on('get purge status')
+    def handle_get_purge_status_socket(self, data: dict):
+        return self.handle_get_purge_status(data.get('user_id'))
+
+    def handle_get_purge_status(self, user_id: int):
+        if user_id not in ADMIN_IDS:
+            return jsonify({"message": "Only admins can see purge status"}), 403
+        status = user_service.get_purge_status()
+        self.reply('purge status', status, user_id)
+        return jsonify(status), 200
+
+
+class MetricsView(BaseView):
+    def get(self):
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
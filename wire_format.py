@@ -0,0 +1,122 @@
+from typing import Optional
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Форматы ответа, которые клиент может попросить полем wire
+WIRE_FORMATS = ('json', 'compact', 'msgpack')
+# Поля автора, которые в компактном формате уходят в таблицу users
+AUTHOR_FIELDS = ('user_id', 'username', 'avatar_url')
+# Списки вложенных элементов страницы: твиты, их комментарии и ответы на комментарии
+ITEM_LISTS = ('messages', 'comments', 'subcomments')
+
+
+def check_wire(wire: Optional[str]) -> str:
+    wire = wire or 'json'
+    if wire not in WIRE_FORMATS:
+        raise ValueError(f"Unknown wire format: {wire}")
+    return wire
+
+
+def encode(payload: dict, wire: str = 'json'):
+    """
+    Page payload in the format the client asked for.
+    'compact' moves authors into a per-payload users table; 'msgpack' also packs it into bytes,
+    which Socket.IO sends as a binary attachment. Without the msgpack package 'msgpack' falls back to 'compact'
+    """
+    if wire == 'json':
+        return payload
+    compacted = compact(payload)
+    if wire == 'msgpack' and msgpack is not None:
+        return msgpack.packb(compacted, use_bin_type=True)
+    return compacted
+
+
+def compact(payload: dict) -> dict:
+    """
+    Copy of the payload where every item refers to its author by index in payload['users'],
+    a list of [user_id, username, avatar_url] with each author once
+    """
+    users = []
+    indexes = {}
+    compacted = compact_item(payload, users, indexes)
+    compacted['users'] = users
+    return compacted
+
+
+def compact_item(item: dict, users: list, indexes: dict) -> dict:
+    compacted = dict(item)
+    if 'user_id' in compacted:
+        author = tuple(compacted.pop(field, None) for field in AUTHOR_FIELDS)
+        index = indexes.get(author)
+        if index is None:
+            index = indexes[author] = len(users)
+            users.append(list(author))
+        compacted['user'] = index
+    for key in ITEM_LISTS:
+        children = compacted.get(key)
+        if isinstance(children, list):
+            compacted[key] = [compact_item(child, users, indexes) for child in children]
+    return compacted
+
+
+def expand(payload: dict) -> dict:
+    """Обратное преобразование, как его делает decodePage в client/script.js"""
+    users = payload['users']
+    expanded = expand_item(payload, users)
+    del expanded['users']
+    return expanded
+
+
+def expand_item(item: dict, users: list) -> dict:
+    expanded = {}
+    for key, value in item.items():
+        if key == 'user' and isinstance(value, int):
+            expanded.update(zip(AUTHOR_FIELDS, users[value]))
+            continue
+        if key in ITEM_LISTS and isinstance(value, list):
+            value = [expand_item(child, users) for child in value]
+        expanded[key] = value
+    return expanded
+
+
+def deflate_websocket_above(threshold: int) -> bool:
+    """
+    Compress websocket messages with permessage-deflate only from threshold characters up.
+    eventlet negotiates the extension whenever the browser offers it and then deflates every frame,
+    small like and typing events included; RFC 7692 lets a sender leave single messages uncompressed.
+    Returns False when the eventlet websocket is not available. The patch replaces private methods
+    of eventlet 0.33 (pinned in pyproject.toml) and raises RuntimeError if an upgrade removed them
+    """
+    try:
+        from eventlet.websocket import RFC6455WebSocket
+    except ImportError:
+        return False
+    missing = [name for name in ('_pack_message', '_get_permessage_deflate_enc')
+               if not hasattr(RFC6455WebSocket, name)]
+    if missing:
+        raise RuntimeError(f"eventlet RFC6455WebSocket has no {', '.join(missing)}: "
+                           f"deflate_websocket_above needs updating for this eventlet version")
+    RFC6455WebSocket.compression_threshold = threshold
+    if getattr(RFC6455WebSocket, 'deflate_threshold_installed', False):
+        return True
+    pack_message = RFC6455WebSocket._pack_message
+    get_encoder = RFC6455WebSocket._get_permessage_deflate_enc
+
+    def pack_message_above(self, message, *args, **kwargs):
+        # Упаковка кадра не переключает green-потоки, так что флаг на сокете виден только этому вызову
+        self.skip_deflate = len(message) < self.compression_threshold
+        try:
+            return pack_message(self, message, *args, **kwargs)
+        finally:
+            self.skip_deflate = False
+
+    def encoder_above(self):
+        return None if getattr(self, 'skip_deflate', False) else get_encoder(self)
+
+    RFC6455WebSocket._pack_message = pack_message_above
+    RFC6455WebSocket._get_permessage_deflate_enc = encoder_above
+    RFC6455WebSocket.deflate_threshold_installed = True
+    return True
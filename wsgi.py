@@ -1,4 +1,9 @@
-from server import app, socketio
+import bootstrap  # noqa: F401
+
+from server import app, socketio, purge_worker
+from models import ensure_indexes
 
 if __name__ == "__main__":
+    ensure_indexes()
+    purge_worker.wake()
     socketio.run(app)